@@ -0,0 +1,253 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, shapes are rasterized one vertex at a time instead
+    np = None
+
+from stormregion_roads import sample_roads
+
+'''
+Bake roads, junctions and decals into the splatmaps
+
+Instead of being drawn as extra geometry every road, junction and decal
+material becomes one more splat layer, its coverage (0-255) of each heightmap
+vertex with a vertex of antialiasing along the edges. See
+stormregion_map.bake_overlays for how the layers are merged into the blend.
+
+Footprints, in heightmap vertices:
+
+    roads       - quads between the samples of stormregion_roads.sample_roads,
+                  r1 to the left and r2 to the right of the centre line
+    junctions   - disc of max(r1, r2), as for the junction meshes
+    decals      - DECAL_SIZE rectangle centred on x/z, width and height swap
+                  for 90/270 degree decals
+
+The terrain is cut into TILE_SIZE square tiles which are rasterized on a
+thread pool, each tile only looks at the shapes whose bounds touch it.
+'''
+
+# (width, height) of a decal in world units, the DECA chunk doesn't have it
+DECAL_SIZE = (8.0, 8.0)
+
+TILE_SIZE = 256
+
+
+def overlay_shapes(map_file, roads: bool = True, decals: bool = True, decal_sizes: dict = None):
+    '''
+    material -> list of (kind, shapes) to rasterize for it, kind is "quad",
+    "disc" or "rect" and shapes a tuple of equal length columns (arrays or
+    lists) in heightmap vertex coordinates
+    '''
+
+    decal_sizes = decal_sizes or {}
+    scale = 1.0 / map_file.UNITS_PER_VERTEX
+    (ox, oy) = (map_file.crop_x1, map_file.crop_y1)
+    layers = {}
+
+    def add(material, kind, columns):
+        if len(columns[0]):
+            layers.setdefault(material, []).append((kind, columns))
+
+    if roads:
+        samples = sample_roads(map_file.roads)
+        road_ids = samples["road"]
+
+        for material in sorted(set(road.material for road in map_file.roads)):
+            selected = [i for i, road in enumerate(map_file.roads) if road.material == material]
+
+            if np is not None:
+                keep = np.isin(road_ids, selected)
+                s = {name: values[keep] for name, values in samples.items()}
+                # a quad between each sample and the next one of the same road
+                first = np.flatnonzero(s["road"][1:] == s["road"][:-1])
+                ends = (first, first + 1)
+            else:
+                rows = [i for i, road in enumerate(road_ids) if road in selected]
+                s = {name: [values[i] for i in rows] for name, values in samples.items()}
+                first = [i for i in range(len(rows) - 1) if s["road"][i] == s["road"][i + 1]]
+                ends = (first, [i + 1 for i in first])
+
+            corners = []
+            for end in ends:
+                for (name, side) in (("r1", 1), ("r2", -1)):
+                    if np is not None:
+                        corners.append(((s["x"][end] + (s["nx"][end] * s[name][end] * side)) * scale) - ox)
+                        corners.append(((s["y"][end] + (s["ny"][end] * s[name][end] * side)) * scale) - oy)
+                    else:
+                        corners.append([((s["x"][i] + (s["nx"][i] * s[name][i] * side)) * scale) - ox for i in end])
+                        corners.append([((s["y"][i] + (s["ny"][i] * s[name][i] * side)) * scale) - oy for i in end])
+
+            # (L0, R0, L1, R1)
+            add(material, "quad", tuple(corners))
+
+        for material in sorted(set(jcn.material for jcn in map_file.junctions)):
+            selected = [jcn for jcn in map_file.junctions if jcn.material == material]
+            add(material, "disc", _columns([((float(jcn.x) * scale) - ox, (float(jcn.y) * scale) - oy,
+                                              max(float(jcn.r1), float(jcn.r2)) * scale) for jcn in selected]))
+
+    if decals:
+        table = map_file.decals
+        materials = table.strings("material")
+        (xs, zs, rotations) = (table.column("x"), table.column("z"), table.column("r"))
+
+        for material in sorted(set(materials)):
+            (width, height) = decal_sizes.get(material, DECAL_SIZE)
+            rects = []
+            for i, name in enumerate(materials):
+                if name != material:
+                    continue
+                (half_x, half_y) = (width * scale / 2, height * scale / 2)
+                if (int(rotations[i]) // 90) % 2:
+                    (half_x, half_y) = (half_y, half_x)
+                rects.append(((float(xs[i]) * scale) - ox, (float(zs[i]) * scale) - oy, half_x, half_y))
+            add(material, "rect", _columns(rects))
+
+    return layers
+
+
+def _columns(rows: list):
+    columns = tuple(zip(*rows))
+    if np is not None:
+        return tuple(np.array(column, dtype=np.float64) for column in columns)
+    return tuple(list(column) for column in columns)
+
+
+def _bounds(kind: str, shapes: tuple):
+    # (x1, x2, y1, y2) of each shape, a vertex wider for the antialiasing
+    if kind == "quad":
+        (xs, ys) = (shapes[0::2], shapes[1::2])
+        if np is not None:
+            return (np.min(xs, axis=0) - 1, np.max(xs, axis=0) + 1, np.min(ys, axis=0) - 1, np.max(ys, axis=0) + 1)
+        return ([min(x) - 1 for x in zip(*xs)], [max(x) + 1 for x in zip(*xs)],
+                [min(y) - 1 for y in zip(*ys)], [max(y) + 1 for y in zip(*ys)])
+
+    (cx, cy) = shapes[:2]
+    (rx, ry) = (shapes[2], shapes[2]) if kind == "disc" else shapes[2:4]
+    if np is not None:
+        return (cx - rx - 1, cx + rx + 1, cy - ry - 1, cy + ry + 1)
+    return tuple([c + (sign * (r + 1)) for (c, r) in zip(centre, radius)]
+                 for (centre, radius, sign) in ((cx, rx, -1), (cx, rx, 1), (cy, ry, -1), (cy, ry, 1)))
+
+
+def coverage(kind: str, shape: tuple, px, py, clamp):
+    '''
+    How much of the vertex at (px, py) a shape covers, 0..1
+
+    Works on floats and on numpy arrays (one shape per vertex), clamp is the
+    matching clip to 0..1
+    '''
+
+    if kind == "disc":
+        (cx, cy, radius) = shape
+        return clamp(0.5 + radius - ((((px - cx) ** 2) + ((py - cy) ** 2)) ** 0.5))
+
+    if kind == "rect":
+        (cx, cy, half_x, half_y) = shape
+        return clamp(0.5 + half_x - abs(px - cx)) * clamp(0.5 + half_y - abs(py - cy))
+
+    (l0x, l0y, r0x, r0y, l1x, l1y, r1x, r1y) = shape
+
+    def cross(ax, ay, bx, by):
+        return (ax * by) - (ay * bx)
+
+    def length(x, y):
+        return (((x * x) + (y * y)) ** 0.5) + 1e-9
+
+    # the ends of the quad are hard edges so the quads of a road join up
+    # without seams, the left and right edges are antialiased
+    start = -cross(l0x - r0x, l0y - r0y, px - r0x, py - r0y) >= 0
+    end = cross(l1x - r1x, l1y - r1y, px - r1x, py - r1y) >= 0
+
+    left = -cross(l1x - l0x, l1y - l0y, px - l0x, py - l0y) / length(l1x - l0x, l1y - l0y)
+    right = cross(r1x - r0x, r1y - r0y, px - r0x, py - r0y) / length(r1x - r0x, r1y - r0y)
+
+    return clamp(0.5 + left) * clamp(0.5 + right) * (start & end)
+
+
+def rasterize_tile(layers: dict, planes: dict, x0: int, x1: int, y0: int, y1: int):
+    '''
+    Rasterize the shapes touching the tile x0 <= x < x1, y0 <= y < y1 into
+    the float32 coverage planes (numpy only), keeping the highest coverage
+    '''
+
+    for (material, groups) in layers.items():
+        window = planes[material][y0:y1, x0:x1]
+
+        for (kind, shapes, bounds) in groups:
+            (bx1, bx2, by1, by2) = bounds
+            touching = np.flatnonzero((bx2 >= x0) & (bx1 < x1) & (by2 >= y0) & (by1 < y1))
+            if len(touching) == 0:
+                continue
+
+            # every vertex inside the bounds of every shape, clipped to the tile
+            sx1 = np.maximum(np.ceil(bx1[touching]), x0).astype(np.int64)
+            sx2 = np.minimum(np.floor(bx2[touching]), x1 - 1).astype(np.int64)
+            sy1 = np.maximum(np.ceil(by1[touching]), y0).astype(np.int64)
+            sy2 = np.minimum(np.floor(by2[touching]), y1 - 1).astype(np.int64)
+            widths = np.maximum(sx2 - sx1 + 1, 0)
+            counts = widths * np.maximum(sy2 - sy1 + 1, 0)
+
+            owner = np.repeat(np.arange(len(touching)), counts)
+            if len(owner) == 0:
+                continue
+            offset = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+            px = sx1[owner] + (offset % widths[owner])
+            py = sy1[owner] + (offset // widths[owner])
+
+            shape = tuple(column[touching][owner] for column in shapes)
+            values = coverage(kind, shape, px.astype(np.float64), py.astype(np.float64), lambda v: np.clip(v, 0.0, 1.0))
+
+            np.maximum.at(window, (py - y0, px - x0), values.astype(np.float32))
+
+
+def bake_coverage(map_file, roads: bool = True, decals: bool = True, decal_sizes: dict = None,
+                  tile_size: int = TILE_SIZE, workers: int = None):
+    '''
+    (material, coverage) for every road, junction and decal material, the
+    coverage as a (size_y, size_x) uint8 plane (a list of bytearray rows
+    without numpy)
+    '''
+
+    layers = overlay_shapes(map_file, roads, decals, decal_sizes)
+    (size_x, size_y) = (map_file.size_x, map_file.size_y)
+
+    if np is None:
+        return [(material, _bake_layer(groups, size_x, size_y)) for (material, groups) in layers.items()]
+
+    layers = {material: [(kind, shapes, _bounds(kind, shapes)) for (kind, shapes) in groups]
+              for (material, groups) in layers.items()}
+    planes = {material: np.zeros((size_y, size_x), dtype=np.float32) for material in layers}
+
+    tiles = [(x, min(x + tile_size, size_x), y, min(y + tile_size, size_y))
+             for y in range(0, size_y, tile_size) for x in range(0, size_x, tile_size)]
+
+    # tiles write to their own part of the planes only
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(lambda tile: rasterize_tile(layers, planes, *tile), tiles))
+
+    return [(material, np.rint(plane * 255).astype(np.uint8)) for (material, plane) in planes.items()]
+
+
+def _bake_layer(groups: list, size_x: int, size_y: int):
+    plane = [[0.0] * size_x for y in range(size_y)]
+
+    def clamp(value):
+        return min(max(value, 0.0), 1.0)
+
+    for (kind, shapes) in groups:
+        bounds = _bounds(kind, shapes)
+
+        for i, shape in enumerate(zip(*shapes)):
+            x_range = range(max(0, math.ceil(bounds[0][i])), min(size_x - 1, math.floor(bounds[1][i])) + 1)
+            y_range = range(max(0, math.ceil(bounds[2][i])), min(size_y - 1, math.floor(bounds[3][i])) + 1)
+
+            for y in y_range:
+                row = plane[y]
+                for x in x_range:
+                    row[x] = max(row[x], coverage(kind, shape, float(x), float(y), clamp))
+
+    # as numpy's rint, halves to even
+    return [bytearray(int(round(value * 255)) for value in row) for row in plane]
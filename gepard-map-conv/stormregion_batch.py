@@ -0,0 +1,207 @@
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+'''
+Batch conversion of whole folders of maps
+
+Every map is converted by convert_map() in a worker process into its own
+folder under the output folder (named after the map), with the console
+output of the conversion kept in convert.log next to the exports. A map
+that fails is reported in the summary at the end, the others carry on.
+
+Usage: python stormregion_batch.py <folders/maps/globs...> [-o output] [-j workers]
+'''
+
+MAP_EXTENSION    = ".map"
+LOG_FILENAME     = "convert.log"
+PROFILE_FILENAME = "profile.json"
+
+
+def find_maps(sources: list):
+    '''
+    Map files from a list of files, folders (searched recursively) and globs,
+    sorted and without duplicates
+    '''
+
+    found = set()
+
+    for source in sources:
+        if os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                found.update(os.path.join(root, name) for name in files
+                             if name.lower().endswith(MAP_EXTENSION))
+
+        elif os.path.isfile(source):
+            found.add(source)
+
+        else:
+            found.update(path for path in glob.glob(source, recursive=True) if os.path.isfile(path))
+
+    return sorted(found)
+
+
+def output_dir_for(path: str, output_root: str, used: set):
+    '''
+    Folder for the exports of one map, maps with the same name
+    (eg. from different games) get a numbered suffix
+    '''
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    output_dir = os.path.join(output_root, name)
+
+    suffix = 2
+    while output_dir in used:
+        output_dir = os.path.join(output_root, f"{name}_{suffix}")
+        suffix += 1
+
+    used.add(output_dir)
+    return output_dir
+
+
+def convert_one(path: str, output_dir: str, options: dict, profile: bool = False):
+    '''
+    Runs in the worker, never raises so one bad map can't take the batch down
+    '''
+
+    # imported here so the workers don't depend on how the parent was started
+    from stormregion_native import convert_map
+    from stormregion_profile import profiler
+
+    if profile:
+        # workers are reused, start every map from zero
+        profiler.enable()
+        profiler.reset()
+
+    start = time.perf_counter()
+    result = {"file": path, "output": output_dir, "ok": False, "error": None}
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+
+        with open(os.path.join(output_dir, LOG_FILENAME), "w") as log, \
+             contextlib.redirect_stdout(log):
+            try:
+                map_file = convert_map(path, output_dir, **options)
+                result["ok"] = True
+                result["size"] = [map_file.size_x, map_file.size_y]
+
+                if profile:
+                    profiler.save(os.path.join(output_dir, PROFILE_FILENAME), file=path)
+
+            except (Exception, SystemExit) as e:
+                # SystemExit too, it would reach the parent through the pool
+                # and end the whole batch
+                traceback.print_exc(file=log)
+                result["error"] = f"{type(e).__name__}: {e}"
+
+    except OSError as e:
+        # couldn't even create the output folder/log
+        result["error"] = f"{type(e).__name__}: {e}"
+
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(paths: list, output_root: str, workers: int = None, profile: bool = False, **options):
+    '''
+    Convert maps on a process pool, returns one result dict per map
+    in the order they finished
+
+    With profile each map gets a profile.json, see stormregion_profile
+    '''
+
+    used = set()
+    jobs = [(path, output_dir_for(path, output_root, used)) for path in paths]
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_one, path, output_dir, options, profile) for (path, output_dir) in jobs]
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            status = "OK    " if result["ok"] else "FAILED"
+            print(f"[{len(results)}/{len(jobs)}] {status} {result['seconds']:7.2f}s  {result['file']}")
+
+    return results
+
+
+def print_summary(results: list, elapsed: float):
+    failed = [result for result in results if not result["ok"]]
+
+    print()
+    print(f"{'seconds':>8}  map")
+    for result in sorted(results, key=lambda result: result["seconds"], reverse=True):
+        print(f"{result['seconds']:8.2f}  {result['file']}" + ("" if result["ok"] else "  (FAILED)"))
+
+    print()
+    print(f"Converted {len(results) - len(failed)} of {len(results)} maps in {elapsed:.2f}s "
+          f"({sum(result['seconds'] for result in results):.2f}s of work)")
+
+    for result in failed:
+        print(f"FAILED {result['file']}: {result['error']} (see {os.path.join(result['output'], LOG_FILENAME)})")
+
+
+def parse_crop(value: str):
+    crop = tuple(int(v) for v in value.split(","))
+    if len(crop) != 4:
+        raise argparse.ArgumentTypeError("crop is x1,x2,y1,y2")
+    return crop
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Gepard maps in parallel")
+    parser.add_argument("sources", nargs="+", help="map files, folders or globs")
+    parser.add_argument("-o", "--output", default="output", help="output folder, one sub folder per map")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: one per CPU)")
+    parser.add_argument("--crop", type=parse_crop, default=None, help="crop every map to x1,x2,y1,y2")
+    parser.add_argument("--padding-height", type=float, default=-4, help="height of the padding around the terrain")
+    parser.add_argument("--heightmap", default="raw", help="heightmap formats, comma separated (raw, png, r32)")
+    parser.add_argument("--no-splatmaps", action="store_true", help="skip the splatmaps and texturemap")
+    parser.add_argument("--stream", action="store_true", help="export the terrain in row windows, for maps that don't fit in memory")
+    parser.add_argument("--tile-size", type=int, default=None, help="export a grid of tiles of this many vertices instead (eg. 257)")
+    parser.add_argument("--tile-overlap", type=int, default=1, help="vertices shared by neighbouring tiles")
+    parser.add_argument("--lod-min-size", type=int, default=None, help="also write LOD levels down to this size (eg. 33)")
+    parser.add_argument("--lod-filter", default="decimate", help="how LOD vertices are merged: decimate, min, max, minmax, average")
+    parser.add_argument("--roads", action="store_true", help="also write the roads and junctions as meshes (roads.gltf)")
+    parser.add_argument("--bake", action="store_true", help="bake roads, junctions and decals into the splatmaps as extra layers")
+    parser.add_argument("--instances", action="store_true", help="also write objects/decals as instance buffers per model/material (instances.json)")
+    parser.add_argument("--cache", action="store_true", help="keep parsed maps in a binary cache, later runs skip the parse")
+    parser.add_argument("--cache-dir", default=None, help="folder for the caches (default: next to each map)")
+    parser.add_argument("--profile", action="store_true", help=f"write per chunk/stage timings to {PROFILE_FILENAME} for each map")
+    args = parser.parse_args()
+
+    paths = find_maps(args.sources)
+    if not paths:
+        print("No map files found")
+        sys.exit(1)
+
+    print(f"Converting {len(paths)} maps to {args.output}")
+
+    start = time.perf_counter()
+    results = run_batch(paths, args.output, args.workers, args.profile,
+                        crop=args.crop,
+                        padding_height=args.padding_height,
+                        heightmap_formats=tuple(args.heightmap.split(",")),
+                        splatmaps=not args.no_splatmaps,
+                        stream=args.stream,
+                        tile_size=args.tile_size,
+                        tile_overlap=args.tile_overlap,
+                        lod_min_size=args.lod_min_size,
+                        lod_filter=args.lod_filter,
+                        roads=args.roads,
+                        bake=args.bake,
+                        instances=args.instances,
+                        cache=args.cache,
+                        cache_dir=args.cache_dir)
+
+    print_summary(results, time.perf_counter() - start)
+
+    sys.exit(0 if all(result["ok"] for result in results) else 1)
@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+from PIL import Image
+
+import stormregion_native as native
+from stormregion_cache import load_map
+from stormregion_reader import stormregion_reader
+from stormregion_writer import write_map, write_model
+
+'''
+Benchmarks for the converter, on synthetic files from stormregion_writer
+
+Each stage (parsing, lazy opening, the export steps, model parsing) is run a
+few times per size tier and the median is kept. Results can be saved as a
+baseline and later runs compared against it, anything slower than the
+threshold is flagged and the exit code is 1.
+
+Usage: python stormregion_bench.py [--tiers small,medium] [--save-baseline bench.json]
+                                   [--baseline bench.json] [--threshold 1.25]
+'''
+
+# name -> (map size, layers, doods, roads), (model vertices)
+TIERS = {
+    "small"  : {"map": (129, 4, 100, 5),      "model": 1000},
+    "medium" : {"map": (513, 6, 2000, 40),    "model": 10000},
+    "large"  : {"map": (2049, 8, 20000, 200), "model": 60000},
+}
+
+CORPUS_DIR = "bench_corpus"
+
+
+def make_corpus(tier: str, corpus_dir: str = CORPUS_DIR):
+    '''
+    Write the files of a tier plus a tile texture per layer, returns a dict
+    of name -> path. Files made by an older writer are replaced, so every
+    run (and baseline) measures the same data
+    '''
+
+    (size, layers, doods, roads) = TIERS[tier]["map"]
+    vertices = TIERS[tier]["model"]
+
+    tier_dir = os.path.join(corpus_dir, tier)
+    texture_dir = os.path.join(corpus_dir, "texture")
+    os.makedirs(tier_dir, exist_ok=True)
+    os.makedirs(texture_dir, exist_ok=True)
+
+    files = {
+        "map"        : (f"map_{size}.map",     lambda: write_map(size, layers, doods, roads)),
+        "units_map"  : (f"units_{doods}.map",  lambda: write_map(65, 2, 10, 1, units=doods, stored_units=2)),
+        "model_v100" : (f"mesh_v100.4d",       lambda: write_model(vertices, version="v100")),
+        "model_v101" : (f"mesh_v101.4d",       lambda: write_model(vertices, version="v101")),
+        "model_strp" : (f"mesh_strp.4d",       lambda: write_model(vertices, strip=True)),
+        "model_skvs" : (f"mesh_skvs.4d",       lambda: write_model(vertices, skvs=True)),
+    }
+
+    paths = {}
+    for name, (filename, generate) in files.items():
+        path = os.path.join(tier_dir, filename)
+        data = generate()
+
+        existing = None
+        if os.path.isfile(path) and os.path.getsize(path) == len(data):
+            with open(path, "rb") as fp:
+                existing = fp.read()
+
+        if existing != data:
+            with open(path, "wb") as fp:
+                fp.write(data)
+        paths[name] = path
+
+    for i in range(layers):
+        path = os.path.join(texture_dir, f"tile{i}_1.png")
+        if not os.path.isfile(path):
+            Image.new("RGBA", (256, 256), ((i * 40) % 256, 128, 255 - (i * 40) % 256, 255)).save(path)
+
+    paths["texture"] = texture_dir
+    return paths
+
+
+def parse_file(path: str):
+    with stormregion_reader.open(path) as file:
+        return native.parse_4d_model(path, file)
+
+
+def lazy_header(path: str):
+    with native.open_map(path) as map_file:
+        return map_file.get_header()
+
+
+def lazy_heightmap(path: str):
+    with native.open_map(path) as map_file:
+        return map_file.heightmap
+
+
+def lazy_units(path: str):
+    # only the UNDS chunk is decoded
+    with native.open_map(path) as map_file:
+        return map_file.units
+
+
+def spatial_queries(map_file, count: int = 1000):
+    '''
+    Build the object index and run radius queries spread over the map
+    '''
+
+    index = map_file.spatial_index("objects")
+    for i in range(count):
+        index.radius((i * 37) % map_file.size_x, (i * 61) % map_file.size_y, 16)
+
+
+def map_stages(paths: dict, output_dir: str):
+    '''
+    (stage name, setup, stage) - setup isn't timed and gives the argument for the stage
+    '''
+
+    def parsed():
+        map_file = parse_file(paths["map"])
+        map_file.TEXTURE_PATHS = [paths["texture"]]
+        return map_file
+
+    def prepped():
+        map_file = parsed()
+        map_file.export_prep()
+        return map_file
+
+    def cached():
+        # make sure the cache is there, only the load is timed
+        load_map(paths["map"])
+        return paths["map"]
+
+    def normalised():
+        map_file = prepped()
+        map_file.normalise_splatmap()
+        return map_file
+
+    return [
+        ("parse_map",           lambda: paths["map"],   parse_file),
+        ("load_cache",          cached,                 load_map),
+        ("open_map_header",     lambda: paths["map"],   lazy_header),
+        ("open_map_heightmap",  lambda: paths["map"],   lazy_heightmap),
+        ("parse_units",         lambda: paths["units_map"], lazy_units),
+        ("crop_to",             parsed,                 lambda m: m.crop_to(m.size_x // 4, m.size_x * 3 // 4, m.size_y // 4, m.size_y * 3 // 4)),
+        ("export_heightmap",    parsed,                 lambda m: m.export_heightmap({"raw": os.path.join(output_dir, "heightmap.raw"),
+                                                                                      "png": os.path.join(output_dir, "heightmap.png")})),
+        ("normalise_splatmap",  prepped,                lambda m: m.normalise_splatmap()),
+        ("pack_splatmaps",      normalised,             lambda m: m.pack_splatmaps()),
+        ("create_texturemap",   parsed,                 lambda m: m.create_texturemap(os.path.join(output_dir, "texture.png"), 256, cache_dir=None)),
+        ("export_splatmaps",    parsed,                 lambda m: m.export_splatmaps(output_dir)),
+        ("spatial_queries",     parsed,                 spatial_queries),
+        ("export_lods",         normalised,             lambda m: m.export_lods(output_dir, 17, "minmax")),
+        ("bake_overlays",       parsed,                 lambda m: m.bake_overlays()),
+        ("export_instances",    parsed,                 lambda m: m.export_instances(output_dir)),
+        ("export_roads",        parsed,                 lambda m: m.export_roads(output_dir)),
+    ]
+
+
+def model_stages(paths: dict):
+    return [(f"parse_{name}", (lambda path=path: path), parse_file)
+            for name, path in paths.items() if name.startswith("model_")]
+
+
+def time_stage(setup, stage, repeat: int):
+    times = []
+
+    for i in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        stage(argument)
+        times.append(time.perf_counter() - start)
+
+    return {"median": statistics.median(times), "min": min(times), "repeat": repeat}
+
+
+def run(tiers: list, repeat: int = 5, corpus_dir: str = CORPUS_DIR):
+    results = {}
+
+    for tier in tiers:
+        paths = make_corpus(tier, corpus_dir)
+        output_dir = os.path.join(corpus_dir, tier, "output")
+        os.makedirs(output_dir, exist_ok=True)
+
+        for (name, setup, stage) in map_stages(paths, output_dir) + model_stages(paths):
+            # keep the parse and export summaries (per chunk/entity detail is
+            # already off, see stormregion_trace) out of the results table
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = time_stage(setup, stage, repeat)
+
+            results[f"{tier}/{name}"] = result
+            print(f"{tier:>8} {name:<20} {result['median'] * 1000:10.2f} ms")
+
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float, min_seconds: float = 0.001):
+    '''
+    Print the ratio to the baseline for every stage, returns the regressed ones
+
+    Stages have to be slower by more than min_seconds as well, sub millisecond
+    stages are mostly noise
+    '''
+
+    regressions = []
+
+    print()
+    print(f"{'stage':<30} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]["median"]
+        ratio = result["median"] / before if before > 0 else 1.0
+        flag = ""
+        if ratio > threshold and result["median"] - before > min_seconds:
+            regressions.append(name)
+            flag = "  SLOWER"
+
+        print(f"{name:<30} {before * 1000:9.2f}ms {result['median'] * 1000:9.2f}ms {ratio:7.2f}{flag}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing and export on synthetic files")
+    parser.add_argument("--tiers", default="small,medium", help=f"comma separated, from {list(TIERS)}")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--corpus", default=CORPUS_DIR, help="where the synthetic files are kept")
+    parser.add_argument("--save-baseline", default=None, help="write the results to this file")
+    parser.add_argument("--baseline", default=None, help="compare against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=1.25, help="ratio to the baseline that counts as slower")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="ignore stages slower by less than this")
+    args = parser.parse_args()
+
+    results = run(args.tiers.split(","), args.repeat, args.corpus)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fp:
+            json.dump({"python": platform.python_version(),
+                       "numpy": native.np is not None,
+                       "results": results}, fp, indent=1)
+        print(f"Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as fp:
+            baseline = json.load(fp)
+
+        regressions = compare(results, baseline["results"], args.threshold, args.min_ms / 1000)
+        if regressions:
+            print(f"{len(regressions)} stages slower than {args.threshold}x the baseline")
+            sys.exit(1)
@@ -0,0 +1,419 @@
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import stormregion_native as native
+from stormregion_def import *
+from stormregion_reader import stormregion_reader
+
+'''
+Binary cache of parsed maps
+
+Everything parse_4d_model decodes from a map is written to one file: the
+header fields, the heightmap and blend as raw arrays, the entities as one
+column per field and every string once in a pool. Loading it maps the file,
+the heightmap and blend are views onto the mapping (like a normal parse) and
+the entity tables are filled with straight copies of their columns.
+
+The cache is kept next to the map (<map>.cache) or in a cache folder and
+is only used if it was written from the same source file: the size has to
+match and the source is always hashed and compared with the sha1 stored in
+the cache, a matching mtime alone isn't trusted (tools that rewrite maps in
+place can keep it). A stale or unreadable cache is simply rebuilt.
+
+Usage: python stormregion_cache.py <maps...> [--cache-dir folder]
+'''
+
+CACHE_MAGIC   = b'SRMCACHE'
+CACHE_VERSION = 3
+CACHE_SUFFIX  = ".cache"
+
+# magic, version, source size, source mtime, source sha1, meta length
+CACHE_HEADER  = struct.Struct('<8sIQq20sI')
+ALIGN         = 8
+
+# map attributes that are written as they are (in the JSON meta data)
+FIELDS = ("version", "size_x", "size_y", "campaign", "atmosphere", "skybox",
+          "config", "aircraft_type", "ambient_music")
+
+# map attribute -> columns, for the stormregion_tables of a map (see stormregion_def)
+TABLES = {
+    "objects"        : OBJECT_COLUMNS,
+    "decals"         : DECAL_COLUMNS,
+    "ambient_sounds" : SFX_COLUMNS,
+    "units"          : UNIT_COLUMNS,
+    "unit_fields"    : UNIT_FIELD_COLUMNS,
+}
+
+# map attribute -> (class, columns) for the entities that are still lists of objects,
+# the columns are in the order of the class constructor. Type codes are as for
+# read_array, 's' is an index into the strings
+OBJECT_TABLES = {
+    "locations"      : (stormregion_loc,    (("name", "s"), ("x1", "I"), ("y1", "I"), ("x2", "I"), ("y2", "I"), ("color", "I"))),
+    "junctions"      : (stormregion_jcn,    (("material", "s"), ("config", "I"), ("x", "f"), ("y", "f"), ("r1", "f"), ("r2", "f"), ("r3", "f"))),
+}
+
+ROAD_COLUMNS      = (("material", "s"), ("tesselation", "f"), ("config", "I"))
+
+
+def cache_path_for(path: str, cache_dir: str = None):
+    '''
+    Where the cache of a map is kept, next to it unless there is a cache_dir
+    '''
+
+    if cache_dir is None:
+        return path + CACHE_SUFFIX
+
+    # the full path goes in the name so maps with the same name don't collide
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.basename(path)}.{key}{CACHE_SUFFIX}")
+
+
+def source_hash(file: stormregion_reader):
+    return hashlib.sha1(file.data).digest()
+
+
+class cache_writer:
+    '''
+    Collects the data blocks of a cache file, blocks are aligned so they
+    can be used in place once the file is mapped
+    '''
+
+    def __init__(self, pool: stormregion_string_pool):
+        self.blocks  = []
+        self.length  = 0
+
+        # a copy of the map's pool, so the string columns of its tables can be
+        # written as they are, other strings are added after them
+        self.source  = pool
+        self.strings = stormregion_string_pool(pool.strings)
+
+
+    def add(self, dtype: str, data):
+        '''
+        Add a block of dtype values (bytes, an array.array or a numpy array),
+        returns [dtype, offset, count] for the meta data
+        '''
+
+        if np is not None and isinstance(data, np.ndarray):
+            raw_data = np.ascontiguousarray(data, dtype=f'<{dtype}').tobytes()
+        elif isinstance(data, array):
+            if sys.byteorder != "little":
+                data = array(dtype, data)
+                data.byteswap()
+            raw_data = data.tobytes()
+        else:
+            raw_data = bytes(data)
+
+        offset = self.length
+        padding = -len(raw_data) % ALIGN
+
+        self.blocks.append(raw_data)
+        self.blocks.append(b'\0' * padding)
+        self.length += len(raw_data) + padding
+
+        return [dtype, offset, len(raw_data) // struct.calcsize(dtype)]
+
+
+    def string_id(self, value: str):
+        return self.strings.intern(value)
+
+
+    def add_columns(self, rows: list, columns: tuple):
+        '''
+        One block per column of a list of objects
+        '''
+
+        table = {"count": len(rows)}
+
+        for (name, dtype) in columns:
+            if dtype == "s":
+                values = array('I', [self.string_id(getattr(row, name)) for row in rows])
+                table[name] = self.add('I', values)
+            else:
+                table[name] = self.add(dtype, array(dtype, [getattr(row, name) for row in rows]))
+
+        return table
+
+
+    def add_table(self, table: stormregion_table):
+        '''
+        One block per column of a stormregion_table
+        '''
+
+        entries = {"count": len(table)}
+
+        for (name, dtype) in table.schema:
+            if name in table.string_columns and table.pool is not self.source:
+                entries[name] = self.add('I', array('I', [self.string_id(value) for value in table.strings(name)]))
+            else:
+                entries[name] = self.add('I' if dtype == 's' else dtype, table.columns[name])
+
+        return entries
+
+
+    def add_strings(self):
+        pool = bytearray()
+        offsets = array('I', [0])
+
+        for value in self.strings.strings:
+            pool += value.encode()
+            offsets.append(len(pool))
+
+        return {"offsets": self.add('I', offsets), "pool": self.add('B', pool)}
+
+
+def save_cache(map_file, cache_path: str, source_size: int, source_mtime_ns: int, sha1: bytes):
+    '''
+    Write a parsed (not cropped) map to cache_path
+    '''
+
+    writer = cache_writer(map_file.strings)
+
+    if np is not None:
+        heightmap = writer.add('f', np.asarray(map_file.heightmap, dtype=np.float32))
+        blend = writer.add('B', np.asarray(map_file.blend, dtype=np.uint8))
+    else:
+        heightmap = writer.add('f', array('f', [value for row in map_file.heightmap for value in row]))
+        blend = writer.add('B', b''.join(bytes(row) for plane in map_file.blend for row in plane))
+
+    tables = {name: writer.add_table(getattr(map_file, name)) for name in TABLES}
+    tables.update({name: writer.add_columns(getattr(map_file, name), columns)
+                   for name, (cls, columns) in OBJECT_TABLES.items()})
+
+    # the nodes of all the roads one after the other
+    nodes = stormregion_table(ROAD_NODE_COLUMNS)
+    for road in map_file.roads:
+        for name, column in nodes.columns.items():
+            column.extend(road.nodes.columns[name])
+
+    roads = writer.add_columns(map_file.roads, ROAD_COLUMNS)
+    roads["nodes"] = writer.add_table(nodes)
+    roads["node_counts"] = writer.add('I', array('I', [len(road.nodes) for road in map_file.roads]))
+
+    paths = {
+        "count"       : len(map_file.paths),
+        "name"        : writer.add('I', array('I', [writer.string_id(path.name) for path in map_file.paths])),
+        "nodes"       : writer.add('f', array('f', [value for path in map_file.paths for node in path.nodes for value in node])),
+        "node_counts" : writer.add('I', array('I', [len(path.nodes) for path in map_file.paths])),
+    }
+
+    tlayers = {
+        "count"      : len(map_file.tlayers),
+        "material"   : writer.add('I', array('I', [writer.string_id(layer['material']) for layer in map_file.tlayers])),
+        "properties" : writer.add('I', array('I', [layer['properties'] for layer in map_file.tlayers])),
+    }
+
+    tvars = list(map_file.tvars.values())
+    tvars = {
+        "count"         : len(tvars),
+        "name"          : writer.add('I', array('I', [writer.string_id(tvar.name) for tvar in tvars])),
+        "initial_value" : writer.add('I', array('I', [tvar.initial_value for tvar in tvars])),
+        "increment"     : writer.add('I', array('I', [tvar.increment for tvar in tvars])),
+    }
+
+    meta = {
+        "fields"     : {name: getattr(map_file, name) for name in FIELDS},
+        "heightmap"  : heightmap,
+        "blend"      : blend,
+        "blend_mask" : writer.add('B', bytes(bool(textured) for textured in map_file.blend_mask)),
+        "tlayers"    : tlayers,
+        "tables"     : tables,
+        "roads"      : roads,
+        "paths"      : paths,
+        "tvars"      : tvars,
+        "strings"    : writer.add_strings(),
+    }
+
+    raw_meta = json.dumps(meta, separators=(',', ':')).encode()
+    raw_meta += b' ' * (-(CACHE_HEADER.size + len(raw_meta)) % ALIGN)
+
+    # written under another name first, so a reader never sees half a cache
+    folder = os.path.dirname(cache_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as fp:
+        fp.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, source_size, source_mtime_ns, sha1, len(raw_meta)))
+        fp.write(raw_meta)
+        for raw_data in writer.blocks:
+            fp.write(raw_data)
+
+    os.replace(temp_path, cache_path)
+
+
+def read_cache_header(file: stormregion_reader):
+    '''
+    (source size, source mtime, source sha1, meta length), or None if
+    this isn't a cache file of the current version
+    '''
+
+    if len(file) < CACHE_HEADER.size:
+        return None
+
+    (magic, version, size, mtime_ns, sha1, meta_length) = file.read_struct(CACHE_HEADER)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+
+    return (size, mtime_ns, sha1, meta_length)
+
+
+def load_cache(file: stormregion_reader, meta_length: int):
+    '''
+    Rebuild a stormregion_map from an open cache file (after its header)
+    '''
+
+    meta = json.loads(bytes(file.read(meta_length)))
+    data_start = CACHE_HEADER.size + meta_length
+
+    def block(entry):
+        (dtype, offset, count) = entry
+        file.seek(data_start + offset)
+        return file.read_array(dtype, count)
+
+    def column(entry):
+        return block(entry).tolist()
+
+    def fill(table, entries):
+        # straight copies of the column blocks
+        for name, values in table.columns.items():
+            data = block(entries[name])
+            if np is not None:
+                values.frombytes(np.ascontiguousarray(data, dtype=values.typecode).tobytes())
+            else:
+                values.frombytes(data.tobytes())
+        return table
+
+    offsets = column(meta["strings"]["offsets"])
+    pool = bytes(block(meta["strings"]["pool"]))
+    strings = [pool[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+    def table(entries, columns):
+        values = [[strings[i] for i in column(entries[name])] if dtype == "s" else column(entries[name])
+                  for (name, dtype) in columns]
+        return list(zip(*values)) if values else []
+
+    map_file = native.stormregion_map()
+    for name, value in meta["fields"].items():
+        setattr(map_file, name, value)
+
+    map_file.strings = stormregion_string_pool(strings)
+
+    map_file.heightmap = native.decode_heightmap(block(meta["heightmap"]), map_file.size_x, map_file.size_y)
+
+    map_file.blend_mask = [bool(textured) for textured in column(meta["blend_mask"])]
+    map_file.blend = native.decode_blend(block(meta["blend"]), len(map_file.blend_mask), map_file.size_x, map_file.size_y)
+
+    map_file.tlayers = [{"material": strings[material], "properties": properties}
+                        for (material, properties) in zip(column(meta["tlayers"]["material"]),
+                                                          column(meta["tlayers"]["properties"]))]
+
+    for name, columns in TABLES.items():
+        setattr(map_file, name, fill(stormregion_table(columns, map_file.strings), meta["tables"][name]))
+
+    for name, (cls, columns) in OBJECT_TABLES.items():
+        setattr(map_file, name, [cls(*row) for row in table(meta["tables"][name], columns)])
+
+    roads = meta["roads"]
+    nodes = fill(stormregion_table(ROAD_NODE_COLUMNS), roads["nodes"])
+    start = 0
+    for (row, node_count) in zip(table(roads, ROAD_COLUMNS), column(roads["node_counts"])):
+        road = stormregion_road(*row)
+        for name, values in road.nodes.columns.items():
+            values.extend(nodes.columns[name][start:start + node_count])
+        map_file.roads.append(road)
+        start += node_count
+
+    paths = meta["paths"]
+    values = column(paths["nodes"])
+    start = 0
+    for (name, node_count) in zip(column(paths["name"]), column(paths["node_counts"])):
+        nodes = [(values[i], values[i + 1]) for i in range(start, start + (node_count * 2), 2)]
+        map_file.paths.append(stormregion_path(strings[name], nodes))
+        start += node_count * 2
+
+    tvars = meta["tvars"]
+    for (name, initial_value, increment) in zip(column(tvars["name"]), column(tvars["initial_value"]), column(tvars["increment"])):
+        map_file.tvars[strings[name]] = stormregion_tvar(strings[name], initial_value, increment)
+
+    return map_file
+
+
+def load_map(path: str, cache_dir: str = None, save: bool = True):
+    '''
+    Parse a map, or load it from its cache if that was made from the same file
+
+    With save a missing or stale cache is (re)written after the parse, failures
+    to write it (read only folders etc) are ignored. Returns the map, raises an
+    IOError if the file isn't a map
+    '''
+
+    cache_path = cache_path_for(path, cache_dir)
+    stat = os.stat(path)
+
+    with stormregion_reader.open(path) as file:
+        sha1 = None
+
+        try:
+            with stormregion_reader.open(cache_path) as cache:
+                header = read_cache_header(cache)
+
+                if header is not None:
+                    (size, mtime_ns, cached_sha1, meta_length) = header
+
+                    # touched or copied files still match if the contents are the same
+                    if size == stat.st_size:
+                        sha1 = source_hash(file)
+
+                    if sha1 is not None and sha1 == cached_sha1:
+                        map_file = load_cache(cache, meta_length)
+                        map_file.map_name = os.path.splitext(os.path.basename(path))[0]
+                        print(f"Loaded {path} from cache {cache_path}")
+                        return map_file
+
+        except (OSError, ValueError, KeyError, IndexError, struct.error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print(f"WARNING: ignoring unreadable cache {cache_path}: {e}")
+
+        map_file = native.parse_4d_model(path, file)
+        if map_file is None:
+            raise IOError(f"{path} is not a map file")
+
+        if save:
+            try:
+                save_cache(map_file, cache_path, stat.st_size, stat.st_mtime_ns, sha1 or source_hash(file))
+                print(f"Wrote cache {cache_path}")
+            except OSError as e:
+                print(f"WARNING: could not save map cache {cache_path}: {e}")
+
+    return map_file
+
+
+if __name__ == "__main__":
+    cache_dir = None
+    paths = sys.argv[1:]
+
+    if "--cache-dir" in paths:
+        i = paths.index("--cache-dir")
+        cache_dir = paths[i + 1]
+        del paths[i:i + 2]
+
+    if not paths:
+        print("Usage: python stormregion_cache.py <maps...> [--cache-dir folder]")
+        sys.exit(1)
+
+    for path in paths:
+        start = time.perf_counter()
+        map_file = load_map(path, cache_dir)
+        print(f"{path}: {map_file.size_x} x {map_file.size_y}, {len(map_file.objects)} objects, "
+              f"{time.perf_counter() - start:.3f}s")
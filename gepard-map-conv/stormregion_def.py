@@ -4,6 +4,13 @@ import math
 import sys
 from PIL import Image
 from enum import Enum
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, table columns are plain arrays instead
+    np = None
 
 sr_trigger_action = Enum('sr_trigger_action', ['attack_ground'
                                                'attack_move_ai_group',
@@ -128,7 +135,9 @@ sr_trigger_condition = Enum('sr_trigger_condition', ['always',
                                                      'type_of_trigger_unit_2'])
 
 class stormregion_loc:
-    name: str = ""
+    __slots__ = ("name", "x1", "y1", "x2", "y2", "color")
+
+    name: str
     x1 : float
     y1 : float
     x2 : float
@@ -146,7 +155,9 @@ class stormregion_loc:
 
 
 class stormregion_tvar:
-    name: str = ""
+    __slots__ = ("name", "initial_value", "increment", "state")
+
+    name: str
     initial_value : int
     increment : int
     state: int
@@ -159,36 +170,53 @@ class stormregion_tvar:
 
 
 class stormregion_map_unit_def:
-    classname: str = ""
-    player: int = 0
-    xp: int = 0
+    __slots__ = ("classname", "player", "xp", "x", "z", "y", "dir", "hp", "ammo", "script_id",
+                 "ai_group", "armor", "behaviour", "global_active", "slot_0", "slot_1",
+                 "stored_units", "cargo", "firstkill", "firstblood", "firstshot",
+                 "firstvehiclelost", "firstarmouredvehiclekill", "towed_units", "stored_special")
+
+    classname: str
+    player: int
+    xp: int
     x : float
     z : float
     y : float       # off ground
     dir : float     # radians...?
     hp  : float     # 0 - 1 (%)
     ammo: float
-    script_id : str = ""
+    script_id : str
     ai_group : int
-    armor : list = [ 0, 0, 0, 0]    # F, L, R, Back
+    armor : list    # F, L, R, Back
     behaviour: float
     global_active : int
     slot_0 : int
     slot_1 : int
-    stored_units : list = []
+    stored_units : list
     cargo : float
     firstkill : bool
     firstblood : bool
     firstshot : bool
     firstvehiclelost : bool
     firstarmouredvehiclekill : bool
-    towed_units  = None
+    towed_units : list
     stored_special : int
 
+    def __init__(self):
+        # lists are per unit, not shared by every unit
+        self.classname = ""
+        self.player = 0
+        self.xp = 0
+        self.script_id = ""
+        self.armor = [0, 0, 0, 0]
+        self.stored_units = []
+        self.towed_units = None
+
 
 class stormregion_path:
-    name = ""
-    nodes = []      # list of xy tuples
+    __slots__ = ("name", "nodes")
+
+    name: str
+    nodes: list     # list of xy tuples
 
     def __init__(self, _name, _nodes):
         self.name = _name
@@ -196,7 +224,9 @@ class stormregion_path:
 
 
 class stormregion_sfx:
-    sound = ""
+    __slots__ = ("sound", "x", "y", "z", "v", "index")
+
+    sound: str
     x : float
     y : float
     z : float
@@ -213,6 +243,8 @@ class stormregion_sfx:
 
 
 class stormregion_road_node:
+    __slots__ = ("x", "y", "r1", "r2", "r3", "alpha_l", "alpha_r", "interp", "jcn_id")
+
     x : float
     y : float
     r1 : float
@@ -236,25 +268,29 @@ class stormregion_road_node:
 
 
 class stormregion_road:
+    __slots__ = ("material", "tesselation", "config", "nodes")
+
     U_MIRROR = 0x20
     V_MIRROR = 0x40
 
     material: str
     tesselation: float
     config: int
-    nodes : list
+    nodes : "stormregion_table"     # ROAD_NODE_COLUMNS
 
     def __init__(self, _mat, _tes, _cfg):
         self.material = _mat
         self.tesselation = _tes
         self.config = _cfg
-        self.nodes = []
+        self.nodes = stormregion_table(ROAD_NODE_COLUMNS)
 
     def add_node(self, node: stormregion_road_node):
         self.nodes.append(node)
 
 
 class stormregion_jcn:
+    __slots__ = ("material", "config", "x", "y", "r1", "r2", "r3")
+
     U_MIRROR = 0x20
     V_MIRROR = 0x40
 
@@ -277,7 +313,9 @@ class stormregion_jcn:
 
 
 class stormregion_decal:
-    material = ""
+    __slots__ = ("material", "x", "z", "r")
+
+    material: str
     x : float
     z : float
     r : int     # degrees
@@ -290,7 +328,9 @@ class stormregion_decal:
 
 
 class stormregion_object:
-    model_file = ""
+    __slots__ = ("model_file", "x", "y", "z", "r", "index")
+
+    model_file: str
     x : float
     y : float
     z : float
@@ -304,3 +344,187 @@ class stormregion_object:
         self.z = _z
         self.r = _r
         self.index = _index
+
+
+# Columns of the entity tables, in the order of the class constructors
+# type codes are as for array.array, 's' is a string kept in the string pool
+
+OBJECT_COLUMNS    = (("model_file", "s"), ("x", "f"), ("y", "f"), ("z", "f"), ("r", "f"), ("index", "I"))
+DECAL_COLUMNS     = (("material", "s"), ("x", "I"), ("z", "I"), ("r", "I"))
+SFX_COLUMNS       = (("sound", "s"), ("x", "f"), ("y", "f"), ("z", "f"), ("v", "f"), ("index", "I"))
+ROAD_NODE_COLUMNS = (("x", "f"), ("y", "f"), ("r1", "f"), ("r2", "f"), ("r3", "f"),
+                     ("alpha_l", "f"), ("alpha_r", "f"), ("interp", "f"), ("jcn_id", "I"))
+
+# units and the units they carry (parent is the row of the carrying unit, -1 for
+# units on the map), every UNTD field of every unit is kept in the unit fields
+# table as well: value/value2 for numbers and positions, text for strings
+UNIT_COLUMNS       = (("classname", "s"), ("player", "i"), ("xp", "f"), ("x", "f"), ("y", "f"),
+                      ("parent", "i"), ("depth", "I"))
+UNIT_FIELD_COLUMNS = (("unit", "I"), ("name", "s"), ("type", "I"), ("value", "d"), ("value2", "d"), ("text", "s"))
+
+
+class stormregion_string_pool:
+    '''
+    Every distinct string once, the tables keep the index instead of the string
+    '''
+
+    __slots__ = ("strings", "ids")
+
+    def __init__(self, strings = ()):
+        self.strings = []
+        self.ids     = {}
+
+        for value in strings:
+            self.intern(value)
+
+    def intern(self, value: str):
+        index = self.ids.get(value)
+        if index is None:
+            index = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return index
+
+    def __getitem__(self, index: int):
+        return self.strings[index]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class stormregion_row:
+    '''
+    One row of a stormregion_table, looks like the entity object (obj.x,
+    obj.model_file...) but reads and writes straight to the columns
+    '''
+
+    __slots__ = ("_table", "_row")
+
+    def __init__(self, table, row: int):
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_row", row)
+
+    def __getattr__(self, name):
+        table = object.__getattribute__(self, "_table")
+        column = table.columns.get(name)
+        if column is None:
+            raise AttributeError(f"No {name} column")
+
+        value = column[self._row]
+        return table.pool[value] if name in table.string_columns else value
+
+    def __setattr__(self, name, value):
+        self._table.set(self._row, name, value)
+
+    def __repr__(self):
+        return "row(" + ", ".join(f"{name}={getattr(self, name)!r}" for (name, dtype) in self._table.schema) + ")"
+
+
+class stormregion_table:
+    '''
+    Entities of one kind (objects, decals, sounds, road nodes) as one typed
+    array per field instead of one object each, strings are indexes into a
+    string pool shared by the tables of a map
+
+    Works like a list of the entity objects (len, iteration, table[i] give
+    stormregion_row views), column() gives a whole field at once for
+    vectorized work and select() keeps a subset of the rows
+    '''
+
+    __slots__ = ("schema", "pool", "columns", "string_columns", "_column_list")
+
+    def __init__(self, schema: tuple, pool: stormregion_string_pool = None):
+        self.schema = schema
+        self.pool   = pool if pool is not None else stormregion_string_pool()
+
+        self.columns = {name: array('I' if dtype == 's' else dtype) for (name, dtype) in schema}
+        self.string_columns = frozenset(name for (name, dtype) in schema if dtype == 's')
+        self._column_list = [(self.columns[name], dtype == 's') for (name, dtype) in schema]
+
+
+    def append_values(self, *values):
+        '''
+        Add a row, values in the order of the schema
+        '''
+
+        for ((column, is_string), value) in zip(self._column_list, values):
+            column.append(self.pool.intern(value) if is_string else value)
+
+    def append(self, row):
+        '''
+        Add an entity object (or a row of another table)
+        '''
+
+        self.append_values(*[getattr(row, name) for (name, dtype) in self.schema])
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+
+    def set(self, row: int, name: str, value):
+        self.columns[name][row] = self.pool.intern(value) if name in self.string_columns else value
+
+
+    def __len__(self):
+        return len(self._column_list[0][0]) if self._column_list else 0
+
+    def __getitem__(self, row: int):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError("Table row out of range")
+        return stormregion_row(self, row)
+
+    def __iter__(self):
+        return (stormregion_row(self, row) for row in range(len(self)))
+
+    def __bool__(self):
+        return len(self) > 0
+
+
+    def column(self, name: str):
+        '''
+        All the values of a field, a numpy array (a copy, so the table can still
+        grow) or the array.array itself without numpy. String columns are pool indexes
+        '''
+
+        column = self.columns[name]
+        if np is not None:
+            return np.frombuffer(column, dtype=column.typecode).copy() if len(column) else np.zeros(0, dtype=column.typecode)
+        return column
+
+    def strings(self, name: str):
+        '''
+        A string field as a list of strings
+        '''
+
+        strings = self.pool.strings
+        return [strings[index] for index in self.columns[name]]
+
+
+    def select(self, rows):
+        '''
+        New table (same string pool) with only some rows, rows is a boolean mask
+        or a list of row numbers (numpy arrays of either work too)
+        '''
+
+        table = stormregion_table(self.schema, self.pool)
+
+        if np is not None:
+            rows = np.asarray(rows)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+
+            for name, column in self.columns.items():
+                if len(rows):
+                    table.columns[name].frombytes(np.frombuffer(column, dtype=column.typecode)[rows].tobytes())
+            return table
+
+        rows = list(rows)
+        if rows and isinstance(rows[0], bool):
+            rows = [row for row, keep in enumerate(rows) if keep]
+
+        for name, column in self.columns.items():
+            table.columns[name].extend(column[row] for row in rows)
+
+        return table
@@ -0,0 +1,236 @@
+import json
+import os
+import sys
+from collections import namedtuple
+
+from stormregion_reader import stormregion_reader
+
+'''
+Table of contents for Gepard files
+
+One pass over the kind/size chunk tree records where every chunk starts, so
+a single section (HMAP, ROD5, DODS...) can be read without decoding anything
+in front of it. The table can be kept next to the file as a small JSON
+sidecar, it's rebuilt automatically when the file size or mtime changes.
+
+Usage: python stormregion_index.py <file.map|file.4d> [--save]
+'''
+
+INDEX_VERSION = 1
+INDEX_SUFFIX  = ".idx"
+MAGIC         = b'\x53\x72\x1A\x1B\x0D\x0A\x87\x0A'
+
+
+# (path, kind, offset, size) - offset is the start of the payload (after the
+# kind and size fields), path is the kinds from the root joined with '/'
+chunk_entry = namedtuple('chunk_entry', ['path', 'kind', 'offset', 'size'])
+
+
+def _object_header(file, version):
+    # name, parent ID, (2 unknown ints on v101), rotation matrix, location
+    length = 2 + file.read_ushort() + 4 + 48
+    if version == "v101":
+        length += 8
+    return length
+
+def _node_header(file, version):
+    # as above, plus 7 unknown floats
+    return _object_header(file, version) + 28
+
+
+# Chunks that contain more chunks, with the number of bytes of their own
+# data that come before the first child (or a function to work it out).
+# Anything else is a leaf, DODS and AMBS look like containers but aren't.
+CONTAINERS = {
+    'SCEN' : 4,     # version
+    'MAPF' : 4,     # version
+    'CANM' : 16,    # version + 3 floats
+    'TERR' : 4,     # version
+    'ENTS' : 4,     # version
+    'DECS' : 4,     # count
+    'UNDS' : 0,
+    'MESH' : _object_header,
+    'SKVS' : _object_header,
+    'BSP_' : _object_header,
+    'NODE' : _node_header,
+    'MTLS' : 4,     # count
+    'MATE' : 12,    # faces, vertex start, vertex end
+    'STRP' : 12,
+}
+
+
+def _is_kind(raw_data):
+    return len(raw_data) == 4 and all(0x20 < c < 0x7f for c in raw_data)
+
+
+def _scan(file, limit, prefix, entries, version):
+    while file.tell() + 8 <= limit:
+        start = file.tell()
+        raw_kind = file.read(4)
+        size = file.read_uint()
+        offset = file.tell()
+
+        if not _is_kind(raw_kind) or offset + size > limit:
+            # not a chunk after all (or truncated), nothing more to find at this level
+            print(f"WARNING: stopped indexing {prefix or '/'} at {hex(start)}")
+            return
+
+        kind = raw_kind.decode()
+        path = f"{prefix}/{kind}" if prefix else kind
+        entries.append(chunk_entry(path, kind, offset, size))
+
+        header = CONTAINERS.get(kind)
+        if header is not None:
+            if kind in ('SCEN', 'CANM'):
+                version = file.read(4).decode("utf-8", "replace")
+
+            if callable(header):
+                file.seek(offset)
+                header = header(file, version)
+
+            file.seek(offset + header)
+            _scan(file, offset + size, path, entries, version)
+
+        file.seek(offset + size)
+
+
+class chunk_index:
+    '''
+    Every chunk in a file, in file order
+    '''
+
+    def __init__(self, entries: list, file_size: int = 0, mtime_ns: int = 0):
+        self.entries   = entries
+        self.file_size = file_size
+        self.mtime_ns  = mtime_ns
+
+        self.by_path = {}
+        for entry in entries:
+            self.by_path.setdefault(entry.path, []).append(entry)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __contains__(self, path: str):
+        return path in self.by_path
+
+
+    def find(self, path: str):
+        '''
+        First chunk with this path (eg. "MAPF/TERR/HMAP"), or None
+        '''
+
+        found = self.by_path.get(path)
+        return found[0] if found else None
+
+    def find_all(self, path: str):
+        return self.by_path.get(path, [])
+
+    def children(self, path: str):
+        '''
+        Direct children of the chunk(s) at path
+        '''
+
+        depth = path.count('/') + 1
+        return [entry for entry in self.entries
+                if entry.path.startswith(path + '/') and entry.path.count('/') == depth]
+
+
+    def seek(self, file, path: str):
+        '''
+        Move the reader to the payload of a chunk and return its limit,
+        so it can be used like the result of iter_chunks
+        '''
+
+        entry = self.find(path)
+        if entry is None:
+            raise KeyError(f"No {path} chunk in file")
+
+        file.seek(entry.offset)
+        return entry.offset + entry.size
+
+
+    def save(self, index_path: str):
+        data = {
+            "version"   : INDEX_VERSION,
+            "size"      : self.file_size,
+            "mtime_ns"  : self.mtime_ns,
+            "chunks"    : [[entry.path, entry.offset, entry.size] for entry in self.entries],
+        }
+        with open(index_path, "w") as fp:
+            json.dump(data, fp, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, index_path: str):
+        with open(index_path, "r") as fp:
+            data = json.load(fp)
+
+        if data.get("version") != INDEX_VERSION:
+            return None
+
+        entries = [chunk_entry(path, path.rsplit('/', 1)[-1], offset, size) for (path, offset, size) in data["chunks"]]
+        return cls(entries, data["size"], data["mtime_ns"])
+
+
+def scan_chunks(file):
+    '''
+    Build the index for an open stormregion_reader
+    '''
+
+    file.seek(0)
+    if file.read(8) != MAGIC:
+        raise IOError('Not a Stormregion file')
+
+    entries = []
+    _scan(file, len(file), "", entries, None)
+    file.seek(0)
+
+    return chunk_index(entries)
+
+
+def load_index(path: str, file = None, save: bool = False):
+    '''
+    Index for the file at path, taken from the sidecar (<path>.idx) when it
+    matches the file size and mtime, scanned otherwise
+
+    With save the sidecar is (re)written after a scan, failures to write it
+    (read only folders etc) are ignored
+    '''
+
+    stat = os.stat(path)
+    index_path = path + INDEX_SUFFIX
+
+    try:
+        index = chunk_index.load(index_path)
+        if index is not None and index.file_size == stat.st_size and index.mtime_ns == stat.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if file is None:
+        with stormregion_reader.open(path) as file:
+            index = scan_chunks(file)
+    else:
+        index = scan_chunks(file)
+
+    index.file_size = stat.st_size
+    index.mtime_ns  = stat.st_mtime_ns
+
+    if save:
+        try:
+            index.save(index_path)
+        except OSError as e:
+            print(f"WARNING: could not save chunk index {index_path}: {e}")
+
+    return index
+
+
+if __name__ == "__main__":
+    index = load_index(sys.argv[1], save="--save" in sys.argv)
+
+    for entry in index:
+        print(f"{hex(entry.offset):>10} {entry.size:>10}  {entry.path}")
@@ -0,0 +1,168 @@
+import json
+import os
+import re
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, records are packed one at a time instead
+    np = None
+
+'''
+Instanced export of the map objects and decals
+
+Objects are grouped by model_file and decals by material, every group is
+written as one buffer of fixed size little endian records which a MultiMesh
+(or any other instancing) can load in one go, instead of creating a node per
+placement. instances.json lists the groups with their file and instance
+count, and the record layout (stride, field names, types and offsets):
+
+    objects - x, y, z, yaw, index       20 bytes, yaw is the DOOD rotation as is
+    decals  - x, z, height, rotation    16 bytes, height is the terrain under the
+                                        decal, rotation in degrees (0/90/180/270)
+
+Positions are in world units as in the map, z is up for objects.
+'''
+
+OBJECT_RECORD = (("x", "float32"), ("y", "float32"), ("z", "float32"), ("yaw", "float32"), ("index", "uint32"))
+DECAL_RECORD  = (("x", "float32"), ("z", "float32"), ("height", "float32"), ("rotation", "uint32"))
+
+# record field type -> (numpy dtype, struct code)
+FIELD_TYPES = {"float32": ("<f4", "f"), "uint32": ("<u4", "I")}
+
+INSTANCES_MANIFEST = "instances.json"
+INSTANCES_DIR = "instances"
+
+
+def group_rows(table, name: str):
+    '''
+    (string, rows) for every distinct value of a string column of a
+    stormregion_table, sorted by the string, rows in table order
+    '''
+
+    if np is not None:
+        ids = table.column(name)
+        order = np.argsort(ids, kind="stable")
+        starts = np.flatnonzero(np.concatenate(([True], ids[order][1:] != ids[order][:-1]))) if len(ids) else []
+        groups = [(table.pool[int(ids[order[start]])], rows) for (start, rows) in zip(starts, np.split(order, starts[1:]))]
+    else:
+        by_id = {}
+        for row, string_id in enumerate(table.columns[name]):
+            by_id.setdefault(string_id, []).append(row)
+        groups = [(table.pool[string_id], rows) for (string_id, rows) in by_id.items()]
+
+    return sorted(groups, key=lambda group: group[0])
+
+
+def record_layout(record: tuple):
+    '''
+    Manifest description of a record: stride and the fields with their offsets
+    '''
+
+    fields = []
+    offset = 0
+    for (name, kind) in record:
+        fields.append({"name": name, "type": kind, "offset": offset})
+        offset += struct.calcsize(FIELD_TYPES[kind][1])
+
+    return {"stride": offset, "fields": fields}
+
+
+def pack_records(record: tuple, columns: dict):
+    '''
+    Interleave the columns (numpy arrays or lists, one per record field) into
+    the records as bytes
+    '''
+
+    if np is not None:
+        records = np.empty(len(columns[record[0][0]]), dtype=[(name, FIELD_TYPES[kind][0]) for (name, kind) in record])
+        for (name, kind) in record:
+            records[name] = columns[name]
+        return records.tobytes()
+
+    packer = struct.Struct("<" + "".join(FIELD_TYPES[kind][1] for (name, kind) in record))
+    return b"".join(packer.pack(*values) for values in zip(*[columns[name] for (name, kind) in record]))
+
+
+def _take(column, rows):
+    if np is not None:
+        return column[rows]
+    return [column[row] for row in rows]
+
+
+def group_filename(name: str, used: set):
+    '''
+    File name (without extension) for a model file or material, unique within used
+    '''
+
+    base = re.sub(r"[^A-Za-z0-9_.-]+", "_", os.path.splitext(name.replace("\\", "/"))[0]).strip("_.") or "unnamed"
+    filename = base
+    count = 1
+    while filename.lower() in used:
+        count += 1
+        filename = f"{base}_{count}"
+
+    used.add(filename.lower())
+    return filename
+
+
+def write_groups(output_dir: str, kind: str, groups: list, record: tuple):
+    '''
+    Write each (name, columns) group as INSTANCES_DIR/kind/<name>.bin,
+    returns the manifest entry for them
+    '''
+
+    folder = os.path.join(output_dir, INSTANCES_DIR, kind)
+    os.makedirs(folder, exist_ok=True)
+
+    used = set()
+    entries = []
+    for (name, columns) in groups:
+        filename = f"{INSTANCES_DIR}/{kind}/{group_filename(name, used)}.bin"
+        data = pack_records(record, columns)
+
+        with open(os.path.join(output_dir, filename), "wb") as fp:
+            fp.write(data)
+
+        entries.append({"name": name, "count": len(columns[record[0][0]]), "file": filename})
+
+    return {**record_layout(record), "groups": entries}
+
+
+def export_instances(map_file, output_dir: str = ".", decals: bool = True):
+    '''
+    Write the object (and decal) instance buffers and instances.json to
+    output_dir, returns the manifest
+    '''
+
+    objects = map_file.objects
+    columns = {name: objects.column(name) for (name, kind) in OBJECT_RECORD if name != "yaw"}
+    columns["yaw"] = objects.column("r")
+
+    object_groups = [(model, {name: _take(column, rows) for (name, column) in columns.items()})
+                     for (model, rows) in group_rows(objects, "model_file")]
+
+    manifest = {
+        "map"     : map_file.map_name,
+        "objects" : write_groups(output_dir, "objects", object_groups, OBJECT_RECORD),
+    }
+
+    if decals:
+        table = map_file.decals
+        xs = table.column("x")
+        zs = table.column("z")
+        columns = {"x": xs, "z": zs, "height": map_file.height_at(xs, zs), "rotation": table.column("r")}
+
+        decal_groups = [(material, {name: _take(column, rows) for (name, column) in columns.items()})
+                        for (material, rows) in group_rows(table, "material")]
+
+        manifest["decals"] = write_groups(output_dir, "decals", decal_groups, DECAL_RECORD)
+
+    with open(os.path.join(output_dir, INSTANCES_MANIFEST), "w") as fp:
+        json.dump(manifest, fp, indent=1)
+
+    print(f"Wrote {len(objects)} objects as {len(manifest['objects']['groups'])} instance groups"
+          + (f", {len(map_file.decals)} decals as {len(manifest['decals']['groups'])}" if decals else ""))
+
+    return manifest
@@ -1,16 +1,54 @@
 
 import os
+import json
 import struct
 import math
 import sys
+import hashlib
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from enum import Enum
 
+try:
+    import numpy as np
+except ImportError:
+    # optional, heightmap and blend are kept as lists of rows instead
+    np = None
+
 from stormregion_def import *
+from stormregion_reader import stormregion_reader
+from stormregion_index import load_index
+from stormregion_trace import trace
+from stormregion_profile import profiler, profile_stage
+from stormregion_spatial import stormregion_grid_index, ENTITY_COORDS
 
 '''
 Version history
 
+18/10/26 - Units (and the units they carry) are decoded without recursion into unit tables, see parse_untd
+18/10/26 - Instanced object/decal export grouped by model/material, see export_instances
+18/10/26 - Roads, junctions and decals can be baked into the splatmaps, see bake_overlays
+18/10/26 - Road and junction meshes (glTF), see export_roads
+18/10/26 - Grid spatial index over objects/decals/sounds, see spatial_index
+18/10/26 - Objects, decals, sounds and road nodes are columnar tables (stormregion_table)
+18/10/26 - Parsed maps can be kept in a binary cache, see stormregion_cache
+18/10/26 - Heightmap/splatmap LOD levels, see export_lods
+18/10/26 - Tiled terrain export with a tiles.json manifest, see export_tiles
+18/10/26 - Streaming terrain export in bounded memory, see stormregion_stream
+18/10/26 - Optional per chunk and export stage timings, see stormregion_profile
+18/10/26 - Per chunk/vertex/bone detail goes through stormregion_trace, off by default
+18/10/26 - Parse state is kept per parse (ParsingContext, map instances), no more module globals
+18/10/26 - convert_map() writes the exports of one map to its own folder, see stormregion_batch.py
+18/10/26 - Texture atlas tiles are loaded in parallel and cached
+18/10/26 - Splatmaps are normalised and packed as whole arrays
+18/10/26 - Heightmap export is done on the whole array, RAW16/PNG16/float32 output
+18/10/26 - Crop by world area or location, entities are clipped to the cropped area
+18/10/26 - Map sections split into chunk decoders, open_map() decodes them lazily
+18/10/26 - Read files through a memory mapped stormregion_reader
+18/10/26 - BLND is stored plane by plane in one uint8 array
+18/10/26 - HMAP is read in one go into a (size_y, size_x) float32 array
 8/10/23 - Fix parsing of RODJ, add most of PATH and LOCS, add basic for TRIG
 7/10/23 - Workflow to generate height + splatmaps + texturemap working mostly properly
 3/10/23 - Added CEUP and CESP for *.anim files
@@ -22,14 +60,14 @@ Version history
 
 import collections
 
-file_version = "v101"
 just_scene_tree = True
 debug_print = False
 
-objects = []
-scene_animations = {}
-dummies = []
-bones_by_object = {}
+
+# decoded terrain textures, see load_texture_tile, in the user cache folder
+# (not the working directory) so every map and output folder shares it
+TEXTURE_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                             "gepard-map-conv", "textures")
 
 
 class stormregion_map:
@@ -55,7 +93,15 @@ class stormregion_map:
 
     export_size : int = 0
 
+    # where create_texturemap looks for the layer textures, in order
+    TEXTURE_PATHS = ["texture", "../../stormregion-tools/gepard1and2/PanzersUnpacker/extractedFiles/tiles"]
+
+    # world units (entity coordinates) between heightmap vertices
+    # not confirmed yet, adjust if entities don't line up with the terrain
+    UNITS_PER_VERTEX = 1.0
+
     map_name        = ""
+    campaign        = ""
 
     atmosphere      = ""
     skybox          = ""
@@ -63,101 +109,314 @@ class stormregion_map:
     aircraft_type   = ""
     ambient_music   = ""
 
-    heightmap       = []    # heightmap values
-    tlayers         = []    # material name + properties
-    blend           = []    # for textured layers
-    blend_special   = []    # for blocked/onlywalker layers
 
-    objects         = []
-    decals          = []
-    ambient_sounds  = []
-    locations       = []
-    paths           = []
+    def __init__(self):
+        # per instance, so maps parsed in the same process don't share anything
+        self.heightmap       = []    # heightmap values, 2D (size_y, size_x) float32
+        self.tlayers         = []    # material name + properties
+        self.blend           = []    # BLND planes, 3D (layers, size_y, size_x) uint8
+        self.blend_mask      = []    # per BLND plane, True if it is a textured layer
+        self.blend_special   = []    # for blocked/onlywalker layers
+
+        # objects, decals and sounds are columnar tables, strings are kept once in self.strings
+        self.strings         = stormregion_string_pool()
+        self.objects         = stormregion_table(OBJECT_COLUMNS, self.strings)
+        self.decals          = stormregion_table(DECAL_COLUMNS, self.strings)
+        self.ambient_sounds  = stormregion_table(SFX_COLUMNS, self.strings)
+        self.units           = stormregion_table(UNIT_COLUMNS, self.strings)
+        self.unit_fields     = stormregion_table(UNIT_FIELD_COLUMNS, self.strings)
+        self.locations       = []
+        self.paths           = []
+
+        self.roads           = []
+        self.junctions       = []
+
+        self.tvars           = {}    # variables, dict by name
 
-    roads           = []
-    junctions       = []
+        self.splat_normalised = False   # blend has been through normalise_splatmap
+        self.overlays_baked   = False   # roads/decals have been added to the blend, see bake_overlays
 
-    tvars           = {}    # variables, dict by name
+        self.spatial_indexes = {}       # see spatial_index
 
 
     def is_pow2plus1(self, x):
         x = x - 1
         return (x & (x - 1)) == 0
-    
 
-    def crop_to(self, x1: int, x2: int, y1: int, y2: int):
+
+    def is_textured_layer(self, properties: int):
         '''
-        Crop a terrain to a specified size
-        
+        True for layers that are drawn with a texture, layers with unusual
+        properties (blocker, grass, ford, only walker, invisible) are not
         '''
 
-        new_heightmap = []
-        new_blend = []
+        return ((properties & self.TLAYER_MASK_TYPE) == self.TLAYER_NORMAL) and \
+            ((properties & self.TLAYER_MASK_WALKER) == 0) and \
+            ((properties & self.TLAYER_MASK_INVISIBLE) == 0)
 
-        x_count = 0
-        y_count = 0
-        abs_count = -1
-        for pixel in self.heightmap:
-            abs_count += 1
-            #print(f"pixel: {x_count}, {y_count}, {abs_count}, {(y_count * self.size_x)+x_count}")
 
-            if x_count > self.size_x:
-                # newline
-                x_count = 1
-                y_count += 1
+    def textured_blend(self):
+        '''
+        The BLND planes selected by blend_mask, in tlayers order
+        '''
 
-            if y_count < y1:
-                x_count += 1
-                continue
+        if np is not None:
+            return self.blend[np.array(self.blend_mask, dtype=bool)]
 
-            if x_count < x1 or x_count >= x2:
-                x_count += 1
-                continue
+        return [plane for plane, textured in zip(self.blend, self.blend_mask) if textured]
+    
 
-            if y_count >= y2:
-                break
+    @profile_stage("crop_to")
+    def crop_to(self, x1: int, x2: int, y1: int, y2: int, clip_entities: bool = True):
+        '''
+        Crop a terrain to a specified size, in vertices (x2 and y2 are not included)
+
+        The heightmap and blend layers become views of the original data
+        so nothing is copied. Entities outside the new area are dropped
+        '''
 
-            new_heightmap.append(pixel)
-            x_count += 1
+        x1 = max(0, x1)
+        y1 = max(0, y1)
+        x2 = min(self.size_x, x2)
+        y2 = min(self.size_y, y2)
+
+        if x2 <= x1 or y2 <= y1:
+            raise ValueError(f"Crop area ({x1}, {y1}) to ({x2}, {y2}) is outside the {self.size_x} x {self.size_y} map")
+
+        if np is not None:
+            new_heightmap = self.heightmap[y1:y2, x1:x2]
+            new_blend = self.blend[:, y1:y2, x1:x2]
+        else:
+            new_heightmap = [row[x1:x2] for row in self.heightmap[y1:y2]]
+            new_blend = [[row[x1:x2] for row in plane[y1:y2]] for plane in self.blend]
 
         self.heightmap = new_heightmap
+        self.blend = new_blend
 
-        x_count = 0
-        y_count = 0
+        if self.imported_size_x == 0:
+            self.imported_size_x = self.size_x
+            self.imported_size_y = self.size_y
 
-        for pixel in self.blend:
-            if x_count > self.size_x:
-                # newline
-                x_count = 1
-                y_count += 1
+        self.size_x = x2 - x1
+        self.size_y = y2 - y1
 
-            if y_count < y1:
-                x_count += 1
-                continue
+        # crop offsets are always from the original map
+        self.crop_x1 += x1
+        self.crop_y1 += y1
 
-            if x_count < x1 or x_count >= x2:
-                x_count += 1
-                continue
+        if clip_entities:
+            self.clip_entities()
 
-            if y_count >= y2:
-                break
+        print(f"Heightmap cropped to {x2-x1} by {y2-y1}, new length is {self.size_x * self.size_y} for {len(new_blend)} blend layers")
 
-            new_blend.append(pixel)
-            x_count += 1
 
-        self.blend = new_blend
+    def crop_to_world(self, x1: float, x2: float, y1: float, y2: float, clip_entities: bool = True):
+        '''
+        Crop to an area in world units (the coordinates used by entities)
+        '''
 
-        self.imported_size_x = self.size_x
-        self.imported_size_y = self.size_y
+        x1, x2 = sorted((x1, x2))
+        y1, y2 = sorted((y1, y2))
 
-        self.size_x = x2 - x1
-        self.size_y = y2 - y1
+        # keep every vertex needed to cover the area
+        self.crop_to(math.floor(x1 / self.UNITS_PER_VERTEX) - self.crop_x1,
+                     math.ceil(x2 / self.UNITS_PER_VERTEX) + 1 - self.crop_x1,
+                     math.floor(y1 / self.UNITS_PER_VERTEX) - self.crop_y1,
+                     math.ceil(y2 / self.UNITS_PER_VERTEX) + 1 - self.crop_y1,
+                     clip_entities)
+
+
+    def crop_to_location(self, loc: stormregion_loc, clip_entities: bool = True):
+        '''
+        Crop to the box of a LOCS location
+        '''
+
+        self.crop_to_world(loc.x1, loc.x2, loc.y1, loc.y2, clip_entities)
 
-        self.crop_x1 = x1
-        self.crop_y1 = y1
 
+    def world_bounds(self):
+        '''
+        (x1, x2, y1, y2) in world units covered by the current terrain
+        '''
+
+        return (self.crop_x1 * self.UNITS_PER_VERTEX,
+                (self.crop_x1 + self.size_x - 1) * self.UNITS_PER_VERTEX,
+                self.crop_y1 * self.UNITS_PER_VERTEX,
+                (self.crop_y1 + self.size_y - 1) * self.UNITS_PER_VERTEX)
+
+
+    def height_at(self, xs, ys):
+        '''
+        Terrain height at world positions, bilinear between the vertices, positions
+        off the terrain get the height of its nearest edge
+
+        numpy arrays in and out, lists without numpy
+        '''
+
+        if not self.size_x or not self.size_y:
+            return np.zeros(len(xs)) if np is not None else [0.0] * len(xs)
+
+        if np is not None:
+            heights = np.asarray(self.heightmap, dtype=np.float32)
+            gx = np.clip((np.asarray(xs, dtype=np.float64) / self.UNITS_PER_VERTEX) - self.crop_x1, 0, self.size_x - 1)
+            gy = np.clip((np.asarray(ys, dtype=np.float64) / self.UNITS_PER_VERTEX) - self.crop_y1, 0, self.size_y - 1)
+            x0 = np.minimum(gx.astype(np.int64), max(0, self.size_x - 2))
+            y0 = np.minimum(gy.astype(np.int64), max(0, self.size_y - 2))
+            x1 = np.minimum(x0 + 1, self.size_x - 1)
+            y1 = np.minimum(y0 + 1, self.size_y - 1)
+            (fx, fy) = (gx - x0, gy - y0)
+
+            top = (heights[y0, x0] * (1 - fx)) + (heights[y0, x1] * fx)
+            bottom = (heights[y1, x0] * (1 - fx)) + (heights[y1, x1] * fx)
+            return (top * (1 - fy)) + (bottom * fy)
+
+        result = []
+        for (x, y) in zip(xs, ys):
+            gx = min(max((x / self.UNITS_PER_VERTEX) - self.crop_x1, 0), self.size_x - 1)
+            gy = min(max((y / self.UNITS_PER_VERTEX) - self.crop_y1, 0), self.size_y - 1)
+            x0 = min(int(gx), max(0, self.size_x - 2))
+            y0 = min(int(gy), max(0, self.size_y - 2))
+            x1 = min(x0 + 1, self.size_x - 1)
+            y1 = min(y0 + 1, self.size_y - 1)
+            (fx, fy) = (gx - x0, gy - y0)
+
+            top = (self.heightmap[y0][x0] * (1 - fx)) + (self.heightmap[y0][x1] * fx)
+            bottom = (self.heightmap[y1][x0] * (1 - fx)) + (self.heightmap[y1][x1] * fx)
+            result.append((top * (1 - fy)) + (bottom * fy))
+
+        return result
+
+
+    def clip_entities(self):
+        '''
+        Drop entities that are outside the current terrain
+        Roads and paths are kept if any of their nodes are inside,
+        locations if they overlap it at all
+        '''
+
+        (x1, x2, y1, y2) = self.world_bounds()
+
+        def inside(x, y):
+            return x1 <= x <= x2 and y1 <= y <= y2
+
+        def inside_rows(table, x_name, y_name):
+            # whole columns at once
+            if np is not None:
+                xs = table.column(x_name)
+                ys = table.column(y_name)
+                return (xs >= x1) & (xs <= x2) & (ys >= y1) & (ys <= y2)
+
+            return [inside(x, y) for (x, y) in zip(table.columns[x_name], table.columns[y_name])]
+
+        self.objects        = self.objects.select(inside_rows(self.objects, "x", "y"))
+        self.decals         = self.decals.select(inside_rows(self.decals, "x", "z"))
+        self.ambient_sounds = self.ambient_sounds.select(inside_rows(self.ambient_sounds, "x", "y"))
+        self.clip_units(inside_rows(self.units, "x", "y"))
+        self.junctions      = [jcn for jcn in self.junctions if inside(jcn.x, jcn.y)]
+        self.roads          = [road for road in self.roads if any(inside_rows(road.nodes, "x", "y"))]
+        self.paths          = [path for path in self.paths if any(inside(x, y) for (x, y) in path.nodes)]
+        self.locations      = [loc for loc in self.locations
+                               if min(loc.x1, loc.x2) <= x2 and max(loc.x1, loc.x2) >= x1 and
+                                  min(loc.y1, loc.y2) <= y2 and max(loc.y1, loc.y2) >= y1]
+
+
+    def clip_units(self, inside):
+        '''
+        Keep the units where inside (a mask over the unit table) is True for
+        the unit on the map carrying them, stored units go with their carrier
+        '''
+
+        if np is not None:
+            parents = self.units.column("parent").astype(np.int64)
+            rows = np.arange(len(parents))
+
+            # follow the parents up to the unit on the map
+            roots = np.where(parents < 0, rows, parents)
+            while len(roots) and (parents[roots] >= 0).any():
+                roots = np.where(parents[roots] >= 0, parents[roots], roots)
+
+            keep = np.asarray(inside, dtype=bool)[roots] if len(roots) else np.zeros(0, dtype=bool)
+            new_rows = np.cumsum(keep) - 1
+            new_parents = np.where(parents >= 0, new_rows[np.maximum(parents, 0)], -1)[keep]
+            field_units = self.unit_fields.column("unit").astype(np.int64)
+            keep_fields = keep[field_units] if len(field_units) else np.zeros(0, dtype=bool)
+            new_field_units = new_rows[field_units][keep_fields]
+        else:
+            parents = self.units.columns["parent"]
+            keep = []
+            for (row, parent) in enumerate(parents):
+                # carriers come before the units they carry
+                keep.append(inside[row] if parent < 0 else keep[parent])
+
+            new_rows = []
+            for kept in keep:
+                new_rows.append((new_rows[-1] if new_rows else -1) + (1 if kept else 0))
+            new_parents = [new_rows[parent] if parent >= 0 else -1 for (parent, kept) in zip(parents, keep) if kept]
+            keep_fields = [keep[unit] for unit in self.unit_fields.columns["unit"]]
+            new_field_units = [new_rows[unit] for unit in self.unit_fields.columns["unit"] if keep[unit]]
+
+        self.units = self.units.select(keep)
+        self.unit_fields = self.unit_fields.select(keep_fields)
+
+        # rows moved, point at the new ones
+        self.units.columns["parent"][:] = array('i', [int(row) for row in new_parents])
+        self.unit_fields.columns["unit"][:] = array('I', [int(row) for row in new_field_units])
+
+
+    def unit_values(self, field: str, column: str = "value"):
+        '''
+        (unit rows, values) of one UNTD field over all the units that have it,
+        eg. unit_values("XP") for the experience of every unit at once
+
+        column is "value" (numbers, x of positions), "value2" (y of positions,
+        number of stored units) or "text" (strings, given as strings). numpy
+        arrays, lists without numpy
+        '''
+
+        string_id = self.strings.ids.get(field)
+        fields = self.unit_fields
+
+        if np is not None:
+            if string_id is None:
+                return (np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=object if column == "text" else np.float64))
+            rows = fields.column("name") == string_id
+            values = fields.column(column)[rows]
+            if column == "text":
+                values = np.array([self.strings[i] for i in values], dtype=object)
+            return (fields.column("unit")[rows], values)
+
+        rows = [row for (row, name) in enumerate(fields.columns["name"]) if name == string_id]
+        values = [fields.columns[column][row] for row in rows]
+        if column == "text":
+            values = [self.strings[i] for i in values]
+        return ([fields.columns["unit"][row] for row in rows], values)
+
+
+    def spatial_index(self, entities: str = "objects", cell_size: float = None):
+        '''
+        Grid index (see stormregion_spatial) over the positions of objects,
+        decals, ambient_sounds or units, for rectangle/radius/nearest queries that
+        return row numbers into that table
+
+        Built on first use and kept until the table changes (crop etc.)
+        '''
+
+        if entities not in ENTITY_COORDS:
+            raise ValueError(f"No spatial index for {entities}, use one of {list(ENTITY_COORDS)}")
 
-        print(f"Heightmap cropped to {x2-x1} by {y2-y1}, new length is {len(new_heightmap)} and {len(new_blend)}")
+        table = getattr(self, entities)
+        cached = self.spatial_indexes.get(entities)
+
+        if cached is not None:
+            (indexed_table, count, requested_size, index) = cached
+            if indexed_table is table and count == len(table) and requested_size == cell_size:
+                return index
+
+        (x_name, y_name) = ENTITY_COORDS[entities]
+        index = stormregion_grid_index.from_table(table, x_name, y_name, cell_size)
+        self.spatial_indexes[entities] = (table, len(table), cell_size, index)
+
+        return index
 
 
     def export_prep(self):
@@ -167,120 +426,114 @@ class stormregion_map:
         any undefined area will be flat
         '''
 
-        if self.size_x != self.size_y:
-            self.export_size = self.size_x if self.size_x > self.size_y else self.size_y
-            print(f"WARNING: Heightmap is not square ({self.size_x} x {self.size_y}), it will be expanded to {self.export_size} in both dimensions")
-        else:
-            self.export_size = self.size_x
-
-        if not self.is_pow2plus1(self.export_size):
-            next_pow2 = int(math.pow(2, (math.ceil(math.log(self.export_size, 2))))) + 1
-            print(f"WARNING: Map size ({self.size_x} x {self.size_y}) was not a power of 2. Expanded to {next_pow2} square. Unused vertices will be 0 (flat)")
+        self.export_size = export_size_for(self.size_x, self.size_y)
 
-        self.export_size = next_pow2
         self.x_padding = self.export_size - self.size_x
         self.y_padding = self.export_size - self.size_y
 
         print(f"Export prepared to {self.export_size}pixels square with padding of {self.x_padding} and {self.y_padding}")
 
 
-    def export_heightmap_to_raw(self, output_filename: str, to_png = False, padding_height: int = 0):
+    HEIGHTMAP_FORMATS = ("raw", "png", "r32")
+
+    @profile_stage("export_heightmap")
+    def export_heightmap(self, outputs: dict, padding_height: float = 0):
         '''
-        Generates a 16bit unsigned RAW file
-        from the heightmap and print scaling ranges
+        Scale, quantize and pad the heightmap once and write it in one or
+        more formats, outputs is a dict of format -> filename:
+
+            raw - 16bit unsigned RAW, little endian
+            png - 16bit grayscale PNG (same values as raw)
+            r32 - 32bit float RAW, little endian, heights are not scaled
 
-        Can also generate a PNG heightmap (8 bit unsigned)
+        The terrain is padded out to export_size square with padding_height
         '''
 
+        for fmt in outputs:
+            if fmt not in self.HEIGHTMAP_FORMATS:
+                raise ValueError(f"Unknown heightmap format {fmt}, use one of {self.HEIGHTMAP_FORMATS}")
+
         self.export_prep()
 
-        max_value = 0
-        min_value = 0
-        scale = 65535.0
+        (min_value, max_value, scale) = self.height_range()
+        padded = self.padded_heightmap(self.export_size, self.export_size, padding_height)
+        (raw_data, float_data) = quantize_heights(padded, min_value, scale)
 
-        for pixel in self.heightmap:
-            if pixel > max_value:
-                max_value = pixel       # 1.5
-            elif pixel < min_value:
-                min_value = pixel       # -1.5
+        for (fmt, output_filename) in outputs.items():
+            if fmt == "png":
+                img = Image.frombuffer("I;16", (self.export_size, self.export_size), raw_data, "raw", "I;16", 0, 1)
+                img.save(output_filename, "PNG")
 
-        if to_png:
-            scale = 255.0
+            else:
+                with open(output_filename, "wb") as fp:
+                    fp.write(float_data if fmt == "r32" else raw_data)
 
-        scale = (max_value - min_value) / scale  # 3
+            print(f"Wrote heightmap to file: {output_filename} ({fmt}), {self.export_size * self.export_size} pixels written")
 
-        wrote = 0
+        print(f"Scale: {scale}, Max: {max_value}, Min: {min_value}")
+        print(f"Layers needed: {self.tlayers}")
 
-        pixel_origin = int((padding_height + abs(min_value)) / scale)
-        
-        if to_png:
-            img = Image.new("RGB", (self.export_size, self.export_size))
-            png_data = []
-
-            x_count = 0
-            y_count = 0
-            for pixel in self.heightmap:
-                raw_pixel = int((pixel + abs(min_value)) / scale)
-                png_data.append((raw_pixel, raw_pixel, raw_pixel))
-                wrote += 1
-
-                x_count += 1
-
-                # pad rest of row with 0s (pixel_origin equates to 0 once terrain is re-imported)
-                if x_count >= self.size_x:
-                    if self.x_padding > 0:
-                        for i in range(self.x_padding):
-                            png_data.append((pixel_origin, pixel_origin, pixel_origin))
-                            wrote += 1
-                    y_count += 1
-                    x_count = 0
-                
-                # pad y_padding rows of export_size length
-                if y_count >= self.size_y:
-                    if self.y_padding > 0:
-                        for i in range(self.y_padding):
-                            for i in range(self.export_size):
-                                png_data.append((pixel_origin, pixel_origin, pixel_origin))
-                                wrote += 1
-
-            img.putdata(png_data)
-            #img = img.convert('L')
-            img.save(output_filename, 'PNG')
 
+    def height_range(self):
+        '''
+        (min, max, scale) the heightmap is quantized with, 0 is always
+        in range so the padding stays flat
+        '''
+
+        if np is not None:
+            heights = np.asarray(self.heightmap, dtype=np.float32)
+            max_value = max(0.0, float(heights.max()))
+            min_value = min(0.0, float(heights.min()))
         else:
-            pixel_origin = pixel_origin.to_bytes(2, "little")
-            with open(output_filename, "wb") as fp:
-                x_count = 0
-                y_count = 0
-                for pixel in self.heightmap:
-                    raw_pixel = int((pixel + abs(min_value)) / scale)
-                    fp.write(raw_pixel.to_bytes(2, "little"))
-                    wrote += 1
-
-                    x_count += 1
-
-                    # pad rest of row with 0s (pixel_origin equates to 0 once terrain is re-imported)
-                    if x_count >= self.size_x:
-                        if self.x_padding > 0:
-                            for i in range(self.x_padding):
-                                fp.write(pixel_origin)
-                                wrote += 1
-                        y_count += 1
-                        x_count = 0
-                    
-                    # pad y_padding rows of export_size length
-                    if y_count >= self.size_y:
-                        if self.y_padding > 0:
-                            for i in range(self.y_padding):
-                                for i in range(self.export_size):
-                                    fp.write(pixel_origin)
-                                    wrote += 1
-        
-        print(f"Scale: {scale}, Max: {max_value}, Min: {min_value}")
-        print(f"Wrote heightmap to file: {output_filename}, {wrote} bytes written")
-        print(f"Layers needed: {self.tlayers}")
+            max_value = max(0.0, max(max(row) for row in self.heightmap))
+            min_value = min(0.0, min(min(row) for row in self.heightmap))
+
+        return (min_value, max_value, self.heightmap_scale(min_value, max_value))
+
+
+    def padded_heightmap(self, width: int, height: int, padding_height: float = 0):
+        '''
+        The heightmap padded out to width x height with padding_height, a float32
+        array (an array('f') of the rows one after the other without numpy)
+        '''
+
+        if np is not None:
+            heights = np.asarray(self.heightmap, dtype=np.float32)
+            return np.pad(heights, ((0, height - self.size_y), (0, width - self.size_x)), constant_values=padding_height)
+
+        padded = array('f')
+        for row in self.heightmap:
+            padded.extend(row)
+            padded.extend([padding_height] * (width - self.size_x))
+        padded.extend([padding_height] * ((height - self.size_y) * width))
 
+        return padded
 
+
+    def heightmap_scale(self, min_value: float, max_value: float, levels: float = 65535.0):
+        '''
+        Height per step when the heightmap is quantized to 16 bits
+        '''
+
+        if max_value == min_value:
+            # completely flat
+            return 1.0
+
+        return (max_value - min_value) / levels
+
+
+    def export_heightmap_to_raw(self, output_filename: str, to_png = False, padding_height: int = 0):
+        '''
+        Generates a 16bit unsigned RAW file
+        from the heightmap and print scaling ranges
+
+        Can also generate a PNG heightmap (16 bit grayscale)
+        '''
+
+        self.export_heightmap({"png" if to_png else "raw": output_filename}, padding_height)
+
+
+    @profile_stage("normalise_splatmap")
     def normalise_splatmap(self):
         '''
         Convert the BLEND layers to a set of splatmaps
@@ -290,176 +543,523 @@ class stormregion_map:
         Stormregion uses a "base layer" which doesn't have a BLEND parameter so we have
         to generate it manually. Using 255 for that layer makes it too strong, but 128 
         seems to be about right.
+
+        Only done once, later calls (eg. tiles or LODs after the splatmaps) are a no-op
         '''
 
+        if self.splat_normalised:
+            return
+
+        self.splat_normalised = True
+
         base_layer_weight = 128
 
-        new_map = []
+        layers = self.textured_blend()
+        num_layers = len(layers) + 1
 
-        for t in range(len(self.blend)):
-            new_map.append([])
+        # note: this makes base_layer_weight effectively 255, if all other layers are 0
+        #       which is what we want
 
+        if np is not None:
+            total_weight = layers.sum(axis=0, dtype=np.float64) + base_layer_weight
 
-        for pixel in range(len(self.blend)):
-            total_weight = float(sum(self.blend[pixel])) + base_layer_weight
+            new_map = np.empty((num_layers, self.size_y, self.size_x), dtype=np.uint8)
+            new_map[0] = (base_layer_weight / total_weight) * 255
+            new_map[1:] = (layers / total_weight) * 255
 
-            # note: this makes base_layer_weight effectively 255, if all other layers are 0
-            #       which is what we want
+            self.blend = new_map
+            self.blend_mask = [True] * num_layers
 
-            #print(f"Pixel {pixel} T {total_weight}")
-            
-            new_map[pixel].append(int(float(base_layer_weight / total_weight) * 255 ))
-            for layer in self.blend[pixel]:
-                new_map[pixel].append(int(float(layer / total_weight) * 255))
+            print("BLEND map normalised")
+            return
+
+        plane_size = self.size_x * self.size_y
+        new_map = bytearray(num_layers * plane_size)
+
+        for y in range(self.size_y):
+            rows = [bytes(plane[y]) for plane in layers]
+            row_start = y * self.size_x
+
+            for x in range(self.size_x):
+                total_weight = float(sum(row[x] for row in rows)) + base_layer_weight
+
+                new_map[row_start + x] = int(float(base_layer_weight / total_weight) * 255)
+                for layer, row in enumerate(rows):
+                    new_map[((layer + 1) * plane_size) + row_start + x] = int(float(row[x] / total_weight) * 255)
 
-        self.blend = new_map
+        self.blend = decode_blend(new_map, num_layers, self.size_x, self.size_y)
+        self.blend_mask = [True] * num_layers
 
         print("BLEND map normalised")
 
 
-    def create_texturemap(self, output_filename: str, texture_size_pixels: int = 512):
+    @profile_stage("bake_overlays")
+    def bake_overlays(self, roads: bool = True, decals: bool = True, decal_sizes: dict = None, workers: int = None):
+        '''
+        Add the roads, junctions and decals to the splatmaps, one extra layer per
+        material (see stormregion_bake), so the engine doesn't have to draw them
+        as separate geometry
+
+        Each new layer takes its coverage out of the layers before it so the
+        weights still add up to 255. The layers are added to tlayers as well,
+        their textures are looked up like the terrain ones (<material>_1.png)
+
+        decal_sizes is material -> (width, height) in world units, for decals
+        that aren't DECAL_SIZE. Only done once
+        '''
+
+        if self.overlays_baked:
+            return
+
+        from stormregion_bake import bake_coverage
+
+        self.normalise_splatmap()
+        self.overlays_baked = True
+
+        baked = bake_coverage(self, roads, decals, decal_sizes, workers=workers)
+        if not baked:
+            return
+
+        # from the last layer back, each keeps what the layers after it leave
+        if np is not None:
+            remaining = np.ones((self.size_y, self.size_x), dtype=np.float32)
+            layers = []
+
+            for (material, plane) in reversed(baked):
+                share = plane.astype(np.float32) / 255
+                layers.insert(0, share * 255 * remaining)
+                remaining *= 1 - share
+
+            weights = self.blend.astype(np.float32) * remaining
+            self.blend = np.rint(np.concatenate((weights, np.stack(layers)))).astype(np.uint8)
+
+        else:
+            blend = [[bytearray(self.size_x) for y in range(self.size_y)] for layer in range(len(self.blend) + len(baked))]
+
+            for y in range(self.size_y):
+                for x in range(self.size_x):
+                    remaining = 1.0
+                    for (layer, (material, plane)) in reversed(list(enumerate(baked, len(self.blend)))):
+                        share = plane[y][x] / 255
+                        blend[layer][y][x] = int(round(share * 255 * remaining))
+                        remaining *= 1 - share
+
+                    for layer, plane in enumerate(self.blend):
+                        blend[layer][y][x] = int(round(plane[y][x] * remaining))
+
+            self.blend = blend
+
+        for (material, plane) in baked:
+            self.tlayers.append({'material': material, 'properties': 0})
+            self.blend_mask.append(True)
+
+        print(f"Baked {len(baked)} road/decal layers into the splatmaps")
+
+
+    def find_texture(self, material: str, texture_paths: list = None):
+        '''
+        Path of the tile texture for a terrain layer material, or None
+
+        Each folder in texture_paths is tried in order, converted PNGs
+        first and then the DDS files from the game archives
+        '''
+
+        for folder in (texture_paths or self.TEXTURE_PATHS):
+            for extension in (".png", ".dds"):
+                path = os.path.join(folder, f"{material}_1{extension}")
+                if os.path.isfile(path):
+                    return path
+
+        return None
+
+
+    @profile_stage("create_texturemap")
+    def create_texturemap(self, output_filename: str, texture_size_pixels: int = 512,
+                          texture_paths: list = None, cache_dir: str = TEXTURE_CACHE, workers: int = None):
         '''
         Create a merged grid of the necessary textures used by the splatmaps
 
         It will be auto-arranged into a square that fits them all (the rest padded white)
+
+        Textures are decoded and resized on a thread pool. Decoded tiles are kept
+        in cache_dir (TEXTURE_CACHE by default, None to disable) so later runs
+        don't decode them again
         '''
 
-        texture_data = []
-        missing_textures = 0
-
-        for layer in self.tlayers:
-            # ignore layers with unusual properties
-            if ((layer['properties'] & self.TLAYER_MASK_TYPE) == self.TLAYER_NORMAL) and \
-                ((layer['properties'] & self.TLAYER_MASK_WALKER) == 0) and \
-                ((layer['properties'] & self.TLAYER_MASK_INVISIBLE) == 0):
-
-                try:
-                    texture_data.append(Image.open(f"texture/{layer['material']}_1.png"))
-                except FileNotFoundError:
-                    try:
-                        texture_data.append(Image.open(f"../../stormregion-tools/gepard1and2/PanzersUnpacker/extractedFiles/tiles/{layer['material']}_1.dds"))
-                        print(f"Importing DDS texture {layer['material']}")
-                        texture_data[-1].save(f"texture/{layer['material']}_1.png", 'PNG')
-                    except FileNotFoundError:
-                        print(f"Missing texture locally and in game files: {layer['material']}_1.png")
-                        missing_textures += 1
-                        continue
-
-        if missing_textures > 0:
-            print("Missing textures - texturemap/splatmap NOT generated")
-            exit()
+        materials = [layer['material'] for layer in self.tlayers if self.is_textured_layer(layer['properties'])]
+
+        sources = [self.find_texture(material, texture_paths) for material in materials]
+        missing = [material for material, source in zip(materials, sources) if source is None]
+
+        if missing:
+            for material in missing:
+                print(f"Missing texture locally and in game files: {material}_1.png")
+            raise FileNotFoundError(f"Missing textures {missing} - texturemap/splatmap NOT generated")
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            texture_data = list(pool.map(lambda source: load_texture_tile(source, texture_size_pixels, cache_dir), sources))
 
         size_side = math.ceil(math.sqrt(len(texture_data)))
         size_pixels = size_side * texture_size_pixels
         print(f"Creating texturemap of {len(texture_data)} - {size_side} by {size_side}, image size will be {size_pixels} square")
         output_tex = Image.new('RGBA', (size_pixels, size_pixels), color=(0,0,0,0))
 
-        x_pos = 0
-        y_pos = 0
-        for image in texture_data:
-            output_tex.paste(image,(x_pos,y_pos))
-            x_pos += texture_size_pixels
-            if x_pos >= size_pixels:
-                x_pos = 0
-                y_pos += texture_size_pixels
+        for idx, image in enumerate(texture_data):
+            output_tex.paste(image, ((idx % size_side) * texture_size_pixels, (idx // size_side) * texture_size_pixels))
 
         output_tex.save(output_filename, "PNG")
 
 
-    def export_splatmaps(self, output_filename: str):
+    @profile_stage("pack_splatmaps")
+    def pack_splatmaps(self):
+        '''
+        Pack the blend layers 4 at a time into RGBA images of export_size square,
+        undefined areas are 0 (no texture at all)
+
+        Returns the raw RGBA data of each splatmap
+        '''
+
+        return pack_rgba(self.blend, self.size_x, self.size_y, self.export_size)
+
+
+    @profile_stage("export_splatmaps")
+    def export_splatmaps(self, output_dir: str = "."):
         '''
         Export all textured BLEND layers to a series of splatmaps
         Up to 4 layers per map (R, G, B, A)
         Client application will need to ensure that the texture channels in-game
         are matched with the order here (we use the order that tlayers are parsed)
+
+        The splatmaps and the texturemap are written to output_dir
         '''
 
         self.export_prep()
 
         self.normalise_splatmap()
 
-        self.create_texturemap(f"{self.map_name}_texture_array.png")
+        self.create_texturemap(os.path.join(output_dir, f"{self.map_name}_texture_array.png"))
 
-        num_splatmaps = math.ceil(len(self.blend[0]) / 4)
+        splatmaps = self.pack_splatmaps()
 
-        print(f"Require {num_splatmaps} splatmaps for {len(self.blend[0])} layers")
+        print(f"Require {len(splatmaps)} splatmaps for {len(self.blend)} layers")
 
-        output_data = []
-        for splatmap_index in range(num_splatmaps):
-            output_data.append([])
+        # export to file
+        for splatmap_index, rgba in enumerate(splatmaps):
+            img = Image.frombuffer("RGBA", (self.export_size, self.export_size), rgba, "raw", "RGBA", 0, 1)
+            
+            if splatmap_index == 0:
+                fname = "splat.png"
+            else:
+                # game expects splat, splat2, splat3...
+                fname = f"splat{splatmap_index+1}.png"
+            img.save(os.path.join(output_dir, fname), "PNG")
 
-        pixel_index = 0
-        x_index = 0
-        y_index = 0
+        print(f"{len(splatmaps)} BLEND splatmaps generated")
 
-        # per pixel
-        for pixel_map in self.blend:
-            layer_index = 0
+        # todo: generate GRASS or FORD layers as "detail" layers
 
-            pixel_cache = []
 
-            # per layer
-            for map in pixel_map:
-                splatmap_index = math.floor(layer_index / 4)
+    TILES_MANIFEST = "tiles.json"
 
-                pixel_cache.append(map)
-                
-                if len(pixel_cache) == 4:
-                    output_data[splatmap_index].append(tuple(pixel_cache))
-                    splatmap_index += 1
-                    pixel_cache = []
-
-                layer_index += 1
-
-            if len(pixel_cache) != 0:
-                while len(pixel_cache) != 4:
-                    #print(f"padding channel {len(pixel_cache) -1 }")
-                    pixel_cache.append(0)
-                output_data[splatmap_index].append(tuple(pixel_cache))
-                pixel_cache = []
-            
-            x_index += 1
-            pixel_index += 1
-
-            # pad out undefined areas
-            if x_index >= self.size_x:
-                if self.x_padding > 0:
-                    for q in range(self.x_padding):
-                        for z in range(num_splatmaps):
-                            output_data[z].append((0,0,0,0))
-                        pixel_index += 1
-                
-                x_index = 0
-                y_index += 1
-                
-            # pad out y with full rows of 0 (no texture at all)
-            if y_index > self.size_y:
-                if self.y_padding > 0:
-                    for q in range(self.y_padding):
-                        for u in range(self.export_size):
-                            for z in range(num_splatmaps):
-                                output_data[z].append((0,0,0,0))
-                            pixel_index += 1
+    def tile_grid(self, tile_size: int, overlap: int = 1):
+        '''
+        (tiles_x, tiles_y, step) for cutting the terrain into tile_size square
+        tiles, neighbouring tiles share overlap rows/columns of vertices
+        '''
 
+        if tile_size < 2 or not 0 <= overlap < tile_size:
+            raise ValueError(f"Tile size {tile_size} with overlap {overlap} is not usable")
 
-        print(f"{num_splatmaps} BLEND splatmaps generated")
+        step = tile_size - overlap
+        tiles_x = max(1, math.ceil((self.size_x - overlap) / step))
+        tiles_y = max(1, math.ceil((self.size_y - overlap) / step))
 
+        return (tiles_x, tiles_y, step)
 
-        # export to file
-        for splatmap_index in range(num_splatmaps):
-            img = Image.new("RGBA", (self.export_size, self.export_size))
-            img.putdata(output_data[splatmap_index])
-            
-            if splatmap_index == 0:
-                fname = "splat.png"
+
+    @profile_stage("export_tiles")
+    def export_tiles(self, output_dir: str, tile_size: int = 257, overlap: int = 1,
+                     heightmap_formats: tuple = ("raw",), splatmaps: bool = True,
+                     padding_height: float = 0, workers: int = None):
+        '''
+        Export the terrain as a grid of tile_size square tiles instead of one
+        heightmap/splatmap, for engines that stream terrain in chunks
+
+        With the default overlap of 1 the edge vertices are in both neighbouring
+        tiles so they line up exactly. Tiles on the right/bottom edge are padded
+        with padding_height (and no texture). Heights are quantized with the range
+        of the whole map so every tile uses the same scale
+
+        Per tile (x, y) in output_dir/tiles:
+
+            heightmap_<x>_<y>.raw/.png/.r32 - see export_heightmap
+            splat_<x>_<y>.png, splat2_<x>_<y>.png..
+
+        plus the texturemap and tiles.json describing the grid. Tiles are encoded
+        on a thread pool
+        '''
+
+        for fmt in heightmap_formats:
+            if fmt not in self.HEIGHTMAP_FORMATS:
+                raise ValueError(f"Unknown heightmap format {fmt}, use one of {self.HEIGHTMAP_FORMATS}")
+
+        (tiles_x, tiles_y, step) = self.tile_grid(tile_size, overlap)
+
+        # everything the tiles are cut from, padded out to the whole grid
+        grid_x = (tiles_x * step) + overlap
+        grid_y = (tiles_y * step) + overlap
+
+        tile_dir = os.path.join(output_dir, "tiles")
+        os.makedirs(tile_dir, exist_ok=True)
+
+        (min_value, max_value, scale) = self.height_range()
+
+        num_splatmaps = 0
+        texture_filename = None
+
+        if splatmaps:
+            self.normalise_splatmap()
+            texture_filename = f"{self.map_name}_texture_array.png"
+            self.create_texturemap(os.path.join(output_dir, texture_filename))
+            num_splatmaps = math.ceil(len(self.blend) / 4)
+
+        padded = self.padded_heightmap(grid_x, grid_y, padding_height)
+
+        if np is not None and num_splatmaps:
+            channels = np.zeros((num_splatmaps * 4, grid_y, grid_x), dtype=np.uint8)
+            channels[:len(self.blend), :self.size_y, :self.size_x] = self.blend
+            # (splatmap, y, x, channel), the tiles are cut from this view
+            splat_grid = channels.reshape(num_splatmaps, 4, grid_y, grid_x).transpose(0, 2, 3, 1)
+
+        def tile_heights(x0, y0):
+            if np is not None:
+                return quantize_heights(padded[y0:y0 + tile_size, x0:x0 + tile_size], min_value, scale)
+
+            values = array('f')
+            for y in range(y0, y0 + tile_size):
+                values.extend(padded[(y * grid_x) + x0:(y * grid_x) + x0 + tile_size])
+
+            return quantize_heights(values, min_value, scale)
+
+        def tile_splatmap(splatmap_index, x0, y0):
+            if np is not None:
+                return np.ascontiguousarray(splat_grid[splatmap_index, y0:y0 + tile_size, x0:x0 + tile_size])
+
+            rgba = bytearray(tile_size * tile_size * 4)
+            for channel in range(4):
+                layer = (splatmap_index * 4) + channel
+                if layer >= len(self.blend):
+                    break
+
+                for y in range(y0, min(y0 + tile_size, self.size_y)):
+                    row = bytes(self.blend[layer][y][x0:x0 + tile_size])
+                    start = ((y - y0) * tile_size * 4) + channel
+                    rgba[start:start + (len(row) * 4):4] = row
+
+            return rgba
+
+        def export_tile(tile):
+            (tx, ty) = tile
+            x0 = tx * step
+            y0 = ty * step
+
+            entry = {
+                "x"         : tx,
+                "y"         : ty,
+                "origin"    : [x0, y0],
+                "world"     : [(self.crop_x1 + x0) * self.UNITS_PER_VERTEX,
+                               (self.crop_x1 + x0 + tile_size - 1) * self.UNITS_PER_VERTEX,
+                               (self.crop_y1 + y0) * self.UNITS_PER_VERTEX,
+                               (self.crop_y1 + y0 + tile_size - 1) * self.UNITS_PER_VERTEX],
+                "heightmap" : {},
+                "splatmaps" : [],
+            }
+
+            (raw_data, float_data) = tile_heights(x0, y0)
+
+            for fmt in heightmap_formats:
+                fname = f"heightmap_{tx}_{ty}.{fmt}"
+                if fmt == "png":
+                    img = Image.frombuffer("I;16", (tile_size, tile_size), raw_data, "raw", "I;16", 0, 1)
+                    img.save(os.path.join(tile_dir, fname), "PNG")
+                else:
+                    with open(os.path.join(tile_dir, fname), "wb") as fp:
+                        fp.write(float_data if fmt == "r32" else raw_data)
+                entry["heightmap"][fmt] = f"tiles/{fname}"
+
+            for splatmap_index in range(num_splatmaps):
+                rgba = tile_splatmap(splatmap_index, x0, y0)
+                img = Image.frombuffer("RGBA", (tile_size, tile_size), rgba, "raw", "RGBA", 0, 1)
+
+                # same naming as export_splatmaps, splat, splat2, splat3...
+                fname = f"splat{splatmap_index + 1 if splatmap_index else ''}_{tx}_{ty}.png"
+                img.save(os.path.join(tile_dir, fname), "PNG")
+                entry["splatmaps"].append(f"tiles/{fname}")
+
+            return entry
+
+        tiles = [(tx, ty) for ty in range(tiles_y) for tx in range(tiles_x)]
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(export_tile, tiles))
+
+        manifest = {
+            "map"              : self.map_name,
+            "size"             : [self.size_x, self.size_y],
+            "crop"             : [self.crop_x1, self.crop_y1],
+            "units_per_vertex" : self.UNITS_PER_VERTEX,
+            "tile_size"        : tile_size,
+            "overlap"          : overlap,
+            "grid"             : [tiles_x, tiles_y],
+            "height"           : {"min": min_value, "max": max_value, "scale": scale, "padding": padding_height},
+            "layers"           : [layer['material'] for layer in self.tlayers if self.is_textured_layer(layer['properties'])],
+            "texture"          : texture_filename,
+            "tiles"            : entries,
+        }
+
+        with open(os.path.join(output_dir, self.TILES_MANIFEST), "w") as fp:
+            json.dump(manifest, fp, indent=1)
+
+        print(f"Wrote {tiles_x} by {tiles_y} tiles of {tile_size} vertices (overlap {overlap}) to {tile_dir}")
+        print(f"Scale: {scale}, Max: {max_value}, Min: {min_value}")
+
+
+    @profile_stage("export_lods")
+    def export_lods(self, output_dir: str = ".", min_size: int = 33, filter: str = "decimate",
+                    heightmap_formats: tuple = ("raw",), splatmaps: bool = True, padding_height: float = 0):
+        '''
+        Write lower detail levels of the heightmap (and splatmaps) next to the full
+        size export, for distant terrain. Each level halves the previous one,
+        (export_size - 1) / 2 + 1 vertices and so on down to min_size:
+
+            heightmap_lod1.raw/.png/.r32, heightmap_lod2...
+            splat_lod1.png, splat2_lod1.png..
+
+        filter is how vertices are merged, see downsample. Splat weights are
+        decimated with decimate and averaged otherwise, so they still add up to 255.
+        Heights use the scale of the full size heightmap
+
+        Returns the size of each level written
+        '''
+
+        for fmt in heightmap_formats:
+            if fmt not in self.HEIGHTMAP_FORMATS:
+                raise ValueError(f"Unknown heightmap format {fmt}, use one of {self.HEIGHTMAP_FORMATS}")
+
+        self.export_prep()
+        size = self.export_size
+
+        (min_value, max_value, scale) = self.height_range()
+        heights = self.padded_heightmap(size, size, padding_height)
+        if np is None:
+            heights = [heights[y * size:(y + 1) * size] for y in range(size)]
+
+        planes = None
+        if splatmaps:
+            self.normalise_splatmap()
+            splat_filter = "decimate" if filter == "decimate" else "average"
+
+            if np is not None:
+                planes = np.zeros((len(self.blend), size, size), dtype=np.uint8)
+                planes[:, :self.size_y, :self.size_x] = self.blend
             else:
-                # game expects splat, splat2, splat3...
-                fname = f"splat{splatmap_index+1}.png"
-            img.save(fname, "PNG")
-            splatmap_index += 1
-        
-        # todo: generate GRASS or FORD layers as "detail" layers
-        
+                planes = [[list(plane[y]) + [0] * (size - self.size_x) if y < self.size_y else [0] * size
+                           for y in range(size)] for plane in self.blend]
+
+        sizes = []
+        level = 0
+
+        while ((size - 1) // 2) + 1 >= max(2, min_size) and size > 2:
+            level += 1
+            size = ((size - 1) // 2) + 1
+
+            if np is not None:
+                heights = downsample(heights, filter)
+                (raw_data, float_data) = quantize_heights(heights, min_value, scale)
+            else:
+                # back to float32 so every level matches the numpy one
+                heights = [array('f', row) for row in downsample(heights, filter)]
+                (raw_data, float_data) = quantize_heights(array('f', [value for row in heights for value in row]), min_value, scale)
+
+            for fmt in heightmap_formats:
+                output_filename = os.path.join(output_dir, f"heightmap_lod{level}.{fmt}")
+                if fmt == "png":
+                    img = Image.frombuffer("I;16", (size, size), raw_data, "raw", "I;16", 0, 1)
+                    img.save(output_filename, "PNG")
+                else:
+                    with open(output_filename, "wb") as fp:
+                        fp.write(float_data if fmt == "r32" else raw_data)
+
+            if planes is not None:
+                if np is not None:
+                    planes = downsample(planes, splat_filter)
+                else:
+                    planes = [downsample(plane, splat_filter) for plane in planes]
+
+                for splatmap_index, rgba in enumerate(pack_rgba(planes, size, size, size)):
+                    img = Image.frombuffer("RGBA", (size, size), rgba, "raw", "RGBA", 0, 1)
+                    fname = f"splat{splatmap_index + 1 if splatmap_index else ''}_lod{level}.png"
+                    img.save(os.path.join(output_dir, fname), "PNG")
+
+            sizes.append(size)
+
+        print(f"Wrote {len(sizes)} LOD levels ({filter}): {sizes}")
+        return sizes
+
+
+    @profile_stage("export_roads")
+    def export_roads(self, output_dir: str = ".", filename: str = "roads.gltf", height_offset: float = 0.05):
+        '''
+        Roads and junctions as meshes draped over the terrain (height_offset
+        above it), one mesh per material, written to output_dir/roads.gltf + .bin
+
+        See stormregion_roads for how the geometry is built
+        '''
+
+        import stormregion_roads
+
+        meshes = stormregion_roads.road_meshes(self, self.roads, height_offset)
+        meshes += [(f"junction_{material}", mesh) for (material, mesh)
+                   in stormregion_roads.junction_meshes(self, self.junctions, height_offset)]
+
+        output_filename = os.path.join(output_dir, filename)
+        stormregion_roads.write_gltf(meshes, output_filename)
+
+        print(f"Wrote {len(self.roads)} roads and {len(self.junctions)} junctions "
+              f"({sum(mesh['triangles'] for (name, mesh) in meshes)} triangles) to {output_filename}")
+
+        return meshes
+
+
+    @profile_stage("export_instances")
+    def export_instances(self, output_dir: str = ".", decals: bool = True):
+        '''
+        Objects grouped by model file (and decals by material) as instance
+        buffers plus an instances.json manifest, see stormregion_instances
+        '''
+
+        from stormregion_instances import export_instances
+
+        return export_instances(self, output_dir, decals)
+
+
+    def get_header(self):
+        '''
+        Map metadata from the header chunks
+        '''
+
+        return {
+            "version"       : self.version,
+            "campaign"      : self.campaign,
+            "config"        : self.config,
+            "atmosphere"    : self.atmosphere,
+            "skybox"        : self.skybox,
+            "aircraft_type" : self.aircraft_type,
+            "ambient_music" : self.ambient_music,
+            "size_x"        : self.size_x,
+            "size_y"        : self.size_y,
+        }
+
 
     def get_stats(self):
         print(f"Map Size        : {self.size_x} x {self.size_y}")
@@ -471,73 +1071,238 @@ class stormregion_map:
         print(f"Sounds          : {len(self.ambient_sounds)}")
     
 
-def read_kind(file):
-    raw_data = file.read(4)
-    if debug_print:
-        print("++K " + raw_data.hex())
-    return raw_data.decode()
-
-def read_char(file):
-    raw_data = file.read(1)
-    if debug_print:
-        pass#print("++C " + raw_data.hex())       
-    return int.from_bytes(raw_data, 'little')
-
-def read_uint(file):
-    raw_data = file.read(4)
-    if debug_print:
-        print("++U " + raw_data.hex())
-    return struct.unpack('<I', raw_data)[0]
-
-def read_sint(file):
-    raw_data = file.read(4)
-    if debug_print:
-        print("++I " + raw_data.hex())
-    return struct.unpack('<i', raw_data)[0]
-
-def read_ushort(file):
-    raw_data = file.read(2)
-    if debug_print:
-        print("++S " + raw_data.hex())
-    return struct.unpack('<H', raw_data)[0]
-
-def read_float(file):
-    raw_data = file.read(4)
-    if debug_print:
-        print("++F " + raw_data.hex())
-    return struct.unpack('<f', raw_data)[0]
-
-def read_string(file):
-    length = read_ushort(file)
-    if length > 4096:
-        print("ERROR STRING WAS TOO LONG")
-        exit()
-    if length == 0:
-        return ""
-    #    data = read_ushort(file)
-    #    if data != 0:
-    #        print("READ_STRING LEN 0, DATA WAS NOT 0")
-    #        #exit(0)
-    #    else:
-    #        return ""
-    raw_data = file.read(length)
-    if debug_print:
-        print("++S " + raw_data.hex())
-    result = raw_data.decode()
-    return result
+def export_size_for(size_x: int, size_y: int):
+    '''
+    Side of the (power of 2 plus 1) square a size_x by size_y heightmap is padded to
+    '''
+
+    if size_x != size_y:
+        export_size = size_x if size_x > size_y else size_y
+        print(f"WARNING: Heightmap is not square ({size_x} x {size_y}), it will be expanded to {export_size} in both dimensions")
+    else:
+        export_size = size_x
+
+    x = export_size - 1
+    if (x & (x - 1)) != 0:
+        next_pow2 = int(math.pow(2, (math.ceil(math.log(export_size, 2))))) + 1
+        print(f"WARNING: Map size ({size_x} x {size_y}) was not a power of 2. Expanded to {next_pow2} square. Unused vertices will be 0 (flat)")
+        export_size = next_pow2
+
+    return export_size
+
+
+def quantize_heights(values, min_value: float, scale: float):
+    '''
+    (16bit unsigned, 32bit float) little endian data of a float32 heightmap,
+    a numpy array or an array('f')
+    '''
+
+    if np is not None and isinstance(values, np.ndarray):
+        return (np.clip((values.astype(np.float64) - min_value) / scale, 0, 65535).astype('<u2').tobytes(),
+                values.astype('<f4').tobytes())
+
+    raw_values = array('H', [min(65535, max(0, int((pixel - min_value) / scale))) for pixel in values])
+    float_values = array('f', values)
+    if sys.byteorder != "little":
+        raw_values.byteswap()
+        float_values.byteswap()
+
+    return (raw_values.tobytes(), float_values.tobytes())
+
+
+def pack_rgba(blend, size_x: int, size_y: int, size: int):
+    '''
+    Pack (layers, size_y, size_x) blend planes 4 at a time into RGBA data of
+    size square, anything outside the planes is 0
+    '''
+
+    num_layers = len(blend)
+    num_splatmaps = math.ceil(num_layers / 4)
+
+    if np is not None:
+        channels = np.zeros((num_splatmaps * 4, size, size), dtype=np.uint8)
+        channels[:num_layers, :size_y, :size_x] = blend
+
+        # (splatmap, channel, y, x) -> (splatmap, y, x, channel)
+        packed = channels.reshape(num_splatmaps, 4, size, size).transpose(0, 2, 3, 1)
+        return [np.ascontiguousarray(rgba) for rgba in packed]
+
+    splatmaps = []
+    for splatmap_index in range(num_splatmaps):
+        rgba = bytearray(size * size * 4)
+
+        for channel in range(4):
+            layer = (splatmap_index * 4) + channel
+            if layer >= num_layers:
+                break
+
+            for y in range(size_y):
+                start = (y * size * 4) + channel
+                rgba[start:start + (size_x * 4):4] = bytes(blend[layer][y])
+
+        splatmaps.append(rgba)
+
+    return splatmaps
+
+
+LOD_FILTERS = ("decimate", "min", "max", "minmax", "average")
+
+def downsample(values, filter: str = "decimate"):
+    '''
+    Halve a grid of (power of 2 plus 1) vertices, vertex (x, y) of the result is
+    vertex (2x, 2y) of the original merged with the 3x3 vertices around it:
+
+        decimate - just the vertex, the others are dropped
+        min, max - the lowest/highest of the 3x3, keeps valleys/ridges
+        minmax   - min or max, whichever is further from the vertex, keeps both
+        average  - the mean of the 3x3 (rounded for integer data)
+
+    values is a numpy array (the last 2 axes are halved, so all the planes
+    of a blend at once) or a list of rows without numpy
+    '''
+
+    if filter not in LOD_FILTERS:
+        raise ValueError(f"Unknown filter {filter}, use one of {LOD_FILTERS}")
+
+    if np is not None:
+        centre = values[..., ::2, ::2]
+        if filter == "decimate":
+            return np.ascontiguousarray(centre)
+
+        # 3x3 neighbourhood as 9 strided views, edges repeat the border vertex
+        (size_y, size_x) = values.shape[-2:]
+        padded = np.pad(values, [(0, 0)] * (values.ndim - 2) + [(1, 1), (1, 1)], mode="edge")
+        windows = [padded[..., dy:dy + size_y:2, dx:dx + size_x:2] for dy in range(3) for dx in range(3)]
+
+        if filter == "average":
+            total = windows[0].astype(np.float64)
+            for window in windows[1:]:
+                total += window
+            total /= 9
+            return (total.round() if values.dtype.kind in "iu" else total).astype(values.dtype)
+
+        low = np.minimum.reduce(windows)
+        high = np.maximum.reduce(windows)
+        if filter == "min":
+            return low
+        if filter == "max":
+            return high
+
+        return np.where((high - centre) >= (centre - low), high, low)
+
+    size_y = len(values)
+    size_x = len(values[0])
+    result = []
+
+    for y in range(0, size_y, 2):
+        rows = (values[max(0, y - 1)], values[y], values[min(size_y - 1, y + 1)])
+        new_row = []
+
+        for x in range(0, size_x, 2):
+            vertex = values[y][x]
+            if filter == "decimate":
+                new_row.append(vertex)
+                continue
+
+            columns = (max(0, x - 1), x, min(size_x - 1, x + 1))
+            window = [row[i] for row in rows for i in columns]
+
+            if filter == "average":
+                average = sum(window) / 9
+                new_row.append(round(average) if isinstance(vertex, int) else average)
+            elif filter == "min":
+                new_row.append(min(window))
+            elif filter == "max":
+                new_row.append(max(window))
+            else:
+                (low, high) = (min(window), max(window))
+                new_row.append(high if (high - vertex) >= (vertex - low) else low)
+
+        result.append(new_row)
+
+    return result
+
+
+def load_texture_tile(source: str, size: int, cache_dir: str = None):
+    '''
+    Load a terrain texture (PNG or DDS) as a size x size RGBA image
+
+    With cache_dir the decoded tile is stored there as raw RGBA, keyed by the
+    source path, size and mtime, so it's only decoded once
+    '''
+
+    if cache_dir:
+        stat = os.stat(source)
+        key = hashlib.sha1(f"{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}|{size}".encode()).hexdigest()
+        cached = os.path.join(cache_dir, key[:2], f"{key}.rgba")
+
+        try:
+            with open(cached, "rb") as fp:
+                return Image.frombuffer("RGBA", (size, size), fp.read(), "raw", "RGBA", 0, 1)
+        except (OSError, ValueError):
+            pass
+
+    if source.endswith(".dds"):
+        print(f"Importing DDS texture {source}")
+
+    with Image.open(source) as img:
+        tile = img.convert("RGBA")
+
+    if tile.size != (size, size):
+        tile = tile.resize((size, size), Image.LANCZOS)
+
+    if cache_dir:
+        # write then rename, other processes may be filling the same cache
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+        temp_name = f"{cached}.{os.getpid()}.{threading.get_ident()}"
+        with open(temp_name, "wb") as fp:
+            fp.write(tile.tobytes())
+        os.replace(temp_name, cached)
+
+    return tile
+
+
+def decode_heightmap(values, size_x, size_y):
+    '''
+    Shape HMAP values (float32, row by row, as returned by read_array)
+    into a 2D array of shape (size_y, size_x) without copying
+
+    Without NumPy this is a list of rows, so heightmap[y][x]
+    works the same either way
+    '''
+
+    if np is not None:
+        return np.asarray(values, dtype=np.float32).reshape(size_y, size_x)
+
+    return [values[y * size_x:(y + 1) * size_x] for y in range(size_y)]
+
+def decode_blend(raw_data, num_planes, size_x, size_y):
+    '''
+    Wrap BLND data (one byte per vertex, plane after plane) as a 3D
+    uint8 array of shape (num_planes, size_y, size_x) without copying
+
+    Without NumPy this is a list of planes, each a list of rows
+    '''
+
+    if np is not None:
+        return np.frombuffer(raw_data, dtype=np.uint8).reshape(num_planes, size_y, size_x)
+
+    plane_size = size_x * size_y
+    view = memoryview(raw_data)
 
-def read_vec(file, components):
-    res = {}
-    
-    for i in range(components):
-        res[i] = read_float(file)
-        
-    return res
+    return [[view[(i * plane_size) + (y * size_x):(i * plane_size) + ((y + 1) * size_x)] for y in range(size_y)]
+            for i in range(num_planes)]
 
 def iter_chunks(file, limit):    
+    if profiler.enabled:
+        return profiler.iter_chunks(file, limit)
+
+    return _iter_chunks(file, limit)
+
+def _iter_chunks(file, limit):
     while(file.tell() < limit):
-        kind = read_kind(file)
-        size = read_uint(file)
+        kind = file.read_kind()
+        size = file.read_uint()
         
         last = file.tell() + size
     
@@ -557,138 +1322,182 @@ class ParsingContext():
         self.mesh = None
         self.obj  = None
 
+        # v100 - SWINE and some leftover in Panzers Phase 1/2
+        # v101 - Panzers phase 1 + 2
+        # (MAPF has a plain number instead)
+        self.file_version = "v101"
+
+        # everything collected while parsing one file, kept here rather than
+        # in globals so files can be parsed side by side in threads
+        self.dummies = []
+        self.bones_by_object = {}
+        self.scene_animations = {}
+
 
 def parse_anims(file, limit, ctx):
     srefs = {}
-    num_anims = read_uint(file)
+    num_anims = file.read_uint()
 
     for (kind, limit) in iter_chunks(file, limit):    
-        sref_name = read_string(file)
-        sref_anim = read_string(file)
+        sref_name = file.read_string()
+        sref_anim = file.read_string()
         srefs[sref_name] = sref_anim
         #print(f" - Add SREF {sref_name} = {sref_anim}")
 
+    ctx.scene_animations.update(srefs)
+
+
+# UNTD field type tag -> (kind, layout of the value plus the tag of the field after it)
+# strings are variable length and read on their own
+UNTD_FIELD_TYPES = {
+    1  : ("char",   struct.Struct('<BI')),
+    2  : ("uint",   struct.Struct('<II')),
+    3  : ("float",  struct.Struct('<fI')),
+    5  : ("string", None),
+    8  : ("vec2",   struct.Struct('<ffI')),     # x, y
+    10 : ("units",  struct.Struct('<III')),     # ?, stored unit count, the first _mcl block follows if not 0
+}
+
+UNTD_END = 0
+UNTD_MCL = 0x6c636d5f   # "_mcl", a stored unit: length, then its fields
+
+# UNTD fields that also go in columns of the unit table
+UNTD_UNIT_COLUMNS = {
+    "ClassName" : ("classname",),
+    "Player"    : ("player",),
+    "XP"        : ("xp",),
+    "Pos"       : ("x", "y"),
+}
+
+
+def parse_untd(file, limit, units, fields):
+    '''
+    Decode one UNTD unit and the units stored in it into the units and unit
+    fields tables (UNIT_COLUMNS, UNIT_FIELD_COLUMNS)
+
+    A unit is a list of (type tag, name, value) fields ended by a 0 tag. A
+    "units" field with stored units is followed by their _mcl blocks, each a
+    unit of its own, after which the fields of the carrying unit go on. A
+    stored unit ends at its 0 tag, at the _mcl of the next one, or at the end
+    of its block. Stored units are kept on a stack, no recursion
+    '''
+
+    unit_types = dict(UNIT_COLUMNS)
+    unit_columns = units.columns
+    intern = fields.pool.intern
+    (field_units, field_names, field_types, field_values, field_values2, field_texts) = \
+        [fields.columns[name] for (name, dtype) in UNIT_FIELD_COLUMNS]
+    no_text = intern("")
+
+    def begin_unit(parent: int, depth: int):
+        units.append_values("", 0, 0.0, 0.0, 0.0, parent, depth)
+        return len(units) - 1
+
+    # (unit row, end of its data)
+    stack = [(begin_unit(-1, 0), limit)]
+    tag = file.read_uint()
+
+    while stack:
+        (row, end) = stack[-1]
+
+        if tag == UNTD_END or tag == UNTD_MCL:
+            stack.pop()
+            if not stack:
+                break
 
-def parse_untd(file, limit_arbitrary = 0xffffffff, level = 0):
-    unit = stormregion_map_unit_def()
-
-    #if level > 0:
-        #print("SUBUNIT START")
-    next = read_uint(file)
-    while True:
-        field = read_string(file)
-
-        if next == 5:
-            value = read_string(file)
-
-        elif next == 1:
-            value = read_char(file)
-
-        elif next == 2:
-            value = read_uint(file)
-
-        elif next == 8:
-            x = read_float(file)
-            y = read_float(file)
-            value = f"{x} , {y}"  # x, y
+            if tag == UNTD_END:
+                # another stored unit, or the next field of the carrying unit
+                tag = file.read_uint()
+
+            if tag == UNTD_MCL:
+                length = file.read_uint()
+                stack.append((begin_unit(stack[-1][0], len(stack)), file.tell() + length))
+                tag = file.read_uint()
+            continue
+
+        field_type = UNTD_FIELD_TYPES.get(tag)
+        if field_type is None:
+            print(f"Unknown UNTD field type {tag} at {hex(file.tell() - 4)}, rest of the unit skipped")
+            return
+
+        (kind, layout) = field_type
+        name = file.read_string()
+        (value, value2, text) = (0.0, 0.0, None)
+
+        if layout is None:
+            text = file.read_string()
+            next_tag = file.read_uint()
+        elif kind == "vec2" or kind == "units":
+            (value, value2, next_tag) = file.read_struct(layout)
+        else:
+            (value, next_tag) = file.read_struct(layout)
 
-        elif next == 10:
-            value_a = read_uint(file)
-            value_b = read_uint(file)
-            if value_b == 0:
-                value = "null"
-            else:
-                # num stored units
-                # sub unit def interrupts current unit def
-                kind = read_kind(file)
-                if kind == "_mcl":
-                    length = read_uint(file)
-                    count = 1
-                    next = parse_untd(file, length + file.tell(), level + 1)
-                    next = read_uint(file)
-                    if next != 0x6c636d5f:
-                        continue
-                    while next == 0x6c636d5f:
-                        count += 1
-                        length = read_uint(file)
-                        next = parse_untd(file, length + file.tell(), level + 1)
-                        print(next)
-
-                    value = f"subunit_count{count}"
+        field_units.append(row)
+        field_names.append(intern(name))
+        field_types.append(tag)
+        field_values.append(value)
+        field_values2.append(value2)
+        field_texts.append(no_text if text is None else intern(text))
 
-                
-                
+        columns = UNTD_UNIT_COLUMNS.get(name)
+        if columns is not None:
+            for (column, column_value) in zip(columns, (value, value2)):
+                dtype = unit_types[column]
+                if dtype == "s" and text is not None:
+                    unit_columns[column][row] = intern(text)
+                elif dtype != "s" and text is None:
+                    unit_columns[column][row] = column_value if dtype == "f" else int(column_value)
 
-        elif next == 3:
-            value = read_float(file)
+        tag = next_tag
 
-        else:
-            value = f"unknown format: {next}"
-
-        spaces = ""
-        for i in range(level):
-            spaces = spaces + " "
-
-        # create the unit object
-        if field == "ClassName":
-            unit.classname = value
-        elif field == "Player":
-            unit.player = value
-        elif field == "XP":
-            unit.xp = value
-        elif field == "Pos":
-            unit.x = x
-            unit.y = y
-
-        #print(f"  {spaces}> UNTD: {field} = {value}")
-        
-        next = read_uint(file)      # DATATYPE FOR NEXT THING?
-        if next == 0:
-            #print("return 0")
-            return 0
+        if kind == "units" and value2 != 0:
+            if tag != UNTD_MCL:
+                print(f"Expected stored units at {hex(file.tell() - 4)}, rest of the unit skipped")
+                return
 
-        if next == 0x6c636d5f:
-            #print("return mcl")
-            return 0x6c636d5f
+            length = file.read_uint()
+            stack.append((begin_unit(row, len(stack)), file.tell() + length))
+            tag = file.read_uint()
 
-        if file.tell() >= limit_arbitrary:
-            #print("return limit")
-            return 1
+        elif tag != UNTD_END and tag != UNTD_MCL and file.tell() >= end:
+            # unit without an end tag, for a stored unit this is the next field of the carrying unit
+            stack.pop()
 
 
 def parse_material(file, limit, ctx):
 
     
     # TODO: These properties are actually unsupported, first DIFF applies to whole object
-    if file_version == "v101":
-        numFaces = read_uint(file)      # actually numIndis
-        vertexStart = read_uint(file)
-        vertexEnd = read_uint(file)
+    if ctx.file_version == "v101":
+        numFaces = file.read_uint()      # actually numIndis
+        vertexStart = file.read_uint()
+        vertexEnd = file.read_uint()
     else:
         # 100
-        numFaces    = read_uint(file)
-        vertexStart = read_uint(file)
-        vertexEnd   = read_uint(file) + vertexStart
+        numFaces    = file.read_uint()
+        vertexStart = file.read_uint()
+        vertexEnd   = file.read_uint() + vertexStart
 
     diffuse = None
     specular = None
     
     for (kind, limit) in iter_chunks(file, limit):    
-        print(f"  - {kind}")
+        if trace.chunk:
+            trace.emit("chunk", kind, limit=limit)
 
         if kind == 'DIFF':
-            diffuse = read_string(file)
+            diffuse = file.read_string()
 
-            if not just_scene_tree:
-                print(f"  > Parsed DIFF: {diffuse} with {vertexStart} and {vertexEnd} and {numFaces}")
+            if trace.material:
+                trace.emit("material", "DIFF", texture=diffuse, start=vertexStart, end=vertexEnd, faces=numFaces)
             
             # All textures are supposed to be .png files
             diffuse = diffuse.replace('.tga', '.png')
 
         elif kind == 'SPEC':
-            specular = read_string(file)
-            if not just_scene_tree:
-                print(f"  > Parsed SPEC: {specular} with {vertexStart} and {vertexEnd} and {numFaces}")
+            specular = file.read_string()
+            if trace.material:
+                trace.emit("material", "SPEC", texture=specular, start=vertexStart, end=vertexEnd, faces=numFaces)
 
 
         elif kind == "STRP":
@@ -696,27 +1505,21 @@ def parse_material(file, limit, ctx):
 
 
         elif kind == "MTBL":
-            numMTBL = read_uint(file)
-
-            if not just_scene_tree:
-                print(f"  > Found MTBL section with {numMTBL} indexes")
+            numMTBL = file.read_uint()
 
-            mtbl = []
+            mtbl = file.read_array('I', numMTBL).tolist()
 
-            for idx in range(numMTBL):
-                mtbl.append(read_uint(file))
-
-            if not just_scene_tree:
-                print(mtbl)
+            if trace.material:
+                trace.emit("material", "MTBL", count=numMTBL, indexes=mtbl)
 
         elif kind == "REFL":
-            reflection = read_string(file)
-            if not just_scene_tree:
-                print(f"  > Parsed REFL: {reflection} with {vertexStart} and {vertexEnd} and {numFaces}")
+            reflection = file.read_string()
+            if trace.material:
+                trace.emit("material", "REFL", texture=reflection, start=vertexStart, end=vertexEnd, faces=numFaces)
 
         else:
-            if not just_scene_tree:
-                print(f"  > Unsupported MTL kind {kind}")
+            if trace.material:
+                trace.emit("material", "unsupported", kind=kind)
 
 
     # Sanity check
@@ -725,8 +1528,8 @@ def parse_material(file, limit, ctx):
 
 
 def parse_object(file, limit, ctx, kind = "MESH"):
-    name     = read_string(file)
-    parentID = read_sint(file)
+    name     = file.read_string()
+    parentID = file.read_sint()
 
     if not just_scene_tree:
         print(f"Parsed {kind}: {name} with parent ID {parentID}")
@@ -735,12 +1538,12 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     indis = []
     indiNum = 0
     
-    if file_version == "v101":
+    if ctx.file_version == "v101":
         # waste 8 bytes
         if not just_scene_tree:
             print("> Wasting 8 bytes for 101")
-        read_sint(file)
-        read_sint(file)
+        file.read_sint()
+        file.read_sint()
 
     if kind == "MESH" or kind == "SKVS":
         # Allocate associated blender structures
@@ -755,21 +1558,19 @@ def parse_object(file, limit, ctx, kind = "MESH"):
         print("> Transformation:")
     # Parse transformation, location
     transformation_matrix = (
-        (read_float(file), read_float(file), read_float(file), 0),
-        (read_float(file), read_float(file), read_float(file), 0),
-        (read_float(file), read_float(file), read_float(file), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
         (0,                0,                0,                1)
     )
 
-    print(f"Object {name}")
-    print(transformation_matrix)
-    
     if not just_scene_tree:
         print(transformation_matrix)
 
-    print("Location:")
-    location = read_vec(file, 3) #* ctx.scale
-    print(location)
+    location = file.read_vec(3) #* ctx.scale
+
+    if trace.object:
+        trace.emit("object", kind, object=name, parent=parentID, matrix=transformation_matrix, location=location)
     
     # Parse various object attributes
     vertex_pos  = None
@@ -781,8 +1582,8 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     if kind == "NODE":
         if not just_scene_tree:
             print("Unknown:")
-        other_matrix = ( read_float(file), read_float(file), read_float(file), 
-                        read_float(file), read_float(file), read_float(file), read_float(file))
+        other_matrix = ( file.read_float(), file.read_float(), file.read_float(), 
+                        file.read_float(), file.read_float(), file.read_float(), file.read_float())
 
         if not just_scene_tree:
             print(other_matrix)
@@ -790,7 +1591,7 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     faces = []
 
     if kind == "DUMY":
-        dummies.append(name)
+        ctx.dummies.append(name)
 
     if kind == "DUMY":
         return
@@ -798,84 +1599,90 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     root_kind = kind
 
     for (kind, limit) in iter_chunks(file, limit):
-
-        print(f"- {kind} {hex(limit)}")
+        if trace.chunk:
+            trace.emit("chunk", kind, object=name, limit=limit)
         
         # normal VERT, for objects and vehicles
         if kind == 'VERT' and root_kind != "SKVS":
-            vertexNum    = read_uint(file)
-            vertexFormat = read_uint(file)
+            vertexNum    = file.read_uint()
+            vertexFormat = file.read_uint()
+            profiler.add_records(vertexNum)
 
             if vertexNum > 0xFFFF:
                 raise IOError('Too many vertices')
     
             if vertexFormat != 0 and vertexFormat != 1: 
                 raise IOError('Unsupported vertex format {vertexFormat}')
+
+            if trace.object:
+                trace.emit("object", "VERT", object=name, vertices=vertexNum, format=vertexFormat)
             
             if vertexFormat == 0:
                 vertex_pos  = []
                 vertex_norm = []
                 vertex_uv   = []
-                print(f" > Found {vertexNum} vertices for this mesh")
                 for idx in range(vertexNum):
-                    vertex_pos.append( read_vec(file, 3) ) #* ctx.scale )
-                    vertex_norm.append( read_vec(file, 3) )
+                    vertex_pos.append( file.read_vec(3) ) #* ctx.scale )
+                    vertex_norm.append( file.read_vec(3) )
                     
                     # Whacky coordinate systems..
                     vertex_uv.append((
-                        0 + read_float(file), 
-                        1 - read_float(file)
+                        0 + file.read_float(), 
+                        1 - file.read_float()
                     ))
 
             else:
                 vertex_pos  = []
                 vertex_norm = []
                 vertex_uv   = []
-                print(f" > Found {vertexNum} vertices for this mesh")
+                trace_vertex = trace.vertex
                 for idx in range(vertexNum):
-                    pos = read_vec(file, 3) # * ctx.scale
+                    pos = file.read_vec(3) # * ctx.scale
                     vertex_pos.append( pos )
-                    norm = read_vec(file, 3)
+                    norm = file.read_vec(3)
                     vertex_norm.append( norm )
                     
                     # Whacky coordinate systems..
                     vertex_uv.append((
-                        0 + read_float(file), 
-                        1 - read_float(file)
+                        0 + file.read_float(), 
+                        1 - file.read_float()
                     ))
-                    other = read_float(file)
-                    print(pos, norm, other)
+                    other = file.read_float()
+                    if trace_vertex:
+                        trace.emit("vertex", "VERT", object=name, index=idx, pos=pos, norm=norm, other=other)
                 
 
 
         # VERT inside SKVS is used by "walker"s (humans)
         elif kind == "VERT" and root_kind == "SKVS":
-            vertexNum    = read_uint(file)
-            vertexFormat = read_uint(file)
-            vertexUnknown = read_uint(file)
+            vertexNum    = file.read_uint()
+            vertexFormat = file.read_uint()
+            profiler.add_records(vertexNum)
+            vertexUnknown = file.read_uint()
 
-            print(f" > Read vertex format SKVS: {vertexNum}, {vertexFormat}, {vertexUnknown}")
+            if trace.object:
+                trace.emit("object", "VERT", object=name, vertices=vertexNum, format=vertexFormat, unknown=vertexUnknown)
 
             vertex_pos  = []
             vertex_norm = []
             vertex_uv   = []
             groups_created = {}
-            
+            trace_vertex = trace.vertex
 
             for idx in range(vertexNum):
-                vertex_pos.append( read_vec(file, 3) ) #* ctx.scale )
-                vertex_norm.append( read_vec(file, 3) )
+                vertex_pos.append( file.read_vec(3) ) #* ctx.scale )
+                vertex_norm.append( file.read_vec(3) )
                 
                 # Whacky coordinate systems..
                 vertex_uv.append((
-                    0 + read_float(file), 
-                    1 - read_float(file)
+                    0 + file.read_float(), 
+                    1 - file.read_float()
                 ))
 
                 bone_numbers = []
                 group = 0
                 for i in range(4):
-                    group = read_char(file)
+                    group = file.read_char()
                     bone_numbers.append(group)
                 
                 #print(f" > > Bone num {bone_numbers}")
@@ -884,18 +1691,21 @@ def parse_object(file, limit, ctx, kind = "MESH"):
                 material_floats = []
 
                 for i in range(4):
-                    bone_weights.append(read_float(file))
+                    bone_weights.append(file.read_float())
 
                 #print(f" > > Bone weights {bone_weights}")
 
                 mtbl_numbers = []
                 for i in range(4):
-                    mtbl_numbers.append(read_char(file))
+                    mtbl_numbers.append(file.read_char())
                 
                 #print(f" > > MTBL {mtbl_numbers}")
 
                 for i in range(4):
-                    material_floats.append(read_float(file))
+                    material_floats.append(file.read_float())
+
+                if trace_vertex:
+                    trace.emit("vertex", "SKVS", object=name, index=idx, bones=bone_numbers, weights=bone_weights, mtbl=mtbl_numbers)
 
                 # create vertex groups with weights
                 for i in range(4):
@@ -909,23 +1719,22 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
 
         elif kind == "BONS":
-            if name not in bones_by_object:
-                bones_by_object[name] = {}
-            numBones = read_uint(file)
+            if name not in ctx.bones_by_object:
+                ctx.bones_by_object[name] = {}
+            numBones = file.read_uint()
+            profiler.add_records(numBones)
 
             for idx in range(numBones):
-                bone_id = read_uint(file)
-                matrix = read_vec(file, 3)
-                matrix2 = read_vec(file, 3)
-                matrix3 = read_vec(file, 3)
-                pos = read_vec(file, 3)
+                bone_id = file.read_uint()
+                matrix = file.read_vec(3)
+                matrix2 = file.read_vec(3)
+                matrix3 = file.read_vec(3)
+                pos = file.read_vec(3)
                 this_bone = ( matrix, matrix2, matrix3, pos)
   
-                bones_by_object[name][bone_id] = this_bone
-                print(f" > Bone {bone_id}: {matrix}")
-                print(f" >         {matrix2}")
-                print(f" >         {matrix3}")
-                print(f" >         {pos}")
+                ctx.bones_by_object[name][bone_id] = this_bone
+                if trace.bone:
+                    trace.emit("bone", "BONS", object=name, bone=bone_id, matrix=(matrix, matrix2, matrix3), pos=pos)
                 
             if not just_scene_tree:
                 print(f" > Loaded {numBones} bones for this object")
@@ -934,26 +1743,27 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
 
         elif kind == 'INDI':
-            indiNum = read_uint(file)
+            indiNum = file.read_uint()
+            profiler.add_records(indiNum)
 
             if not just_scene_tree:
                 print(f" > Found {indiNum} indexes for this mesh")
 
-            for idx in range(indiNum):
-                indis.append(read_ushort(file))
+            indis.extend(file.read_array('H', indiNum).tolist())
                 
 
         elif kind == 'FACE':
-            faceNum = read_uint(file)
+            faceNum = file.read_uint()
+            profiler.add_records(faceNum)
 
             if not just_scene_tree:
                 print(f" > Found {faceNum} faces for this mesh")
             
             for idx in range(faceNum):
                 faces.append((
-                    read_ushort(file),
-                    read_ushort(file),
-                    read_ushort(file)          
+                    file.read_ushort(),
+                    file.read_ushort(),
+                    file.read_ushort()          
                 ))
                 
             # Fill mesh data with geometry (vertices, faces)
@@ -968,7 +1778,7 @@ def parse_object(file, limit, ctx, kind = "MESH"):
         
 
         elif kind == 'MTLS' or kind == 'SSQS':
-            materialNum = read_uint(file)
+            materialNum = file.read_uint()
             
             for (kind, limit) in iter_chunks(file, limit):
                 if kind == 'MATE' or kind == "STRP":
@@ -984,7 +1794,7 @@ def parse_object(file, limit, ctx, kind = "MESH"):
         elif kind == "BBOX":
                 coords = []
                 for i in range(8):
-                    coords.append(read_vec(file, 3))
+                    coords.append(file.read_vec(3))
 
                 if not just_scene_tree:
                     print(" > Read bounding box for MESH")
@@ -993,28 +1803,34 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
         # .anim files, child of NODE - position?
         elif kind == "CPSP":
-            frames = read_uint(file)       # number of frames
-            blank = read_uint(file)
-            a = read_float(file)
-            sh = read_ushort(file)
-            print(f" > CPSP num frames: {frames}, {a}, {sh}")
+            frames = file.read_uint()       # number of frames
+            profiler.add_records(frames)
+            blank = file.read_uint()
+            a = file.read_float()
+            sh = file.read_ushort()
+            if trace.anim:
+                trace.emit("anim", "CPSP", object=name, frames=frames, a=a, sh=sh)
             
             for i in range(frames):
-                c = read_vec(file, 3)
-                print(i, c)
+                c = file.read_vec(3)
+                if trace.anim:
+                    trace.emit("anim", kind, object=name, frame=i, value=c)
 
             
         # .anim files, child of NODE - rotation?
         elif kind == "CEUP":
-            frames = read_uint(file)
-            blank = read_uint(file)
-            a = read_float(file)
-            sh = read_ushort(file)
-            print(f" > CEUP num frames: {frames}, {a}, {sh}")
+            frames = file.read_uint()
+            profiler.add_records(frames)
+            blank = file.read_uint()
+            a = file.read_float()
+            sh = file.read_ushort()
+            if trace.anim:
+                trace.emit("anim", "CEUP", object=name, frames=frames, a=a, sh=sh)
 
             for i in range(frames):
-                c = read_vec(file, 3)
-                print(i, c)
+                c = file.read_vec(3)
+                if trace.anim:
+                    trace.emit("anim", kind, object=name, frame=i, value=c)
 
         else:
             if not just_scene_tree:
@@ -1063,523 +1879,670 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     # End of MESH chunks
     return
 
-def parse_4d_model(filepath, file):
-    global file_version
+def parse_tpam(file, limit, map_file):
+    campaign = file.read_string()
+    if not just_scene_tree:
+        print(f"Campaign: {campaign}")
+    map_file.campaign = campaign
 
-    if file.read(8) != b'\x53\x72\x1A\x1B\x0D\x0A\x87\x0A':
-        raise IOError('Not a Stormregion file')
 
-    # Setup parsing context
-    ctx = ParsingContext()
-    ctx.folder = os.path.dirname(filepath)
+def parse_inim(file, limit, map_file):
+    file.read(2)
+    map_config = file.read_string()
+    map_file.config = map_config
 
-    # Create root object representing the model
-    #root = bpy.data.objects.new('4d_model', None)
-    
-    #root.empty_display_type = 'CIRCLE'
-    #root.empty_display_size = 1
 
-    # Rotate root object to compensate some the wacky coordinate system
-    #root.rotation_euler = (math.radians(90), 0, 0)
+def parse_atms(file, limit, map_file):
+    atmosphere = file.read_string()
+    if not just_scene_tree:
+        print(f"ATMS: {atmosphere}")
+    map_file.atmosphere = atmosphere
 
-    # Add to parsing context, everything will be parented to this
-    #ctx.objects.append(root)
-    #ctx.parents.append(None)
 
-    map_x = 0
-    map_y = 0
+def parse_ksyb(file, limit, map_file):
+    atmosphere = file.read_string()
+    if not just_scene_tree:
+        print(f"KSYB: {atmosphere}")
+    map_file.skybox = atmosphere
 
-    # ONE section should follow immediately
-    for (kind, limit) in iter_chunks(file, 128):
-        if kind == 'SCEN':
-            print("MODEL file")
-            file_version = file.read(4).decode("utf-8")
-            print(f"SCEN version {file_version}")
 
+def parse_lria(file, limit, map_file):
+    map_file.aircraft_type = file.read_string()
+    if not just_scene_tree:
+        print(f"> LRIA, Airplanes type: {map_file.aircraft_type}")
 
-        elif kind == "MAPF":
-            print("MAP file")
-            map_file = stormregion_map()
-            file_version = read_uint(file)
-            print(f"MAP version {file_version}")
-            map_file.version = file_version
-        
-        elif kind == 'CANM':
-            file_version = file.read(4).decode("utf-8")
-            a = read_float(file)
-            b = read_float(file)
-            c = read_float(file)
-            print(f"ANIM file CANM {file_version} with {a}, {b}, {c}")
-        
-        previous_limit = 0
-        for (kind, limit) in iter_chunks(file, limit):
-            print(kind, limit - previous_limit, hex(limit))
-            length = limit - previous_limit
-            previous_limit = limit
 
-            if kind == 'MESH' or kind == "DUMY" or kind == "SKVS" or kind == "BSP_" or kind == "NODE":
-                parse_object(file, limit, ctx, kind)
+def parse_isum(file, limit, map_file):
+    map_file.ambient_music = file.read_string()
+    if not just_scene_tree:
+        print(f"> ISUM: ambient music: {map_file.ambient_music}")
 
-            elif kind == "SSQS":
-                parse_anims(file, limit, ctx)
 
-            elif kind == "FLYZ":
-                print("Ignoring FLYZ")
+def parse_3whr(file, limit, map_file):
+    file.read(4)
+    whrs = []
 
+    whrs.append(file.read_string())
+    file.read(0x60)
 
-            # -------  map files -----------
 
-            elif kind == "MINA":
-                # 2 bytes == 00
-                pass
+# Fixed layout parts of the map records, strings in between are read separately
 
-            elif kind == "TPAM":
-                campaign = read_string(file)
-                if not just_scene_tree:
-                    print(f"Campaign: {campaign}")
-                map_file.campaign = campaign
+RECORD_HEADER   = struct.Struct('<4sI4s')       # kind, size, version (DOOD, AMBI)
+DOOD_RECORD     = struct.Struct('<4fIIf3BHI')   # x, z, y, rot, ?, ?, ?, ?, ?, ?, ?, next
+AMBI_RECORD     = struct.Struct('<4fI')         # x, y, z, v, next
+ROD5_ROAD       = struct.Struct('<ffII')        # tesselation distance (m), ?, config, node count
+ROD5_NODE       = struct.Struct('<8fI')         # x, y, r1, r2, alpha_l, alpha_r, interp, r3, jcn_id
+RODJ_JCN        = struct.Struct('<ffI8fII')     # ?, ?, config, (as ROD5_NODE), joint count
+RODJ_JOINT      = struct.Struct('<IB')          # ROD5 reference, properties
+LOCS_BOX        = struct.Struct('<4I')          # x1, y1, x2, y2
+LOCS_TAIL       = struct.Struct('<II')          # color, next
+PATH_HEADER     = struct.Struct('<BII')         # ?, index, node count
+PATH_NODE       = struct.Struct('<2f')          # x, y
 
-            elif kind == "INIM":
-                file.read(2)
-                map_config = read_string(file)
-                map_file.config = map_config
 
-            elif kind == "MINI":
-                # mini map ??
-                pass
+def parse_rod5(file, limit, map_file):
+    # road map of some sort
+    num_roads = file.read_uint()
+    b = file.read_uint()
+    c = file.read_uint()      
+    print(f" > ROD5: {num_roads}, {b}, {c}")
 
-            elif kind == "ATMS":
-                atmosphere = read_string(file)
-                if not just_scene_tree:
-                    print(f"ATMS: {atmosphere}")
-                map_file.atmosphere = atmosphere
+    for rd in range(num_roads):
+        nodes = file.read_uint()         # ??
+        while nodes != stormregion_map.DATABLOCK_NEXT and nodes != stormregion_map.DATABLOCK_END:
+            nodes = file.read_uint()  
 
+        if nodes == stormregion_map.DATABLOCK_END:
+            break
 
-            elif kind == "KSYB":
-                atmosphere = read_string(file)
-                if not just_scene_tree:
-                    print(f"KSYB: {atmosphere}")
-                map_file.skybox = atmosphere
+        material = file.read_string()
+        (a, b, c, d) = file.read_struct(ROD5_ROAD)
 
-            elif kind == "TERR":
-                terr_version = file.read(4).decode("utf-8")
-                print(f"TERR version: {terr_version}")
+        road = stormregion_road(material, a, c)
+        if trace.entity:
+            trace.emit("entity", "ROD5", material=material, b=b, nodes=d)
 
-                current_pos = file.tell() + 8
-                for (kind, limit) in iter_chunks(file, limit):
-                    print(f" > Parsing {kind} length {limit-current_pos} limit {hex(limit)}") 
-                    current_pos = limit
+        for (x, y, r1, r2, al, ar, itrp, r3, jcn) in file.iter_struct(ROD5_NODE, d):
+            road.nodes.append_values(x, y, r1, r2, r3, al, ar, itrp, jcn)
 
-                    if kind == "HMAP":
-                        map_file.size_x = read_uint(file) + 1
-                        map_file.size_y = read_uint(file) + 1
-                        print(f"   size {map_file.size_x} by {map_file.size_y}")     
+        map_file.roads.append(road)
 
-                        # either 
-                        for i in range(map_file.size_x * map_file.size_y):
-                            map_file.heightmap.append(read_float(file))
-                        
-                        print(f" > HMAP Read {len(map_file.heightmap)} vertices")
- 
+    profiler.add_records(len(map_file.roads))
 
-                    elif kind == "TLAY":
-                        num_tlays = read_uint(file)
-                        # layer IDS: 0 = normal, 2 = grass (read_string again), 1 = blocker, 4 = ford, 0x10 = only walker, mask 0x80 = invisible
 
-                        for i in range(num_tlays):
-                            layer = read_string(file)
-                            layer_id = read_uint(file)
-                            map_file.tlayers.append({"material": layer, "properties": layer_id})
+def parse_rodj(file, limit, map_file):
+    # road junction .?
+    try:
+        a = file.read_uint()
+        b = file.read_uint()     # 13 = 1, 12 = 2 ???
+        num_junctions = file.read_uint()
+        c = file.read_uint()
+        print(f" > RODJ: {num_junctions}, {c}")
 
-                        print(f" > {map_file.tlayers}")
+        while c != stormregion_map.DATABLOCK_END and c != stormregion_map.DATABLOCK_NEXT:
+            c = file.read_uint()
 
-                    elif kind == "TMAP":
-                        pass
 
+        for jcn in range(num_junctions):
+            prefab = file.read_string()
 
-                    elif kind == "BLND":
-                        # 1 byte per vertex 161x161 per tlayer
-                        for i in range(len(map_file.tlayers) - 1):
-      
-                            if map_file.size_x == 0 or map_file.size_y == 0:
-                                print("ERROR - not obtained dimensions of map from HMAP yet")
-                                exit(0)
+            # unused properties in stormregion_jcn initialiser are not known/used
+            # in JCN type
+            (a, b, c, x, y, r1, r2, al, ar, itrp, r3, jcn, joint_count) = file.read_struct(RODJ_JCN)
+            if trace.entity:
+                trace.emit("entity", "RODJ", prefab=prefab, a=a, b=b, properties=c)
 
-                            if ((map_file.tlayers[i]['properties'] & stormregion_map.TLAYER_MASK_TYPE) == stormregion_map.TLAYER_NORMAL) and \
-                                ((map_file.tlayers[i]['properties'] & stormregion_map.TLAYER_MASK_WALKER) == 0) and \
-                                ((map_file.tlayers[i]['properties'] & stormregion_map.TLAYER_MASK_INVISIBLE) == 0)     :
+            # tells which ROD5's are connected to
+            # seems to be 12 connections per JCN, but only 4 or so max are used
+            # how to know which is which?
+            joints = list(file.iter_struct(RODJ_JOINT, joint_count))
 
-                                if map_file.blend == []:
-                                    for t in range((map_file.size_x * map_file.size_y)):
-                                        map_file.blend.append([])
+            jcn = stormregion_jcn(prefab, c, x, y, r1, r2, r3)
+            map_file.junctions.append(jcn)
 
+            c = file.read_uint()
+            while c != stormregion_map.DATABLOCK_END and c != stormregion_map.DATABLOCK_NEXT:
+                c = file.read_uint()
 
-                                # optimise: could just read the full datablock and switch
-                                # when exported
-                                for j in range(map_file.size_x * map_file.size_y):
-                                    map_file.blend[j].append(read_char(file))
+        profiler.add_records(len(map_file.junctions))
 
-                                print(f" > BLEND: {map_file.tlayers[i]['material']}")
+    except (struct.error, IndexError, ValueError, UnicodeDecodeError) as e:
+        raise IOError(f"Malformed RODJ chunk before {hex(limit)}: {e}") from e
 
-                        print(f"Loaded {len(map_file.blend[0])} blend maps")                    
 
+def parse_tvar(file, limit, map_file):
+    # variables for scripting - DONE
+    num_slots = file.read_uint()
+    b = file.read_uint()
+    num_tvars = file.read_uint()
+    next = 0
 
-                    elif kind == "DIFF":
-                        # same length as HMAP exactly
-                        pass
+    while next != stormregion_map.DATABLOCK_NEXT:
+        next = file.read_uint()
 
+    for tvar in range(num_tvars):
+        tvar_name = file.read_string()
+        initial_value = file.read_uint()         # FFFFFFFF == -1 etc
+        increment = file.read_uint()
 
-                    elif kind == "BLCK":
-                        # big data set, 3.2mb
-                        pass
+        map_file.tvars[tvar_name] = stormregion_tvar(tvar_name, initial_value, increment)
+        if trace.entity:
+            trace.emit("entity", "TVAR", name=tvar_name, initial=initial_value, increment=increment)
 
-            elif kind == "3WHR":
-                file.read(4)
-                whrs = []
+        if num_tvars > 1:
+            next = file.read_uint()
 
-                whrs.append(read_string(file))
-                file.read(0x60)
+    profiler.add_records(num_tvars)
 
 
-            elif kind == "ROD5":
-                # road map of some sort
-                num_roads = read_uint(file)
-                b = read_uint(file)
-                c = read_uint(file)      
-                print(f" > ROD5: {num_roads}, {b}, {c}")
+def parse_trig(file, limit, map_file):
+    num_trig = file.read_uint()
 
-                for rd in range(num_roads):
-                    nodes = read_uint(file)         # ??
-                    while nodes != stormregion_map.DATABLOCK_NEXT and nodes != stormregion_map.DATABLOCK_END:
-                        nodes = read_uint(file)  
+    return
 
-                    if nodes == stormregion_map.DATABLOCK_END:
-                        break
+    # todo : need to parse each trigger action/condition according to its
+    #        type : good repetitive job for spare time kicking about
 
-                    material = read_string(file)
-                    a = read_float(file)    # road tesselation distance (m)
-                    b = read_float(file)
-                    c = read_uint(file)     # 0x20 = U mirror, 0x40 = V mirror,
-                    d = read_uint(file)  
+    for trig in range(num_trig):
+        hdr = file.read_uint()
+        trig_num = file.read_uint()   # 02 when enabled
+        a = file.read_uint()          # 01 = normal, 02 = parallel
+        trig_name = file.read_string()
+        event_type = file.read_uint()          # event (0 = periodical, 4 = unit_attacked)
+        # read payload according to type
 
-                    road = stormregion_road(material, a, c)
-                    print(f" > New road: {material} with: {b} {d}")
+        condition_count = file.read_uint()          # conditions
+        # read payload according to type
+        for condition in range(condition_count):
+            condition = file.read_uint()
 
-                    for i in range(d):
-                        x = read_float(file)
-                        y = read_float(file)
-                        r1 = read_float(file)
-                        r2 = read_float(file)
-                        al = read_float(file)
-                        ar = read_float(file)
-                        itrp = read_float(file)
-                        r3 = read_float(file)
-                        jcn = read_uint(file)
+        actions_count = file.read_uint()          # actions
+        # read payload according to type
+        for action in range(actions_count):
+            action = file.read_uint()
 
-                        node = stormregion_road_node(x, y, r1, r2, r3, al, ar, itrp, jcn)
-                        road.add_node(node)
+        print(f" > TRIG: {trig_num}, {trig_name}, {a} {b} {c} {d} {e} {hdr}")
 
-                    map_file.roads.append(road)
 
-            elif kind == "RODJ":
-                # road junction .?
-                try:
-                    a = read_uint(file)
-                    b = read_uint(file)     # 13 = 1, 12 = 2 ???
-                    num_junctions = read_uint(file)
-                    c = read_uint(file)
-                    print(f" > RODJ: {num_junctions}, {c}")
+def parse_locs(file, limit, map_file):
+    b = file.read_uint()
+    a = file.read_uint()
+    num_locs = file.read_uint()
 
-                    while c != stormregion_map.DATABLOCK_END and c != stormregion_map.DATABLOCK_NEXT:
-                        c = read_uint(file)
-                    
+    if num_locs == 0:
+        print(f" > LOCS: none in file")
+        return
 
-                    for jcn in range(num_junctions):
-                        prefab = read_string(file)
-
-                        a = read_float(file)    # not known
-                        b = read_float(file)    # not known
-                        c = read_uint(file)     # 0x20 = U mirror, 0x40 = V mirror,
-                        print(f" > New jcn: {prefab} with {a}, {b} properties: {c}")
-
-                        # unused properties in stormregion_jcn initialiser are not known/used
-                        # in JCN type
-                        x = read_float(file)
-                        y = read_float(file)
-                        r1 = read_float(file)
-                        r2 = read_float(file)
-                        al = read_float(file)
-                        ar = read_float(file)
-                        itrp = read_float(file)
-                        r3 = read_float(file)
-                        jcn = read_uint(file)
-
-                        joint_count = read_uint(file)
-
-                        # tells which ROD5's are connected to
-                        # seems to be 12 connections per JCN, but only 4 or so max are used
-                        # how to know which is which?
-                        for i in range(joint_count):
-                            joint_ref = read_uint(file)
-                            joint_properties = read_char(file)
-
-                        jcn = stormregion_jcn(prefab, c, x, y, r1, r2, r3)
-                        map_file.junctions.append(jcn)
-
-                        c = read_uint(file)
-                        while c != stormregion_map.DATABLOCK_END and c != stormregion_map.DATABLOCK_NEXT:
-                            c = read_uint(file)
-
-
-                except:
-                    print("ERROR IN RODJ - tbc")
-                    exit()
-
-            elif kind == "ENTS":
-                ents_version = file.read(4).decode("utf-8")
-                print(f"ENTS version: {ents_version}")
-
-                current_pos = file.tell() + 8
-                for (kind, limit) in iter_chunks(file, limit):
-                    print(f" > Parsing {kind} length {limit-current_pos} limit {hex(limit)}") 
-                    current_pos = limit
-
-                    if kind == "DECS":
-                        # stickers on the terrain, basically
-                        num_deca = read_uint(file)
-
-                        for (kind, limit) in iter_chunks(file, limit):
-                            if kind == "DECA":  
-                                deca_version = file.read(4).decode("utf-8")
-                                deca_material = read_string(file)
-                                deca_x = read_uint(file)
-                                deca_y = read_uint(file)
-                                deca_rot_deg = read_uint(file) * 90
-                                #print(f"  > DECA: {deca_version}, {deca_material}, {deca_x}, {deca_y}, {deca_rot_deg}*")
-                                map_file.decals.append(stormregion_decal(deca_material, deca_x, deca_y, deca_rot_deg))
-
-                            else:
-                                print(f"Unknown DECS sub-node {kind}")
-                                exit(0)
-
-
-                    elif kind == "DODS":
-                        # objects - ()shader: multi-create)
-                        # does not subscribe to the same rules of iter_chunks -.-
-
-                        num_doods = read_uint(file)
-                        a = read_uint(file)
-                        b = read_uint(file)
-                        ff = read_uint(file)
-                        next = 0
-
-                        while True:
-                            if next == stormregion_map.DATABLOCK_END:
-                                break
-                            kind = file.read(4)                             # DOOD
-                            size = read_uint(file)
-                            dood_version = file.read(4).decode("utf-8")
-                            dood_object = read_string(file)                 # 4d file
-                            dood_x = read_float(file)                       # x
-                            dood_z = read_float(file)                        # z?
-                            dood_y = read_float(file)                       # y
-                            dood_r = read_float(file)                            # rot
-                            b = read_uint(file)
-                            c = read_uint(file)
-                            d = read_float(file)
-                            e = read_char(file)
-                            f = read_char(file)
-                            g = read_char(file)
-                            gb = read_ushort(file)
-                            next = read_uint(file)
-                            if next == 0x7fffffff or next == stormregion_map.DATABLOCK_END:
-                                #print(f"  > DOOD: {dood_version}, {dood_object}, {dood_x}, {dood_y}, {dood_z}, {dood_r}, {b}, {c}, {d}, {e}, {gb}")
-                                map_file.objects.append(stormregion_object(dood_object, dood_x, dood_y, dood_z, dood_r, 0))
-                                continue
-
-                            while (next != 0x7fffffff) and (next != stormregion_map.DATABLOCK_END):
-                                #print(f"  > DOOD: {dood_version}, {dood_object}, {dood_x}, {dood_y}, {dood_z}, {dood_r}, {b}, {c}, {d}, {e}, {gb}, {next}")
-                                map_file.objects.append(stormregion_object(dood_object, dood_x, dood_y, dood_z, dood_r, next))
-                                next = read_uint(file)
-                        
-
-                    elif kind == "EEFS":
-                        # effects
-                        pass
-
-
-                    elif kind == "UNDS":
-                        # units - mostly done
-
-                        for (kind, limit) in iter_chunks(file, limit):
-                            if kind == "UNTD":
-                                untd_version = file.read(4).decode("utf-8")
-                                parse_untd(file)
-
-                                #print(f"  > UNTD: {untd_version} ends -------------")
-
-
-                    elif kind == "AMBS":          
-                        next = read_uint(file)
-                        while next != stormregion_map.DATABLOCK_NEXT:
-                            next = read_uint(file)
-
-                        while next != stormregion_map.DATABLOCK_END:
-                            kind = read_kind(file)
-                            kindlen = read_uint(file)
-                            ambi_ver = file.read(4).decode("utf-8")
-                            sound = read_string(file)
-                            x = read_float(file)
-                            y = read_float(file)
-                            z = read_float(file)
-                            v = read_float(file)
-                            next = read_uint(file)
-                            if next == 0x7fffffff or next == stormregion_map.DATABLOCK_END:
-                                #print(f"  > {kind}: {ambi_ver} {sound} at {x}, {y}, {z} / {v}")
-                                map_file.ambient_sounds.append(stormregion_sfx(sound, x, y, z, v, 0))
-                                continue
-
-                            while (next != 0x7fffffff) and (next != stormregion_map.DATABLOCK_END):
-                                #print(f"  > {kind}: {ambi_ver} {sound} at {x}, {y}, {z} / {v}, {next}")
-                                map_file.ambient_sounds.append(stormregion_sfx(sound, x, y, z, v, next))
-                                next = read_uint(file)
+    next = file.read_uint()
 
+    while next != stormregion_map.DATABLOCK_NEXT:
+        next = file.read_uint()
 
-            elif kind == "RVR3":
-                # rivers, strangely enough
-                # similar to roads, with some more
-                print(f"> RVR3: Skipping rivers for now")
+    while next != stormregion_map.DATABLOCK_END:
+        # x, y, x, y describing the size of the box
+        (a, b, c, d) = file.read_struct(LOCS_BOX)
+        loc_name = file.read_string()
+        (color, next) = file.read_struct(LOCS_TAIL)     # color not known?
+        if trace.entity:
+            trace.emit("entity", "LOC", name=loc_name, box=(a, b, c, d), color=color)
+        loc = stormregion_loc(loc_name, a, b, c, d, color)
+        map_file.locations.append(loc)
 
+        while next != stormregion_map.DATABLOCK_END and next != stormregion_map.DATABLOCK_NEXT:
+            if trace.entity:
+                trace.emit("entity", "LOC", name=loc_name, extra=next)
+            next = file.read_uint()
 
-            elif kind == "TVAR":
-                # variables for scripting - DONE
-                num_slots = read_uint(file)
-                b = read_uint(file)
-                num_tvars = read_uint(file)
+    profiler.add_records(len(map_file.locations))
 
-                while next != stormregion_map.DATABLOCK_NEXT:
-                    next = read_uint(file)
 
-                for tvar in range(num_tvars):
-                    tvar_name = read_string(file)
-                    initial_value = read_uint(file)         # FFFFFFFF == -1 etc
-                    increment = read_uint(file)
+def parse_path(file, limit, map_file):
+    b = file.read_uint()             # if you create + delete slots, this number doesn't decrease with delete
+    a = file.read_uint()
+    num_paths = file.read_uint()     # this seems to be accurate to the number of slots
 
-                    map_file.tvars[tvar_name] = stormregion_tvar(tvar_name, initial_value, increment)
-                    print(f" > TVAR: {tvar_name}")
+    if num_paths == 0:
+        print(f" > PATH: none in file")
+        return
 
-                    if num_tvars > 1:
-                        next = read_uint(file)
-                
+    next = file.read_uint()
 
+    while next != stormregion_map.DATABLOCK_NEXT:
+        next = file.read_uint()
 
+    while next != stormregion_map.DATABLOCK_END:
+        path_name = file.read_string()
+        (a, c, nodes) = file.read_struct(PATH_HEADER)     # a always ff? c path index?
+        path_locs = list(file.iter_struct(PATH_NODE, nodes))
 
-            elif kind == "TRIG":
-                num_trig = read_uint(file)
+        path = stormregion_path(path_name, path_locs)
+        if trace.entity:
+            trace.emit("entity", "PATH", name=path_name, nodes=nodes)
+        map_file.paths.append(path)
+        next = file.read_uint()
 
-                continue
+        while next != stormregion_map.DATABLOCK_END and next != stormregion_map.DATABLOCK_NEXT:
+            if trace.entity:
+                trace.emit("entity", "PATH", name=path_name, extra=next)
+            next = file.read_uint()
 
-                # todo : need to parse each trigger action/condition according to its
-                #        type : good repetitive job for spare time kicking about
+    print(f"Loaded {len(map_file.paths)} PATH nodes")
+    profiler.add_records(len(map_file.paths))
 
-                for trig in range(num_trig):
-                    hdr = read_uint(file)
-                    trig_num = read_uint(file)   # 02 when enabled
-                    a = read_uint(file)          # 01 = normal, 02 = parallel
-                    trig_name = read_string(file)
-                    event_type = read_uint(file)          # event (0 = periodical, 4 = unit_attacked)
-                    # read payload according to type
 
-                    condition_count = read_uint(file)          # conditions
-                    # read payload according to type
-                    for condition in range(condition_count):
-                        condition = read_uint(file)
+def parse_hmap(file, limit, map_file):
+    map_file.size_x = file.read_uint() + 1
+    map_file.size_y = file.read_uint() + 1
+    print(f"   size {map_file.size_x} by {map_file.size_y}")     
 
-                    actions_count = read_uint(file)          # actions
-                    # read payload according to type
-                    for action in range(actions_count):
-                        action = read_uint(file)
+    # one read for the whole payload rather than one per vertex
+    values = file.read_array('f', map_file.size_x * map_file.size_y)
+    map_file.heightmap = decode_heightmap(values, map_file.size_x, map_file.size_y)
 
-                    print(f" > TRIG: {trig_num}, {trig_name}, {a} {b} {c} {d} {e} {hdr}")
-                
+    print(f" > HMAP Read {map_file.size_x * map_file.size_y} vertices")
+    profiler.add_records(map_file.size_x * map_file.size_y)
 
-            elif kind == "LOCS":
-                b = read_uint(file)
-                a = read_uint(file)
-                num_locs = read_uint(file)
 
-                if num_locs == 0:
-                    print(f" > LOCS: none in file")
-                    continue
+def parse_tlay(file, limit, map_file):
+    num_tlays = file.read_uint()
+    # layer IDS: 0 = normal, 2 = grass (read_string again), 1 = blocker, 4 = ford, 0x10 = only walker, mask 0x80 = invisible
 
-                next = read_uint(file)
+    for i in range(num_tlays):
+        layer = file.read_string()
+        layer_id = file.read_uint()
+        map_file.tlayers.append({"material": layer, "properties": layer_id})
 
-                while next != stormregion_map.DATABLOCK_NEXT:
-                    next = read_uint(file)
+    profiler.add_records(num_tlays)
+    print(f" > {map_file.tlayers}")
 
-                while next != stormregion_map.DATABLOCK_END:
-                    # x, y, x, y describing the size of the box
-                    a = read_uint(file)
-                    b = read_uint(file)
-                    c = read_uint(file)
-                    d = read_uint(file)
-                    loc_name = read_string(file)
-                    color = read_uint(file)     # not known?
-                    print(f" > LOC: {loc_name} {a} {b} {c} {d} {color}")
-                    loc = stormregion_loc(loc_name, a, b, c, d, color)
-                    map_file.locations.append(loc)
-                    next = read_uint(file)
 
-                    while next != stormregion_map.DATABLOCK_END and next != stormregion_map.DATABLOCK_NEXT:
-                        print(f" >      {next}")
-                        next = read_uint(file)
+def parse_blnd(file, limit, map_file):
+    # 1 byte per vertex 161x161 per tlayer, plane after plane
+    if map_file.size_x == 0 or map_file.size_y == 0:
+        raise IOError("BLND before HMAP, map dimensions not known yet")
 
+    num_planes = len(map_file.tlayers) - 1
+    plane_size = map_file.size_x * map_file.size_y
+    raw_data = file.read_array('B', num_planes * plane_size)
 
-            elif kind == "PATH":
-                b = read_uint(file)             # if you create + delete slots, this number doesn't decrease with delete
-                a = read_uint(file)
-                num_paths = read_uint(file)     # this seems to be accurate to the number of slots
+    for i in range(num_planes):
+        print(f" > BLEND: {map_file.tlayers[i]['material']}")
+
+    map_file.blend = decode_blend(raw_data, num_planes, map_file.size_x, map_file.size_y)
+    map_file.blend_mask = [map_file.is_textured_layer(map_file.tlayers[i]['properties']) for i in range(num_planes)]
+
+    print(f"Loaded {sum(map_file.blend_mask)} blend maps")
+    profiler.add_records(num_planes)
 
-                if num_paths == 0:
-                    print(f" > PATH: none in file")
-                    continue
 
-                next = read_uint(file)
+def parse_decs(file, limit, map_file):
+    # stickers on the terrain, basically
+    num_deca = file.read_uint()
 
-                while next != stormregion_map.DATABLOCK_NEXT:
-                    next = read_uint(file)
+    for (kind, limit) in iter_chunks(file, limit):
+        if kind == "DECA":  
+            deca_version = file.read(4).decode("utf-8")
+            deca_material = file.read_string()
+            deca_x = file.read_uint()
+            deca_y = file.read_uint()
+            deca_rot_deg = file.read_uint() * 90
+            #print(f"  > DECA: {deca_version}, {deca_material}, {deca_x}, {deca_y}, {deca_rot_deg}*")
+            map_file.decals.append_values(deca_material, deca_x, deca_y, deca_rot_deg)
 
-                while next != stormregion_map.DATABLOCK_END:
-                    path_name = read_string(file)
-                    a = read_char(file)     # always ff?
-                    c = read_uint(file)     # path index?
-                    nodes = read_uint(file)
-                    path_locs = []
+        else:
+            raise IOError(f"Unknown DECS sub-node {kind} before {hex(limit)}")
 
-                    for q in range(nodes):
-                        x = read_float(file)
-                        y = read_float(file)
-                        path_locs.append((x, y))
+    profiler.add_records(len(map_file.decals))
 
-                    path = stormregion_path(path_name, path_locs)
-                    print(f" > PATH: {path_name} with {nodes} nodes")
-                    map_file.paths.append(path)
-                    next = read_uint(file)
 
-                    while next != stormregion_map.DATABLOCK_END and next != stormregion_map.DATABLOCK_NEXT:
-                        print(next)
-                        next = read_uint(file)
-                
-                print(f"Loaded {len(map_file.paths)} PATH nodes")
+def parse_dods(file, limit, map_file):
+    # objects - ()shader: multi-create)
+    # does not subscribe to the same rules of iter_chunks -.-
 
+    num_doods = file.read_uint()
+    a = file.read_uint()
+    b = file.read_uint()
+    ff = file.read_uint()
+    next = 0
+
+    while True:
+        if next == stormregion_map.DATABLOCK_END:
+            profiler.add_records(len(map_file.objects))
+            break
+        (kind, size, dood_version) = file.read_struct(RECORD_HEADER)     # DOOD
+        dood_object = file.read_string()                                # 4d file
+        (dood_x, dood_z, dood_y, dood_r, b, c, d, e, f, g, gb, next) = file.read_struct(DOOD_RECORD)
+        if next == 0x7fffffff or next == stormregion_map.DATABLOCK_END:
+            #print(f"  > DOOD: {dood_version}, {dood_object}, {dood_x}, {dood_y}, {dood_z}, {dood_r}, {b}, {c}, {d}, {e}, {gb}")
+            map_file.objects.append_values(dood_object, dood_x, dood_y, dood_z, dood_r, 0)
+            continue
+
+        while (next != 0x7fffffff) and (next != stormregion_map.DATABLOCK_END):
+            #print(f"  > DOOD: {dood_version}, {dood_object}, {dood_x}, {dood_y}, {dood_z}, {dood_r}, {b}, {c}, {d}, {e}, {gb}, {next}")
+            map_file.objects.append_values(dood_object, dood_x, dood_y, dood_z, dood_r, next)
+            next = file.read_uint()
+
+
+def parse_unds(file, limit, map_file):
+    # units, with the units stored in them, into two tables (see parse_untd)
+    # assigned when done as both come from this one chunk
+    units = stormregion_table(UNIT_COLUMNS, map_file.strings)
+    fields = stormregion_table(UNIT_FIELD_COLUMNS, map_file.strings)
+
+    for (kind, limit) in iter_chunks(file, limit):
+        if kind == "UNTD":
+            untd_version = file.read(4).decode("utf-8")
+            parse_untd(file, limit, units, fields)
+
+            #print(f"  > UNTD: {untd_version} ends -------------")
+
+    map_file.units = units
+    map_file.unit_fields = fields
+
+    profiler.add_records(len(units))
+
+
+def parse_ambs(file, limit, map_file):
+    next = file.read_uint()
+    while next != stormregion_map.DATABLOCK_NEXT:
+        next = file.read_uint()
+
+    while next != stormregion_map.DATABLOCK_END:
+        (kind, kindlen, ambi_ver) = file.read_struct(RECORD_HEADER)
+        sound = file.read_string()
+        (x, y, z, v, next) = file.read_struct(AMBI_RECORD)
+        if next == 0x7fffffff or next == stormregion_map.DATABLOCK_END:
+            #print(f"  > {kind}: {ambi_ver} {sound} at {x}, {y}, {z} / {v}")
+            map_file.ambient_sounds.append_values(sound, x, y, z, v, 0)
+            continue
+
+        while (next != 0x7fffffff) and (next != stormregion_map.DATABLOCK_END):
+            #print(f"  > {kind}: {ambi_ver} {sound} at {x}, {y}, {z} / {v}, {next}")
+            map_file.ambient_sounds.append_values(sound, x, y, z, v, next)
+            next = file.read_uint()
+
+    profiler.add_records(len(map_file.ambient_sounds))
+
+
+def parse_terr(file, limit, map_file):
+    terr_version = file.read(4).decode("utf-8")
+    print(f"TERR version: {terr_version}")
+
+    current_pos = file.tell() + 8
+    for (kind, limit) in iter_chunks(file, limit):
+        print(f" > Parsing {kind} length {limit-current_pos} limit {hex(limit)}") 
+        current_pos = limit
+
+        if kind in TERR_CHUNKS:
+            TERR_CHUNKS[kind](file, limit, map_file)
+
+
+def parse_ents(file, limit, map_file):
+    ents_version = file.read(4).decode("utf-8")
+    print(f"ENTS version: {ents_version}")
+
+    current_pos = file.tell() + 8
+    for (kind, limit) in iter_chunks(file, limit):
+        print(f" > Parsing {kind} length {limit-current_pos} limit {hex(limit)}") 
+        current_pos = limit
+
+        if kind in ENTS_CHUNKS:
+            ENTS_CHUNKS[kind](file, limit, map_file)
+
+
+# Decoders for the sections of a map file, by chunk kind
+# each one is called with the reader at the start of the chunk data
+
+TERR_CHUNKS = {
+    "HMAP" : parse_hmap,
+    "TLAY" : parse_tlay,
+    "BLND" : parse_blnd,
+    # TMAP - not known
+    # DIFF - same length as HMAP exactly
+    # BLCK - big data set, 3.2mb
+}
+
+ENTS_CHUNKS = {
+    "DECS" : parse_decs,    # stickers on the terrain, basically
+    "DODS" : parse_dods,    # objects
+    "UNDS" : parse_unds,    # units
+    "AMBS" : parse_ambs,    # ambient sounds
+    # EEFS - effects
+}
+
+MAP_CHUNKS = {
+    "TPAM" : parse_tpam,
+    "INIM" : parse_inim,
+    "ATMS" : parse_atms,
+    "KSYB" : parse_ksyb,
+    "LRIA" : parse_lria,
+    "ISUM" : parse_isum,
+    "TERR" : parse_terr,
+    "3WHR" : parse_3whr,
+    "ROD5" : parse_rod5,
+    "RODJ" : parse_rodj,
+    "ENTS" : parse_ents,
+    "TVAR" : parse_tvar,
+    "TRIG" : parse_trig,
+    "LOCS" : parse_locs,
+    "PATH" : parse_path,
+}
+
+
+def parse_hmap_size(file, limit, map_file):
+    map_file.size_x = file.read_uint() + 1
+    map_file.size_y = file.read_uint() + 1
+
+
+class lazy_section:
+    '''
+    Attribute of stormregion_lazy_map that is decoded from its chunk the
+    first time it's used. The decoded value is stored on the instance,
+    which hides this descriptor from then on
+    '''
+
+    def __init__(self, path: str, parser, default = list, table: tuple = None):
+        self.path    = path
+        self.parser  = parser
+        self.default = default
+        self.table   = table        # columns, for sections decoded into a stormregion_table
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, map_file, owner = None):
+        if map_file is None:
+            return self
+
+        if self.table is not None:
+            setattr(map_file, self.name, stormregion_table(self.table, map_file.strings))
+        else:
+            setattr(map_file, self.name, self.default())
+
+        try:
+            map_file.parse_section(self.path, self.parser)
+        except Exception:
+            # don't leave the half decoded value behind, the next read raises again
+            del map_file.__dict__[self.name]
+            raise
+
+        return map_file.__dict__[self.name]
 
-            elif kind == "LRIA":
-                map_file.aircraft_type = read_string(file)
-                print(f"> LRIA, Airplanes type: {map_file.aircraft_type}")
-                
-            elif kind == "ISUM":
-                map_file.ambient_music = read_string(file)
-                print(f"> ISUM: ambient music: {map_file.ambient_music}")
+
+class stormregion_lazy_map(stormregion_map):
+    '''
+    A map that only decodes the header chunks when it's opened
+
+    Everything else (terrain, entities, roads, script data) is decoded
+    the first time it's used, straight from its chunk using the chunk index
+    '''
+
+    HEADER_CHUNKS = ("TPAM", "INIM", "ATMS", "KSYB", "LRIA", "ISUM")
+
+    size_x          = lazy_section("MAPF/TERR/HMAP", parse_hmap_size, int)
+    size_y          = lazy_section("MAPF/TERR/HMAP", parse_hmap_size, int)
+    heightmap       = lazy_section("MAPF/TERR/HMAP", parse_hmap)
+    tlayers         = lazy_section("MAPF/TERR/TLAY", parse_tlay)
+    blend           = lazy_section("MAPF/TERR/BLND", parse_blnd)
+    blend_mask      = lazy_section("MAPF/TERR/BLND", parse_blnd)
+
+    objects         = lazy_section("MAPF/ENTS/DODS", parse_dods, table=OBJECT_COLUMNS)
+    decals          = lazy_section("MAPF/ENTS/DECS", parse_decs, table=DECAL_COLUMNS)
+    ambient_sounds  = lazy_section("MAPF/ENTS/AMBS", parse_ambs, table=SFX_COLUMNS)
+    units           = lazy_section("MAPF/ENTS/UNDS", parse_unds, table=UNIT_COLUMNS)
+    unit_fields     = lazy_section("MAPF/ENTS/UNDS", parse_unds, table=UNIT_FIELD_COLUMNS)
+    locations       = lazy_section("MAPF/LOCS", parse_locs)
+    paths           = lazy_section("MAPF/PATH", parse_path)
+
+    roads           = lazy_section("MAPF/ROD5", parse_rod5)
+    junctions       = lazy_section("MAPF/RODJ", parse_rodj)
+
+    tvars           = lazy_section("MAPF/TVAR", parse_tvar, dict)
+
+
+    def __init__(self, path: str, file = None, save_index: bool = False):
+        super().__init__()
+
+        # drop the empty containers set up by stormregion_map, they would
+        # hide the lazy sections
+        for cls in type(self).__mro__:
+            for name, attr in vars(cls).items():
+                if isinstance(attr, lazy_section):
+                    self.__dict__.pop(name, None)
+
+        self.path  = path
+        self.file  = file if file is not None else stormregion_reader.open(path)
+        self.index = load_index(path, self.file, save_index)
+
+        if self.index.find("MAPF") is None:
+            raise IOError('Not a MAP file')
+
+        self.index.seek(self.file, "MAPF")
+        self.version = self.file.read_uint()
+
+        for kind in self.HEADER_CHUNKS:
+            self.parse_section(f"MAPF/{kind}", MAP_CHUNKS[kind])
+
+
+    def parse_section(self, path: str, parser):
+        '''
+        Run a chunk decoder on the chunk at path, if the map has one
+        '''
+
+        entry = self.index.find(path)
+        if entry is None:
+            return False
+
+        # decoders can read other lazy sections (eg. BLND needs the size and
+        # layers), which moves the shared file, so put it back afterwards
+        position = self.file.tell()
+        self.file.seek(entry.offset)
+        try:
+            parser(self.file, entry.offset + entry.size, self)
+        finally:
+            self.file.seek(position)
+        return True
+
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_map(path: str, save_index: bool = False):
+    '''
+    Open a map file without decoding it, see stormregion_lazy_map
+    '''
+
+    return stormregion_lazy_map(path, save_index=save_index)
+
+
+def parse_4d_model(filepath, file):
+    if file.read(8) != b'\x53\x72\x1A\x1B\x0D\x0A\x87\x0A':
+        raise IOError('Not a Stormregion file')
+
+    # Setup parsing context
+    ctx = ParsingContext()
+    ctx.folder = os.path.dirname(filepath)
+
+    # Create root object representing the model
+    #root = bpy.data.objects.new('4d_model', None)
+    
+    #root.empty_display_type = 'CIRCLE'
+    #root.empty_display_size = 1
+
+    # Rotate root object to compensate some the wacky coordinate system
+    #root.rotation_euler = (math.radians(90), 0, 0)
+
+    # Add to parsing context, everything will be parented to this
+    #ctx.objects.append(root)
+    #ctx.parents.append(None)
+
+    map_file = None
+
+    # ONE section should follow immediately
+    for (kind, limit) in iter_chunks(file, 128):
+        if kind == 'SCEN':
+            print("MODEL file")
+            ctx.file_version = file.read(4).decode("utf-8")
+            print(f"SCEN version {ctx.file_version}")
+
+
+        elif kind == "MAPF":
+            print("MAP file")
+            map_file = stormregion_map()
+            map_file.map_name = os.path.splitext(os.path.basename(filepath))[0]
+            ctx.file_version = file.read_uint()
+            print(f"MAP version {ctx.file_version}")
+            map_file.version = ctx.file_version
+        
+        elif kind == 'CANM':
+            ctx.file_version = file.read(4).decode("utf-8")
+            a = file.read_float()
+            b = file.read_float()
+            c = file.read_float()
+            print(f"ANIM file CANM {ctx.file_version} with {a}, {b}, {c}")
+        
+        previous_limit = 0
+        for (kind, limit) in iter_chunks(file, limit):
+            if trace.chunk:
+                trace.emit("chunk", kind, size=limit - previous_limit, limit=limit)
+            length = limit - previous_limit
+            previous_limit = limit
+
+            if kind == 'MESH' or kind == "DUMY" or kind == "SKVS" or kind == "BSP_" or kind == "NODE":
+                parse_object(file, limit, ctx, kind)
+
+            elif kind == "SSQS":
+                parse_anims(file, limit, ctx)
+
+            elif kind == "FLYZ":
+                print("Ignoring FLYZ")
+
+
+            # -------  map files -----------
+
+            elif kind in MAP_CHUNKS:
+                MAP_CHUNKS[kind](file, limit, map_file)
+
+            elif kind == "MINA":
+                # 2 bytes == 00
+                pass
+
+            elif kind == "MINI":
+                # mini map ??
+                pass
+
+            elif kind == "RVR3":
+                # rivers, strangely enough
+                # similar to roads, with some more
+                print(f"> RVR3: Skipping rivers for now")
 
             else:
                 print(f'Unsupported scene entry of type {kind}')
@@ -1587,43 +2550,136 @@ def parse_4d_model(filepath, file):
             
             
     print("END OF SCENE")
-    map_file.crop_to(37, 140, 32, 140)
-    map_file.export_heightmap_to_raw("output.raw", padding_height=-4)
-    map_file.export_splatmaps("a")
-    
+
     # Restore parent hierarchy between the objects
     for idx, obj in enumerate(ctx.objects):
         #bpy.context.scene.collection.objects.link(obj)
 
         parentID = ctx.parents[idx]
 
-        print(f"Pair object to ID {parentID}")
-
-        print(ctx.objects)
+        if trace.object:
+            trace.emit("object", "parent", index=idx, parent=parentID)
         
         if parentID is not None:  
             pass      
             #obj.parent      = ctx.objects[parentID +1]
             #obj.parent_type = 'OBJECT'
 
-    for object in bones_by_object:
-        print(f"Object {object}")
+    if trace.bone:
+        for object in ctx.bones_by_object:
+            for bone_idx in ctx.bones_by_object[object]:
+                trace.emit("bone", "link", object=object, bone=bone_idx, dummy=ctx.dummies[bone_idx-1],
+                           matrix=ctx.bones_by_object[object][bone_idx][:3], pos=ctx.bones_by_object[object][bone_idx][3])
 
-        for bone_idx in bones_by_object[object]:
-            print(f"Linked bone number {bone_idx} with dummy {dummies[bone_idx-1]}")
-            print(bones_by_object[object][bone_idx][0])
-            print(bones_by_object[object][bone_idx][1])
-            print(bones_by_object[object][bone_idx][2])
-            print(bones_by_object[object][bone_idx][3])
-            
-    return {'FINISHED'}
+    # None for models and animations
+    return map_file
+
+
+def convert_map(path: str, output_dir: str = ".", crop: tuple = None, padding_height: float = -4,
+                heightmap_formats: tuple = ("raw",), splatmaps: bool = True, stream: bool = False,
+                tile_size: int = None, tile_overlap: int = 1, lod_min_size: int = None, lod_filter: str = "decimate",
+                cache: bool = False, cache_dir: str = None, roads: bool = False, bake: bool = False,
+                instances: bool = False):
+    '''
+    Parse a map file and write its exports to output_dir:
+
+        heightmap.raw/.png/.r32 - see export_heightmap
+        splat.png, splat2.png.. - see export_splatmaps
+        <map>_texture_array.png
+
+    crop is (x1, x2, y1, y2) in heightmap vertices, see crop_to
+
+    With tile_size the terrain is written as a grid of tiles with a tiles.json
+    manifest instead, see export_tiles
+
+    With lod_min_size lower detail levels down to that size are written as well,
+    see export_lods
+
+    With roads the roads and junctions are written as meshes to roads.gltf,
+    see export_roads
+
+    With instances the objects and decals are written as instance buffers per
+    model/material with an instances.json manifest, see export_instances
+
+    With bake the roads, junctions and decals are added to the splatmaps as
+    extra layers, see bake_overlays
+
+    With cache the parsed map is kept in a binary cache (next to the map, or in
+    cache_dir) and later runs load it from there, see stormregion_cache
+
+    With stream the terrain is exported a few rows at a time without decoding
+    it (see stormregion_stream), for maps too big to fit in memory
+
+    Returns the parsed map, raises an IOError if the file isn't a map
+    '''
+
+    if stream and (tile_size or lod_min_size or roads or bake or instances):
+        raise ValueError("Tiled, LOD, road, baked and instance exports can't be streamed yet")
+
+    if stream:
+        from stormregion_stream import stream_convert_map
+        return stream_convert_map(path, output_dir, crop, padding_height, heightmap_formats, splatmaps)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if cache:
+        from stormregion_cache import load_map
+
+        with profiler.stage("parse"):
+            map_file = load_map(path, cache_dir)
+
+    else:
+        with stormregion_reader.open(path, debug_print) as file, profiler.stage("parse"):
+            map_file = parse_4d_model(path, file)
+
+        if map_file is None:
+            raise IOError(f"{path} is not a map file")
+
+    if crop is not None:
+        map_file.crop_to(*crop)
+
+    if bake and splatmaps:
+        map_file.bake_overlays()
+
+    if tile_size:
+        map_file.export_tiles(output_dir, tile_size, tile_overlap, heightmap_formats, splatmaps, padding_height)
+    else:
+        map_file.export_heightmap({fmt: os.path.join(output_dir, f"heightmap.{fmt}") for fmt in heightmap_formats}, padding_height)
+
+        if splatmaps:
+            map_file.export_splatmaps(output_dir)
+
+    if lod_min_size:
+        map_file.export_lods(output_dir, lod_min_size, lod_filter, heightmap_formats, splatmaps, padding_height)
+
+    if roads:
+        map_file.export_roads(output_dir)
+
+    if instances:
+        map_file.export_instances(output_dir)
+
+    return map_file
 
 
 
 
 if __name__ == "__main__":
-    with open(sys.argv[1], 'rb') as file:
-        parse_4d_model(sys.argv[1], file)
+    if sys.argv[1] == "--header":
+        # header metadata only, one JSON line per map
+        for path in sys.argv[2:]:
+            with open_map(path) as map_file:
+                print(json.dumps({"file": path, **map_file.get_header()}))
+        sys.exit(0)
+
+    if os.path.splitext(sys.argv[1])[1].lower() == ".map":
+        # exports go to the folder given after the map, the working directory otherwise
+        convert_map(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else ".")
+    else:
+        with stormregion_reader.open(sys.argv[1], debug_print) as file:
+            parse_4d_model(sys.argv[1], file)
+
+    # only if STORMREGION_PROFILE is set
+    profiler.save(file=sys.argv[1])
 
     # Trigger import action immediately
     # bpy.ops.import_4d.model('INVOKE_DEFAULT')
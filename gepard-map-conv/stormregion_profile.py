@@ -0,0 +1,217 @@
+import functools
+import json
+import os
+import threading
+import time
+
+'''
+Where the time goes when parsing and exporting
+
+Opt-in, when it's enabled iter_chunks times every chunk it hands out
+(inclusive of the chunks nested in it) and keeps the bytes and number of
+records (vertices, objects, roads...) per chunk path, eg. MAPF/ENTS/DODS.
+Export steps are timed as stages. All of it is written as one JSON report.
+
+When it's disabled the parsers pay one bool check per iter_chunks call.
+
+    STORMREGION_PROFILE=report.json     enable and write the report there
+
+The same file is shipped with the Blender addon (io_scene_stormregion), keep
+the two copies in sync.
+'''
+
+
+class stormregion_profiler:
+    '''
+    Totals per chunk path and per export stage
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.output_filename = None
+        self.lock  = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+
+    def enable(self, output_filename: str = None):
+        self.enabled = True
+        self.output_filename = output_filename
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.chunks  = {}       # path -> [kind, count, bytes, seconds, records]
+            self.stages  = {}       # name -> [count, seconds]
+            self.started = time.perf_counter()
+
+
+    def configure_from_env(self):
+        output_filename = os.environ.get("STORMREGION_PROFILE")
+        if output_filename:
+            self.enable(output_filename)
+
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+
+    def iter_chunks(self, file, limit):
+        '''
+        iter_chunks with timing, the time between handing out a chunk and
+        being asked for the next one is what the caller spent on it
+        '''
+
+        stack = self._stack()
+
+        while file.tell() < limit:
+            kind = file.read_kind()
+            size = file.read_uint()
+
+            last = file.tell() + size
+            path = f"{stack[-1][0]}/{kind}" if stack else kind
+
+            # [path, records]
+            frame = [path, 0]
+            stack.append(frame)
+            start = time.perf_counter()
+
+            try:
+                yield (kind, last)
+            finally:
+                seconds = time.perf_counter() - start
+                stack.pop()
+
+                with self.lock:
+                    stats = self.chunks.get(path)
+                    if stats is None:
+                        stats = self.chunks[path] = [kind, 0, 0, 0.0, 0]
+                    stats[1] += 1
+                    stats[2] += size
+                    stats[3] += seconds
+                    stats[4] += frame[1]
+
+            file.seek(last)
+
+
+    def add_records(self, count: int):
+        '''
+        Count records (vertices, objects...) against the chunk being parsed
+        '''
+
+        if not self.enabled:
+            return
+
+        stack = self._stack()
+        if stack:
+            stack[-1][1] += count
+
+
+    def stage(self, name: str):
+        '''
+        Context manager timing an export step
+        '''
+
+        return _stage_timer(self, name)
+
+
+    def report(self):
+        '''
+        The totals as a dict, per chunk path (sorted by time) and per chunk kind
+        '''
+
+        with self.lock:
+            chunks = []
+            kinds = {}
+
+            for path, (kind, count, size, seconds, records) in self.chunks.items():
+                chunks.append({
+                    "path"      : path,
+                    "kind"      : kind,
+                    "count"     : count,
+                    "bytes"     : size,
+                    "records"   : records,
+                    "seconds"   : seconds,
+                    "mb_per_s"  : (size / seconds / 1e6) if seconds > 0 else None,
+                })
+
+                # nested paths of the same kind would be counted twice
+                totals = kinds.setdefault(kind, {"count": 0, "bytes": 0, "records": 0, "seconds": 0.0})
+                if f"/{kind}/" not in f"/{path.rsplit('/', 1)[0]}/":
+                    totals["count"]   += count
+                    totals["bytes"]   += size
+                    totals["records"] += records
+                    totals["seconds"] += seconds
+
+            chunks.sort(key=lambda chunk: chunk["seconds"], reverse=True)
+
+            return {
+                "seconds"   : time.perf_counter() - self.started,
+                "chunks"    : chunks,
+                "kinds"     : kinds,
+                "stages"    : {name: {"count": count, "seconds": seconds} for name, (count, seconds) in self.stages.items()},
+            }
+
+
+    def save(self, output_filename: str = None, **extra):
+        '''
+        Write the report as JSON, extra is added at the top level (file name etc)
+        '''
+
+        output_filename = output_filename or self.output_filename
+        if not output_filename:
+            return
+
+        with open(output_filename, "w") as fp:
+            json.dump({**extra, **self.report()}, fp, indent=1)
+
+        print(f"Profile written to {output_filename}")
+
+
+class _stage_timer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        if self.profiler.enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if not self.profiler.enabled:
+            return
+
+        seconds = time.perf_counter() - self.start
+        with self.profiler.lock:
+            stats = self.profiler.stages.setdefault(self.name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+
+def profile_stage(name: str):
+    '''
+    Decorator, times every call of a function as a stage
+    '''
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not profiler.enabled:
+                return function(*args, **kwargs)
+
+            with profiler.stage(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+profiler = stormregion_profiler()
+profiler.configure_from_env()
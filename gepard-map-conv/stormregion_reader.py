@@ -0,0 +1,253 @@
+import mmap
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Reader for Gepard files (maps, models, anims)
+
+The whole file is memory mapped and decoded with precompiled structs straight
+from the mapping, so reading a field doesn't cost a read() syscall or a new
+bytes object. Bulk data (HMAP, BLND, vertex buffers) can be taken as arrays
+which are views onto the mapping rather than copies.
+
+The same file is shipped with the Blender addon (io_scene_stormregion), keep
+the two copies in sync.
+'''
+
+STRING_LIMIT = 4096
+
+_char   = struct.Struct('<B')
+_uint   = struct.Struct('<I')
+_sint   = struct.Struct('<i')
+_ushort = struct.Struct('<H')
+_float  = struct.Struct('<f')
+_vecs   = { 2: struct.Struct('<2f'), 3: struct.Struct('<3f'), 4: struct.Struct('<4f') }
+
+
+class stormregion_reader:
+    '''
+    Cursor over a memory mapped (or in-memory) Gepard file
+
+    Mostly a drop in for a file opened with 'rb': read(), readinto(), tell()
+    and seek() behave the same, plus typed readers for the fields used
+    by the formats
+    '''
+
+    def __init__(self, data, path: str = None):
+        self.path = path
+        self.data = data
+        self.view = memoryview(data)
+        self.size = len(self.view)
+        self.pos  = 0
+        self._mmap = data if isinstance(data, mmap.mmap) else None
+
+
+    @classmethod
+    def open(cls, path: str, debug: bool = False):
+        '''
+        Map a file for reading, use debug to print every field as it is read
+        '''
+
+        if debug:
+            cls = stormregion_debug_reader
+
+        with open(path, 'rb') as file:
+            try:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files can't be mapped
+                data = file.read()
+
+        return cls(data, path)
+
+
+    def close(self):
+        '''
+        Release the mapping. Arrays returned by read_array() still reference
+        it, in that case it's left for the garbage collector to unmap
+        '''
+
+        try:
+            self.view.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos: int, whence: int = 0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.size
+        self.pos = pos
+        return pos
+
+    def skip(self, length: int):
+        self.pos += length
+
+
+    def read(self, length: int = -1):
+        if length < 0:
+            length = self.size - self.pos
+        raw_data = self.data[self.pos:self.pos + length]
+        self.pos += len(raw_data)
+        return raw_data
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.pos)
+        buffer[:length] = self.view[self.pos:self.pos + length]
+        self.pos += length
+        return length
+
+
+    def read_kind(self):
+        raw_data = self.data[self.pos:self.pos + 4]
+        self.pos += 4
+        return raw_data.decode()
+
+    def read_char(self):
+        value = _char.unpack_from(self.data, self.pos)[0]
+        self.pos += 1
+        return value
+
+    def read_uint(self):
+        value = _uint.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def read_sint(self):
+        value = _sint.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def read_ushort(self):
+        value = _ushort.unpack_from(self.data, self.pos)[0]
+        self.pos += 2
+        return value
+
+    def read_float(self):
+        value = _float.unpack_from(self.data, self.pos)[0]
+        self.pos += 4
+        return value
+
+    def read_string(self):
+        length = _ushort.unpack_from(self.data, self.pos)[0]
+        if length > STRING_LIMIT:
+            raise IOError(f'String too long ({length} bytes) at {hex(self.pos)}')
+
+        start = self.pos + 2
+        self.pos = start + length
+        return self.data[start:self.pos].decode()
+
+    def read_vec(self, components: int):
+        fmt = _vecs.get(components)
+        if fmt is None:
+            fmt = _vecs[components] = struct.Struct(f'<{components}f')
+
+        value = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return value
+
+
+    def read_struct(self, fmt: struct.Struct):
+        '''
+        Read one fixed layout record, fmt should be a precompiled struct.Struct
+        '''
+
+        value = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return value
+
+    def iter_struct(self, fmt: struct.Struct, count: int):
+        '''
+        Read a run of count fixed layout records
+        '''
+
+        end = self.pos + (fmt.size * count)
+        records = fmt.iter_unpack(self.view[self.pos:end])
+        self.pos = end
+        return records
+
+
+    def read_array(self, dtype: str, count: int):
+        '''
+        Read count values of a struct type code ('B', 'H', 'I', 'i', 'f')
+        without copying
+
+        Returns a read-only NumPy array if available, otherwise a memoryview
+        (or an array.array on big endian machines, which has to be swapped)
+        '''
+
+        length = struct.calcsize(dtype) * count
+
+        if self.pos + length > self.size:
+            raise IOError(f'Array of {count} {dtype} at {hex(self.pos)} runs past the end of the file')
+
+        start = self.pos
+        self.pos += length
+
+        if np is not None:
+            return np.frombuffer(self.view, dtype=f'<{dtype}', count=count, offset=start)
+
+        if sys.byteorder != "little":
+            from array import array
+
+            values = array(dtype)
+            values.frombytes(self.view[start:start + length])
+            values.byteswap()
+            return values
+
+        return self.view[start:start + length].cast(dtype)
+
+
+class stormregion_debug_reader(stormregion_reader):
+    '''
+    Prints the raw bytes of every field that is read, slow
+    '''
+
+    def _dump(self, tag: str, length: int):
+        print(f"++{tag} " + bytes(self.view[self.pos:self.pos + length]).hex())
+
+    def read_kind(self):
+        self._dump("K", 4)
+        return super().read_kind()
+
+    def read_uint(self):
+        self._dump("U", 4)
+        return super().read_uint()
+
+    def read_sint(self):
+        self._dump("I", 4)
+        return super().read_sint()
+
+    def read_ushort(self):
+        self._dump("S", 2)
+        return super().read_ushort()
+
+    def read_float(self):
+        self._dump("F", 4)
+        return super().read_float()
+
+    def read_string(self):
+        length = _ushort.unpack_from(self.data, self.pos)[0]
+        self._dump("S", 2 + length)
+        return super().read_string()
@@ -0,0 +1,483 @@
+import json
+import math
+import os
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, roads are sampled one point at a time instead
+    np = None
+
+from stormregion_def import stormregion_road
+
+'''
+Road geometry from the ROD5/RODJ control data
+
+Each road is a Catmull-Rom spline through its nodes, sampled every
+tesselation metres. Every sample gets 3 vertices across the road (left edge,
+centre, right edge) and the samples are joined into a left and a right strip,
+so the mesh follows the terrain across the road as well as along it:
+
+    left edge  = centre + r1 to the left
+    right edge = centre + r2 to the right
+    U          = 0 left .. 0.5 centre .. 1 right, V = distance / road width
+    COLOR_0    = alpha_l, 1, alpha_r as the alpha of the 3 vertices
+
+Junctions are a fan of JUNCTION_SIDES triangles, max(r1, r2) around the
+junction, with the texture mapped flat over it. U_MIRROR/V_MIRROR in config
+flip the U/V. What r1/r2/r3 and the alphas mean exactly isn't confirmed yet
+(r3 and interp aren't used), adjust here if roads don't line up in game.
+
+With numpy every road of the map is sampled and meshed at once. The meshes
+(one per material) are written as a glTF file with indexed buffers, in
+world units with glTF's Y up: (x, height, y).
+'''
+
+U_MIRROR = stormregion_road.U_MIRROR
+V_MIRROR = stormregion_road.V_MIRROR
+
+JUNCTION_SIDES = 16
+
+# points per segment used to measure the length of the spline
+LENGTH_SAMPLES = 8
+
+# most samples per segment, whatever the tesselation distance says
+MAX_SEGMENT_SAMPLES = 1024
+
+
+def catmull_rom(p0, p1, p2, p3, t):
+    '''
+    Point and tangent on the segment from p1 to p2, works on floats and
+    on numpy arrays alike
+    '''
+
+    a = 2 * p1
+    b = p2 - p0
+    c = (2 * p0) - (5 * p1) + (4 * p2) - p3
+    d = (3 * p1) - p0 - (3 * p2) + p3
+
+    point = 0.5 * (a + (b * t) + (c * t * t) + (d * t * t * t))
+    tangent = 0.5 * (b + (2 * c * t) + (3 * d * t * t))
+
+    return (point, tangent)
+
+
+def segment_samples(length: float, tesselation: float):
+    if tesselation <= 0 or length <= 0:
+        return 1
+    return min(MAX_SEGMENT_SAMPLES, max(1, math.ceil(length / tesselation)))
+
+
+def sample_roads(roads: list):
+    '''
+    Points along every road, as a dict of equal length arrays (lists without numpy):
+
+        road        - index of the road in roads
+        x, y        - position on the centre line
+        nx, ny      - unit vector to the left of the road
+        r1, r2      - left and right width, alpha_l, alpha_r
+        distance    - along the road from its first node
+    '''
+
+    names = ("road", "x", "y", "nx", "ny", "r1", "r2", "alpha_l", "alpha_r", "distance")
+
+    if np is not None:
+        return _sample_roads_np(roads, names)
+
+    samples = {name: [] for name in names}
+
+    for road_index, road in enumerate(roads):
+        nodes = list(road.nodes)
+        if len(nodes) < 2:
+            continue
+
+        points = []
+        for i in range(len(nodes) - 1):
+            controls = [nodes[max(0, i - 1)], nodes[i], nodes[i + 1], nodes[min(len(nodes) - 1, i + 2)]]
+            (x0, x1, x2, x3) = [float(node.x) for node in controls]
+            (y0, y1, y2, y3) = [float(node.y) for node in controls]
+
+            length = 0.0
+            previous = None
+            for j in range(LENGTH_SAMPLES + 1):
+                t = j / LENGTH_SAMPLES
+                point = (catmull_rom(x0, x1, x2, x3, t)[0], catmull_rom(y0, y1, y2, y3, t)[0])
+                if previous is not None:
+                    length += math.hypot(point[0] - previous[0], point[1] - previous[1])
+                previous = point
+
+            count = segment_samples(length, float(road.tesselation))
+            last = i == len(nodes) - 2
+            for j in range(count + (1 if last else 0)):
+                points.append((i, j / count, x0, x1, x2, x3, y0, y1, y2, y3))
+
+        distance = 0.0
+        previous = None
+        for (i, t, x0, x1, x2, x3, y0, y1, y2, y3) in points:
+            (x, dx) = catmull_rom(x0, x1, x2, x3, t)
+            (y, dy) = catmull_rom(y0, y1, y2, y3, t)
+            length = math.hypot(dx, dy)
+            (nx, ny) = (-dy / length, dx / length) if length > 1e-9 else (0.0, 1.0)
+
+            if previous is not None:
+                distance += math.hypot(x - previous[0], y - previous[1])
+            previous = (x, y)
+
+            (start, end) = (nodes[i], nodes[i + 1])
+            samples["road"].append(road_index)
+            samples["x"].append(x)
+            samples["y"].append(y)
+            samples["nx"].append(nx)
+            samples["ny"].append(ny)
+            for name in ("r1", "r2", "alpha_l", "alpha_r"):
+                samples[name].append(float(getattr(start, name)) + ((float(getattr(end, name)) - float(getattr(start, name))) * t))
+            samples["distance"].append(distance)
+
+    return samples
+
+
+def _sample_roads_np(roads: list, names: tuple):
+    node_columns = ("x", "y", "r1", "r2", "alpha_l", "alpha_r")
+
+    counts = np.array([len(road.nodes) for road in roads], dtype=np.int64)
+    used = np.flatnonzero(counts >= 2)
+
+    if len(used) == 0:
+        return {name: np.zeros(0, dtype=np.int64 if name == "road" else np.float64) for name in names}
+
+    # the nodes of every road one after the other
+    nodes = {name: np.concatenate([roads[i].nodes.column(name).astype(np.float64) for i in used]) for name in node_columns}
+    starts = np.concatenate(([0], np.cumsum(counts[used])[:-1]))
+    ends = starts + counts[used]
+
+    # segment i of a road goes from node i to i + 1, the controls on either side are clamped to the road
+    segment_counts = counts[used] - 1
+    segment_road = np.repeat(np.arange(len(used)), segment_counts)
+    segment_node = np.arange(int(segment_counts.sum())) + np.repeat(starts - np.concatenate(([0], np.cumsum(segment_counts)[:-1])), segment_counts)
+    controls = (np.maximum(segment_node - 1, starts[segment_road]), segment_node,
+                segment_node + 1, np.minimum(segment_node + 2, ends[segment_road] - 1))
+
+    def evaluate(segments, t):
+        xs = [nodes["x"][control[segments]] for control in controls]
+        ys = [nodes["y"][control[segments]] for control in controls]
+        return (catmull_rom(*xs, t), catmull_rom(*ys, t))
+
+    # length of each segment from a few points along it
+    t = np.linspace(0, 1, LENGTH_SAMPLES + 1)
+    everywhere = np.repeat(np.arange(len(segment_node)), len(t))
+    ((x, dx), (y, dy)) = evaluate(everywhere, np.tile(t, len(segment_node)))
+    steps = np.hypot(np.diff(x.reshape(-1, len(t))), np.diff(y.reshape(-1, len(t))))
+    lengths = steps.sum(axis=1)
+
+    tesselation = np.array([float(roads[i].tesselation) for i in used])[segment_road]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_segment = np.where((tesselation > 0) & (lengths > 0), np.ceil(lengths / tesselation), 1)
+    per_segment = np.clip(per_segment, 1, MAX_SEGMENT_SAMPLES).astype(np.int64)
+
+    # samples at t = j / count of each segment, plus t = 1 at the end of every road
+    segments = np.repeat(np.arange(len(segment_node)), per_segment)
+    t = (np.arange(len(segments)) - np.repeat(np.cumsum(per_segment) - per_segment, per_segment)) / np.repeat(per_segment, per_segment)
+
+    last_segments = np.cumsum(segment_counts) - 1
+    segments = np.concatenate((segments, last_segments))
+    t = np.concatenate((t, np.ones(len(last_segments))))
+    order = np.lexsort((t, segments))
+    (segments, t) = (segments[order], t[order])
+
+    ((x, dx), (y, dy)) = evaluate(segments, t)
+    length = np.hypot(dx, dy)
+    flat = length <= 1e-9
+    length[flat] = 1.0
+    nx = np.where(flat, 0.0, -dy / length)
+    ny = np.where(flat, 1.0, dx / length)
+
+    road = segment_road[segments]
+    steps = np.zeros(len(x))
+    steps[1:] = np.hypot(np.diff(x), np.diff(y)) * (road[1:] == road[:-1])
+    distance = np.cumsum(steps)
+    first = np.flatnonzero(np.concatenate(([True], road[1:] != road[:-1])))
+    distance -= np.repeat(distance[first], np.diff(np.append(first, len(x))))
+
+    samples = {"road": used[road], "x": x, "y": y, "nx": nx, "ny": ny, "distance": distance}
+    for name in ("r1", "r2", "alpha_l", "alpha_r"):
+        start = nodes[name][controls[1][segments]]
+        end = nodes[name][controls[2][segments]]
+        samples[name] = start + ((end - start) * t)
+
+    return samples
+
+
+def road_meshes(map_file, roads: list = None, height_offset: float = 0.05):
+    '''
+    One mesh per road material, see mesh_buffers for the layout
+    '''
+
+    roads = map_file.roads if roads is None else roads
+    samples = sample_roads(roads)
+    meshes = []
+
+    for material in sorted(set(road.material for road in roads)):
+        selected = [i for i, road in enumerate(roads) if road.material == material]
+        mesh = _strip_mesh(map_file, roads, samples, selected, height_offset)
+        if mesh is not None:
+            meshes.append((material, mesh))
+
+    return meshes
+
+
+def _strip_mesh(map_file, roads: list, samples: dict, selected: list, height_offset: float):
+    # 3 vertices per sample (left, centre, right), 4 triangles between 2 samples of the same road
+    if np is not None:
+        keep = np.isin(samples["road"], selected)
+        if not keep.any():
+            return None
+
+        s = {name: values[keep] for name, values in samples.items()}
+        count = len(s["x"])
+
+        across = np.stack((s["r1"], np.zeros(count), -s["r2"]), axis=1)
+        xs = s["x"][:, None] + (s["nx"][:, None] * across)
+        ys = s["y"][:, None] + (s["ny"][:, None] * across)
+        heights = map_file.height_at(xs.ravel(), ys.ravel()) + height_offset
+
+        config = np.array([road.config for road in roads])[s["road"]]
+        widths = np.array([_road_width(road) for road in roads])[s["road"]]
+
+        u = np.tile([0.0, 0.5, 1.0], (count, 1))
+        u = np.where((config & U_MIRROR)[:, None] != 0, 1.0 - u, u)
+        v = np.repeat((s["distance"] / widths)[:, None], 3, axis=1)
+        v = np.where((config & V_MIRROR)[:, None] != 0, -v, v)
+
+        alpha = np.stack((s["alpha_l"], np.ones(count), s["alpha_r"]), axis=1)
+
+        joined = np.flatnonzero(s["road"][1:] == s["road"][:-1]) * 3
+        quads = np.array([[1, 0, 4], [0, 3, 4], [1, 4, 2], [2, 4, 5]])
+        indices = (joined[:, None, None] + quads[None]).ravel()
+
+        positions = np.stack((xs.ravel(), heights, ys.ravel()), axis=1)
+        uvs = np.stack((u.ravel(), v.ravel()), axis=1)
+        colors = np.concatenate((np.ones((count * 3, 3)), alpha.reshape(-1, 1)), axis=1)
+
+        return mesh_buffers(positions, uvs, colors, indices)
+
+    rows = [i for i, road in enumerate(samples["road"]) if road in selected]
+    if not rows:
+        return None
+
+    xs = []
+    ys = []
+    for i in rows:
+        for width in (samples["r1"][i], 0.0, -samples["r2"][i]):
+            xs.append(samples["x"][i] + (samples["nx"][i] * width))
+            ys.append(samples["y"][i] + (samples["ny"][i] * width))
+    heights = map_file.height_at(xs, ys)
+
+    positions = []
+    uvs = []
+    colors = []
+    indices = []
+
+    for n, i in enumerate(rows):
+        road = roads[samples["road"][i]]
+        v = samples["distance"][i] / _road_width(road)
+        if road.config & V_MIRROR:
+            v = -v
+
+        for k, (u, alpha) in enumerate(((0.0, samples["alpha_l"][i]), (0.5, 1.0), (1.0, samples["alpha_r"][i]))):
+            positions.append((xs[(n * 3) + k], heights[(n * 3) + k] + height_offset, ys[(n * 3) + k]))
+            uvs.append((1.0 - u if road.config & U_MIRROR else u, v))
+            colors.append((1.0, 1.0, 1.0, alpha))
+
+        if n > 0 and samples["road"][rows[n - 1]] == samples["road"][i]:
+            base = (n - 1) * 3
+            for quad in ((1, 0, 4), (0, 3, 4), (1, 4, 2), (2, 4, 5)):
+                indices.extend(base + corner for corner in quad)
+
+    return mesh_buffers(positions, uvs, colors, indices)
+
+
+def _road_width(road):
+    # the texture repeats every road width along the road
+    if np is not None:
+        width = float(np.mean(road.nodes.column("r1") + road.nodes.column("r2"))) if len(road.nodes) else 0.0
+    else:
+        width = sum(float(node.r1) + float(node.r2) for node in road.nodes) / max(1, len(road.nodes))
+    return width if width > 0 else 1.0
+
+
+def junction_meshes(map_file, junctions: list = None, height_offset: float = 0.05, sides: int = JUNCTION_SIDES):
+    '''
+    One mesh per junction material, a fan around each junction
+    '''
+
+    junctions = map_file.junctions if junctions is None else junctions
+    meshes = []
+
+    for material in sorted(set(jcn.material for jcn in junctions)):
+        selected = [jcn for jcn in junctions if jcn.material == material]
+        meshes.append((material, _fan_mesh(map_file, selected, height_offset, sides)))
+
+    return meshes
+
+
+def _fan_mesh(map_file, junctions: list, height_offset: float, sides: int):
+    # centre vertex then the ring, counter clockwise
+    angles = [2 * math.pi * i / sides for i in range(sides)]
+    ring_u = [0.0] + [0.5 + (0.5 * math.cos(angle)) for angle in angles]
+    ring_v = [0.0] + [0.5 + (0.5 * math.sin(angle)) for angle in angles]
+    ring_u[0] = ring_v[0] = 0.5
+
+    # clockwise seen from above in map x/y, which is facing up in glTF
+    fan = [(0, ((i + 1) % sides) + 1, i + 1) for i in range(sides)]
+
+    if np is not None:
+        centre_x = np.array([float(jcn.x) for jcn in junctions])
+        centre_y = np.array([float(jcn.y) for jcn in junctions])
+        radius = np.array([max(float(jcn.r1), float(jcn.r2)) for jcn in junctions])
+        config = np.array([jcn.config for jcn in junctions])
+
+        offsets_x = np.concatenate(([0.0], np.cos(angles)))
+        offsets_y = np.concatenate(([0.0], np.sin(angles)))
+        xs = centre_x[:, None] + (radius[:, None] * offsets_x)
+        ys = centre_y[:, None] + (radius[:, None] * offsets_y)
+        heights = map_file.height_at(xs.ravel(), ys.ravel()) + height_offset
+
+        u = np.tile(ring_u, (len(junctions), 1))
+        v = np.tile(ring_v, (len(junctions), 1))
+        u = np.where((config & U_MIRROR)[:, None] != 0, 1.0 - u, u)
+        v = np.where((config & V_MIRROR)[:, None] != 0, 1.0 - v, v)
+
+        indices = ((np.arange(len(junctions)) * (sides + 1))[:, None, None] + np.array(fan)[None]).ravel()
+
+        positions = np.stack((xs.ravel(), heights, ys.ravel()), axis=1)
+        uvs = np.stack((u.ravel(), v.ravel()), axis=1)
+        return mesh_buffers(positions, uvs, np.ones((len(positions), 4)), indices)
+
+    positions = []
+    uvs = []
+    indices = []
+
+    for n, jcn in enumerate(junctions):
+        radius = max(float(jcn.r1), float(jcn.r2))
+        xs = [float(jcn.x)] + [float(jcn.x) + (radius * math.cos(angle)) for angle in angles]
+        ys = [float(jcn.y)] + [float(jcn.y) + (radius * math.sin(angle)) for angle in angles]
+        heights = map_file.height_at(xs, ys)
+
+        for (x, y, height, u, v) in zip(xs, ys, heights, ring_u, ring_v):
+            positions.append((x, height + height_offset, y))
+            uvs.append((1.0 - u if jcn.config & U_MIRROR else u, 1.0 - v if jcn.config & V_MIRROR else v))
+
+        indices.extend((n * (sides + 1)) + corner for triangle in fan for corner in triangle)
+
+    return mesh_buffers(positions, uvs, [(1.0, 1.0, 1.0, 1.0)] * len(positions), indices)
+
+
+def mesh_buffers(positions, uvs, colors, indices):
+    '''
+    Indexed mesh as little endian buffers:
+
+        positions   - float32 x, y, z per vertex
+        uvs         - float32 u, v per vertex
+        colors      - float32 r, g, b, a per vertex
+        indices     - uint32, 3 per triangle
+
+    plus the vertex count, triangle count and the bounds of the positions
+    '''
+
+    if np is not None:
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        return {
+            "positions" : positions.astype('<f4').tobytes(),
+            "uvs"       : np.asarray(uvs).astype('<f4').tobytes(),
+            "colors"    : np.asarray(colors).astype('<f4').tobytes(),
+            "indices"   : np.asarray(indices).astype('<u4').tobytes(),
+            "vertices"  : len(positions),
+            "triangles" : len(indices) // 3,
+            "min"       : positions.astype(np.float32).min(axis=0).tolist() if len(positions) else [0.0] * 3,
+            "max"       : positions.astype(np.float32).max(axis=0).tolist() if len(positions) else [0.0] * 3,
+        }
+
+    def little_endian(typecode, values):
+        data = array(typecode, values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        return data
+
+    flat_positions = little_endian('f', [value for position in positions for value in position])
+    rounded = array('f', flat_positions.tobytes())
+    if sys.byteorder != "little":
+        rounded.byteswap()
+
+    return {
+        "positions" : flat_positions.tobytes(),
+        "uvs"       : little_endian('f', [value for uv in uvs for value in uv]).tobytes(),
+        "colors"    : little_endian('f', [value for color in colors for value in color]).tobytes(),
+        "indices"   : little_endian('I', indices).tobytes(),
+        "vertices"  : len(positions),
+        "triangles" : len(indices) // 3,
+        "min"       : [min(rounded[i::3]) for i in range(3)] if positions else [0.0] * 3,
+        "max"       : [max(rounded[i::3]) for i in range(3)] if positions else [0.0] * 3,
+    }
+
+
+# glTF constants
+GLTF_FLOAT          = 5126
+GLTF_UNSIGNED_INT   = 5125
+GLTF_ARRAY_BUFFER   = 34962
+GLTF_INDEX_BUFFER   = 34963
+
+
+def write_gltf(meshes: list, output_filename: str):
+    '''
+    Write (name, mesh_buffers) pairs as a glTF scene with one node and
+    material per mesh, the buffers go in a .bin file next to it
+    '''
+
+    bin_filename = os.path.splitext(output_filename)[0] + ".bin"
+    gltf = {
+        "asset"       : {"version": "2.0", "generator": "gepard-map-conv"},
+        "scene"       : 0,
+        "scenes"      : [{"nodes": list(range(len(meshes)))}],
+        "nodes"       : [],
+        "meshes"      : [],
+        "materials"   : [],
+        "accessors"   : [],
+        "bufferViews" : [],
+        "buffers"     : [],
+    }
+
+    blob = bytearray()
+
+    def add_view(data: bytes, target: int):
+        blob.extend(b'\0' * (-len(blob) % 4))
+        gltf["bufferViews"].append({"buffer": 0, "byteOffset": len(blob), "byteLength": len(data), "target": target})
+        blob.extend(data)
+        return len(gltf["bufferViews"]) - 1
+
+    def add_accessor(data: bytes, component: int, kind: str, count: int, target: int, **extra):
+        gltf["accessors"].append({"bufferView": add_view(data, target), "componentType": component,
+                                  "count": count, "type": kind, **extra})
+        return len(gltf["accessors"]) - 1
+
+    for index, (name, mesh) in enumerate(meshes):
+        attributes = {
+            "POSITION"   : add_accessor(mesh["positions"], GLTF_FLOAT, "VEC3", mesh["vertices"], GLTF_ARRAY_BUFFER,
+                                        min=mesh["min"], max=mesh["max"]),
+            "TEXCOORD_0" : add_accessor(mesh["uvs"], GLTF_FLOAT, "VEC2", mesh["vertices"], GLTF_ARRAY_BUFFER),
+            "COLOR_0"    : add_accessor(mesh["colors"], GLTF_FLOAT, "VEC4", mesh["vertices"], GLTF_ARRAY_BUFFER),
+        }
+        indices = add_accessor(mesh["indices"], GLTF_UNSIGNED_INT, "SCALAR", mesh["triangles"] * 3, GLTF_INDEX_BUFFER)
+
+        gltf["materials"].append({"name": name, "doubleSided": False})
+        gltf["meshes"].append({"name": name, "primitives": [{"attributes": attributes, "indices": indices, "material": index}]})
+        gltf["nodes"].append({"name": name, "mesh": index})
+
+    gltf["buffers"].append({"uri": os.path.basename(bin_filename), "byteLength": len(blob)})
+
+    with open(bin_filename, "wb") as fp:
+        fp.write(blob)
+
+    with open(output_filename, "w") as fp:
+        json.dump(gltf, fp, indent=1)
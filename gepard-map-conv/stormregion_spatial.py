@@ -0,0 +1,211 @@
+import math
+import heapq
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    # optional, queries loop over the cells in Python instead
+    np = None
+
+'''
+Spatial index over map entities (objects, decals, ambient sounds, units)
+
+The positions are bucketed once into a regular grid, stored cell by cell so
+every row of cells covered by a query is one contiguous slice. Rectangle,
+radius and k-nearest queries only look at the cells they touch and return
+the row numbers of the matching entities, sorted, as an index array (numpy
+int64, or array('I') without numpy) which can be given straight to
+stormregion_table.select().
+
+Usage: stormregion_map.spatial_index("objects").radius(x, y, 50)
+'''
+
+# entity table -> the columns with its 2D position
+ENTITY_COORDS = {
+    "objects"        : ("x", "y"),
+    "decals"         : ("x", "z"),
+    "ambient_sounds" : ("x", "y"),
+    "units"          : ("x", "y"),
+}
+
+# entities per cell the grid aims for when no cell size is given
+CELL_TARGET = 8
+
+
+class stormregion_grid_index:
+    '''
+    Uniform grid over a set of 2D points
+    '''
+
+    def __init__(self, xs, ys, cell_size: float = None):
+        self.count = len(xs)
+
+        if np is not None:
+            xs = np.asarray(xs, dtype=np.float64)
+            ys = np.asarray(ys, dtype=np.float64)
+            bounds = (float(xs.min()), float(xs.max()), float(ys.min()), float(ys.max())) if self.count else (0.0, 0.0, 0.0, 0.0)
+        else:
+            xs = [float(x) for x in xs]
+            ys = [float(y) for y in ys]
+            bounds = (min(xs), max(xs), min(ys), max(ys)) if self.count else (0.0, 0.0, 0.0, 0.0)
+
+        (self.x0, x1, self.y0, y1) = bounds
+
+        if cell_size is None:
+            # about CELL_TARGET entities per cell if they were spread evenly
+            area = max(x1 - self.x0, 1.0) * max(y1 - self.y0, 1.0)
+            cell_size = math.sqrt(area * CELL_TARGET / max(self.count, 1))
+
+        self.cell_size = max(float(cell_size), 1e-6)
+        self.cells_x = int((x1 - self.x0) // self.cell_size) + 1
+        self.cells_y = int((y1 - self.y0) // self.cell_size) + 1
+
+        if np is not None:
+            cell_x = ((xs - self.x0) // self.cell_size).astype(np.int64)
+            cell_y = ((ys - self.y0) // self.cell_size).astype(np.int64)
+            cell_ids = (cell_y * self.cells_x) + cell_x
+
+            # entities sorted by cell, starts[c]:starts[c + 1] are the ones in cell c
+            self.order = np.argsort(cell_ids, kind="stable")
+            self.starts = np.searchsorted(cell_ids[self.order], np.arange((self.cells_x * self.cells_y) + 1))
+            self.xs = xs[self.order]
+            self.ys = ys[self.order]
+        else:
+            cells = [[] for i in range(self.cells_x * self.cells_y)]
+            for i, (x, y) in enumerate(zip(xs, ys)):
+                cells[(int((y - self.y0) // self.cell_size) * self.cells_x) + int((x - self.x0) // self.cell_size)].append(i)
+
+            self.order = [i for cell in cells for i in cell]
+            self.starts = [0]
+            for cell in cells:
+                self.starts.append(self.starts[-1] + len(cell))
+            self.xs = [xs[i] for i in self.order]
+            self.ys = [ys[i] for i in self.order]
+
+
+    @classmethod
+    def from_table(cls, table, x_name: str = "x", y_name: str = "y", cell_size: float = None):
+        return cls(table.column(x_name), table.column(y_name), cell_size)
+
+
+    def _cell_range(self, x1: float, x2: float, y1: float, y2: float):
+        # cells covered by the rectangle, clipped to the grid (None if it misses it)
+        cx1 = max(0, int((x1 - self.x0) // self.cell_size))
+        cx2 = min(self.cells_x - 1, int((x2 - self.x0) // self.cell_size))
+        cy1 = max(0, int((y1 - self.y0) // self.cell_size))
+        cy2 = min(self.cells_y - 1, int((y2 - self.y0) // self.cell_size))
+
+        if cx1 > cx2 or cy1 > cy2:
+            return None
+        return (cx1, cx2, cy1, cy2)
+
+
+    def _candidates(self, x1: float, x2: float, y1: float, y2: float):
+        '''
+        Positions (in cell order) of every entity in the cells the rectangle touches
+        '''
+
+        cells = self._cell_range(x1, x2, y1, y2) if self.count else None
+        if cells is None:
+            return np.zeros(0, dtype=np.int64) if np is not None else []
+
+        (cx1, cx2, cy1, cy2) = cells
+        rows = range(cy1 * self.cells_x, (cy2 * self.cells_x) + 1, self.cells_x)
+
+        if np is not None:
+            # one slice per row of cells
+            return np.concatenate([np.arange(self.starts[row + cx1], self.starts[row + cx2 + 1]) for row in rows])
+
+        return [i for row in rows for i in range(self.starts[row + cx1], self.starts[row + cx2 + 1])]
+
+
+    def _result(self, positions):
+        if np is not None:
+            return np.sort(self.order[positions])
+        return array('I', sorted(self.order[i] for i in positions))
+
+
+    def rect(self, x1: float, x2: float, y1: float, y2: float):
+        '''
+        Entities with x1 <= x <= x2 and y1 <= y <= y2
+        '''
+
+        (x1, x2) = sorted((x1, x2))
+        (y1, y2) = sorted((y1, y2))
+        positions = self._candidates(x1, x2, y1, y2)
+
+        if np is not None:
+            xs = self.xs[positions]
+            ys = self.ys[positions]
+            return self._result(positions[(xs >= x1) & (xs <= x2) & (ys >= y1) & (ys <= y2)])
+
+        return self._result([i for i in positions if x1 <= self.xs[i] <= x2 and y1 <= self.ys[i] <= y2])
+
+
+    def radius(self, x: float, y: float, radius: float):
+        '''
+        Entities no further than radius from (x, y)
+        '''
+
+        positions = self._candidates(x - radius, x + radius, y - radius, y + radius)
+        limit = radius * radius
+
+        if np is not None:
+            dx = self.xs[positions] - x
+            dy = self.ys[positions] - y
+            return self._result(positions[(dx * dx) + (dy * dy) <= limit])
+
+        return self._result([i for i in positions if ((self.xs[i] - x) ** 2) + ((self.ys[i] - y) ** 2) <= limit])
+
+
+    def nearest(self, x: float, y: float, k: int = 1):
+        '''
+        The k entities closest to (x, y), closest first (ties by row number)
+        '''
+
+        k = min(k, self.count)
+        if k <= 0:
+            return np.zeros(0, dtype=np.int64) if np is not None else array('I')
+
+        # grow the search square until it holds k entities within its half size,
+        # nothing outside the square can be closer than those
+        reach = self.cell_size
+        extent = max(self.cells_x, self.cells_y) * self.cell_size + abs(x - self.x0) + abs(y - self.y0)
+
+        while True:
+            positions = self._candidates(x - reach, x + reach, y - reach, y + reach)
+
+            if np is not None:
+                distances = ((self.xs[positions] - x) ** 2) + ((self.ys[positions] - y) ** 2)
+                if np.count_nonzero(distances <= reach * reach) >= k or reach > extent:
+                    rows = self.order[positions]
+                    closest = np.lexsort((rows, distances))[:k]
+                    return rows[closest]
+            else:
+                distances = [((self.xs[i] - x) ** 2) + ((self.ys[i] - y) ** 2) for i in positions]
+                if sum(1 for distance in distances if distance <= reach * reach) >= k or reach > extent:
+                    closest = heapq.nsmallest(k, zip(distances, (self.order[i] for i in positions)))
+                    return array('I', [row for (distance, row) in closest])
+
+            reach *= 2
+
+
+    def in_location(self, loc):
+        '''
+        Entities inside a stormregion_loc box
+        '''
+
+        return self.rect(loc.x1, loc.x2, loc.y1, loc.y2)
+
+
+    def near_path(self, path, radius: float):
+        '''
+        Entities within radius of any node of a stormregion_path
+        '''
+
+        found = [self.radius(x, y, radius) for (x, y) in path.nodes]
+
+        if np is not None:
+            return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+        return array('I', sorted(set(row for rows in found for row in rows)))
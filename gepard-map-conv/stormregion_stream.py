@@ -0,0 +1,420 @@
+import contextlib
+import os
+import struct
+import sys
+import zlib
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from stormregion_native import export_size_for, open_map
+from stormregion_profile import profile_stage
+
+'''
+Streaming terrain export for maps too big to hold in memory
+
+The heightmap and blend planes are never decoded as a whole, rows are read
+straight from the HMAP/BLND chunks (found through the chunk index) a window
+at a time, converted and written out before the next window. Peak memory
+depends on the window size and the map width, not on the map size.
+
+The output is the same as export_heightmap/export_splatmaps. PNGs are
+written by png_stream_writer, which compresses rows as they come instead of
+needing the whole image like Pillow does.
+'''
+
+WINDOW_ROWS = 128
+BASE_LAYER_WEIGHT = 128     # see stormregion_map.normalise_splatmap
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_IDAT_SIZE = 1 << 18
+
+
+class png_stream_writer:
+    '''
+    Writes a PNG a few rows at a time
+
+    Modes are "L" (8 bit grey), "I;16" (16 bit grey, rows given big endian
+    as PNG wants) and "RGBA" (8 bit per channel)
+    '''
+
+    MODES = {
+        # bit depth, color type, bytes per pixel
+        "L"     : (8, 0, 1),
+        "I;16"  : (16, 0, 2),
+        "RGBA"  : (8, 6, 4),
+    }
+
+    def __init__(self, path: str, width: int, height: int, mode: str, level: int = 6):
+        (bit_depth, color_type, bytes_per_pixel) = self.MODES[mode]
+
+        self.path       = path
+        self.width      = width
+        self.height     = height
+        self.row_size   = width * bytes_per_pixel
+        self.rows       = 0
+        self.pending    = bytearray()
+        self.compressor = zlib.compressobj(level)
+
+        self.fp = open(path, "wb")
+        self.fp.write(PNG_SIGNATURE)
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0))
+
+
+    def _chunk(self, kind: bytes, payload: bytes):
+        self.fp.write(struct.pack('>I', len(payload)) + kind + payload +
+                      struct.pack('>I', zlib.crc32(payload, zlib.crc32(kind))))
+
+
+    def write_rows(self, raw_data):
+        '''
+        Append whole rows of pixel data
+        '''
+
+        raw_data = memoryview(raw_data).cast('B')
+        count = len(raw_data) // self.row_size
+
+        if count * self.row_size != len(raw_data):
+            raise ValueError(f"{len(raw_data)} bytes is not a whole number of {self.row_size} byte rows")
+        if self.rows + count > self.height:
+            raise IOError(f"Too many rows for {self.path}, {self.rows + count} of {self.height}")
+
+        # every row starts with its filter type, 0 is none
+        filtered = bytearray((self.row_size + 1) * count)
+        for row in range(count):
+            start = row * (self.row_size + 1)
+            filtered[start + 1:start + 1 + self.row_size] = raw_data[row * self.row_size:(row + 1) * self.row_size]
+
+        self.pending += self.compressor.compress(filtered)
+        self.rows += count
+
+        if len(self.pending) >= PNG_IDAT_SIZE:
+            self._chunk(b'IDAT', bytes(self.pending))
+            self.pending = bytearray()
+
+
+    def write_blank_rows(self, count: int, value: bytes = b'\x00'):
+        '''
+        Rows where every pixel is value (padding)
+        '''
+
+        row = (value * (self.row_size // len(value)))
+        for start in range(0, count, WINDOW_ROWS):
+            self.write_rows(row * min(WINDOW_ROWS, count - start))
+
+
+    def close(self):
+        if self.fp is None:
+            return
+
+        try:
+            if self.rows != self.height:
+                raise IOError(f"{self.path} has {self.rows} rows, expected {self.height}")
+
+            self.pending += self.compressor.flush()
+            self._chunk(b'IDAT', bytes(self.pending))
+            self._chunk(b'IEND', b'')
+        finally:
+            self.fp.close()
+            self.fp = None
+
+
+    def abort(self):
+        '''
+        Close without finishing the image and delete the partial file
+        '''
+
+        if self.fp is None:
+            return
+
+        self.fp.close()
+        self.fp = None
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        # after an error the rows are short anyway, don't hide it behind that
+        if kind is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class terrain_stream:
+    '''
+    Row windows of the heightmap and blend planes of an open map
+    (a stormregion_lazy_map), optionally only a crop of it
+
+    crop is (x1, x2, y1, y2) in vertices, like stormregion_map.crop_to
+    '''
+
+    def __init__(self, map_file, crop: tuple = None):
+        self.file = map_file.file
+
+        hmap = map_file.index.find("MAPF/TERR/HMAP")
+        blnd = map_file.index.find("MAPF/TERR/BLND")
+        if hmap is None:
+            raise IOError(f"No heightmap in {map_file.path}")
+
+        self.file.seek(hmap.offset)
+        self.full_size_x = self.file.read_uint() + 1
+        self.full_size_y = self.file.read_uint() + 1
+        self.hmap_offset = hmap.offset + 8
+        self.blnd_offset = blnd.offset if blnd is not None else None
+
+        (x1, x2, y1, y2) = crop if crop is not None else (0, self.full_size_x, 0, self.full_size_y)
+        self.x1 = max(0, x1)
+        self.y1 = max(0, y1)
+        self.x2 = min(self.full_size_x, x2)
+        self.y2 = min(self.full_size_y, y2)
+
+        if self.x2 <= self.x1 or self.y2 <= self.y1:
+            raise ValueError(f"Crop area ({x1}, {y1}) to ({x2}, {y2}) is outside the {self.full_size_x} x {self.full_size_y} map")
+
+        self.size_x = self.x2 - self.x1
+        self.size_y = self.y2 - self.y1
+
+        self.tlayers = map_file.tlayers
+        num_planes = len(self.tlayers) - 1
+        self.textured_planes = [i for i in range(num_planes) if map_file.is_textured_layer(self.tlayers[i]['properties'])]
+
+
+    def windows(self, window_rows: int = WINDOW_ROWS):
+        '''
+        (first row, row count) over the cropped area
+        '''
+
+        for y in range(0, self.size_y, window_rows):
+            yield (y, min(window_rows, self.size_y - y))
+
+
+    def _read(self, dtype: str, offset: int, item_size: int, y: int, rows: int):
+        self.file.seek(offset + ((self.y1 + y) * self.full_size_x * item_size))
+        values = self.file.read_array(dtype, rows * self.full_size_x)
+
+        if np is not None:
+            return values.reshape(rows, self.full_size_x)[:, self.x1:self.x2]
+
+        return [values[row * self.full_size_x + self.x1:row * self.full_size_x + self.x2] for row in range(rows)]
+
+
+    def height_rows(self, y: int, rows: int):
+        '''
+        Heights of rows y to y + rows, a (rows, size_x) float32 array
+        (or a list of rows without NumPy), views onto the file
+        '''
+
+        return self._read('f', self.hmap_offset, 4, y, rows)
+
+
+    def blend_rows(self, plane: int, y: int, rows: int):
+        plane_offset = self.blnd_offset + (plane * self.full_size_x * self.full_size_y)
+        return self._read('B', plane_offset, 1, y, rows)
+
+
+    def height_range(self, window_rows: int = WINDOW_ROWS):
+        '''
+        (min, max) of the heights, always including 0 like export_heightmap
+        '''
+
+        min_value = 0.0
+        max_value = 0.0
+
+        for (y, rows) in self.windows(window_rows):
+            heights = self.height_rows(y, rows)
+            if np is not None:
+                min_value = min(min_value, float(heights.min()))
+                max_value = max(max_value, float(heights.max()))
+            else:
+                min_value = min(min_value, min(min(row) for row in heights))
+                max_value = max(max_value, max(max(row) for row in heights))
+
+        return (min_value, max_value)
+
+
+def _quantize(heights, min_value: float, scale: float, export_size: int, padding_height: float):
+    '''
+    One window of heights -> (16 bit little endian, float32 little endian) padded rows
+    '''
+
+    if np is not None:
+        padded = np.pad(heights, ((0, 0), (0, export_size - heights.shape[1])), constant_values=padding_height)
+        raw_values = np.clip((padded.astype(np.float64) - min_value) / scale, 0, 65535).astype('<u2')
+        return (raw_values, padded.astype('<f4'))
+
+    padded = array('f')
+    for row in heights:
+        padded.extend(row)
+        padded.extend([padding_height] * (export_size - len(row)))
+
+    raw_values = array('H', [min(65535, max(0, int((pixel - min_value) / scale))) for pixel in padded])
+    if sys.byteorder != "little":
+        raw_values.byteswap()
+        padded.byteswap()
+    return (raw_values, padded)
+
+
+def _big_endian_16(raw_values):
+    if np is not None:
+        return raw_values.astype('>u2')
+
+    values = array('H', raw_values)
+    values.byteswap()
+    return values
+
+
+@profile_stage("stream_heightmap")
+def stream_heightmap(map_file, outputs: dict, padding_height: float = 0, crop: tuple = None,
+                     window_rows: int = WINDOW_ROWS):
+    '''
+    export_heightmap for an open map (open_map()) without loading the heightmap,
+    outputs is a dict of format -> filename (raw, png, r32)
+    '''
+
+    terrain = terrain_stream(map_file, crop)
+    export_size = export_size_for(terrain.size_x, terrain.size_y)
+
+    (min_value, max_value) = terrain.height_range(window_rows)
+    scale = map_file.heightmap_scale(min_value, max_value)
+
+    files = {}
+    with contextlib.ExitStack() as stack:
+        for (fmt, output_filename) in outputs.items():
+            if fmt == "png":
+                files[fmt] = stack.enter_context(png_stream_writer(output_filename, export_size, export_size, "I;16"))
+            elif fmt in ("raw", "r32"):
+                files[fmt] = stack.enter_context(open(output_filename, "wb"))
+            else:
+                raise ValueError(f"Unknown heightmap format {fmt}")
+
+        def write(raw_values, float_values):
+            for (fmt, fp) in files.items():
+                if fmt == "png":
+                    fp.write_rows(_big_endian_16(raw_values))
+                else:
+                    fp.write(float_values if fmt == "r32" else raw_values)
+
+        for (y, rows) in terrain.windows(window_rows):
+            write(*_quantize(terrain.height_rows(y, rows), min_value, scale, export_size, padding_height))
+
+        # padding rows at the bottom
+        padding_rows = export_size - terrain.size_y
+        for start in range(0, padding_rows, window_rows):
+            rows = min(window_rows, padding_rows - start)
+            blank = [array('f', [padding_height] * export_size)] * rows if np is None else \
+                    np.full((rows, export_size), padding_height, dtype=np.float32)
+            write(*_quantize(blank, min_value, scale, export_size, padding_height))
+
+    for (fmt, output_filename) in outputs.items():
+        print(f"Wrote heightmap to file: {output_filename} ({fmt}), {export_size * export_size} pixels written")
+    print(f"Scale: {scale}, Max: {max_value}, Min: {min_value}")
+
+    return export_size
+
+
+def _splat_window(terrain, y: int, rows: int, export_size: int, num_splatmaps: int):
+    '''
+    Normalised, packed RGBA rows of every splatmap for one window
+    '''
+
+    layers = [terrain.blend_rows(plane, y, rows) for plane in terrain.textured_planes]
+    num_layers = len(layers) + 1
+
+    if np is not None:
+        layers = np.asarray(layers, dtype=np.uint8).reshape(len(layers), rows, terrain.size_x)
+        total_weight = layers.sum(axis=0, dtype=np.float64) + BASE_LAYER_WEIGHT
+
+        channels = np.zeros((num_splatmaps * 4, rows, export_size), dtype=np.uint8)
+        channels[0, :, :terrain.size_x] = (BASE_LAYER_WEIGHT / total_weight) * 255
+        channels[1:num_layers, :, :terrain.size_x] = (layers / total_weight) * 255
+
+        packed = channels.reshape(num_splatmaps, 4, rows, export_size).transpose(0, 2, 3, 1)
+        return [np.ascontiguousarray(rgba) for rgba in packed]
+
+    splatmaps = [bytearray(rows * export_size * 4) for _ in range(num_splatmaps)]
+
+    for row in range(rows):
+        layer_rows = [bytes(layer[row]) for layer in layers]
+        row_start = row * export_size * 4
+
+        for x in range(terrain.size_x):
+            total_weight = float(sum(layer_row[x] for layer_row in layer_rows)) + BASE_LAYER_WEIGHT
+            weights = [int(float(BASE_LAYER_WEIGHT / total_weight) * 255)] + \
+                      [int(float(layer_row[x] / total_weight) * 255) for layer_row in layer_rows]
+
+            for layer, weight in enumerate(weights):
+                splatmaps[layer // 4][row_start + (x * 4) + (layer % 4)] = weight
+
+    return splatmaps
+
+
+@profile_stage("stream_splatmaps")
+def stream_splatmaps(map_file, output_dir: str = ".", crop: tuple = None, window_rows: int = WINDOW_ROWS):
+    '''
+    export_splatmaps for an open map (open_map()) without loading the blend planes
+    '''
+
+    terrain = terrain_stream(map_file, crop)
+    export_size = export_size_for(terrain.size_x, terrain.size_y)
+
+    if terrain.blnd_offset is None:
+        raise IOError(f"No blend planes in {map_file.path}")
+
+    map_file.create_texturemap(os.path.join(output_dir, f"{map_file.map_name}_texture_array.png"))
+
+    num_layers = len(terrain.textured_planes) + 1
+    num_splatmaps = (num_layers + 3) // 4
+    print(f"Require {num_splatmaps} splatmaps for {num_layers} layers")
+
+    writers = []
+    with contextlib.ExitStack() as stack:
+        for splatmap_index in range(num_splatmaps):
+            # game expects splat, splat2, splat3...
+            fname = "splat.png" if splatmap_index == 0 else f"splat{splatmap_index+1}.png"
+            writers.append(stack.enter_context(png_stream_writer(os.path.join(output_dir, fname), export_size, export_size, "RGBA")))
+
+        for (y, rows) in terrain.windows(window_rows):
+            for writer, rgba in zip(writers, _splat_window(terrain, y, rows, export_size, num_splatmaps)):
+                writer.write_rows(rgba)
+
+        # undefined areas are 0 (no texture at all)
+        for writer in writers:
+            writer.write_blank_rows(export_size - terrain.size_y)
+
+    print(f"{num_splatmaps} BLEND splatmaps generated")
+
+
+def stream_convert_map(path: str, output_dir: str = ".", crop: tuple = None, padding_height: float = -4,
+                       heightmap_formats: tuple = ("raw",), splatmaps: bool = True, window_rows: int = WINDOW_ROWS):
+    '''
+    convert_map without decoding the terrain, for very large maps.
+    Returns the (closed) map, its header and size are still available
+    '''
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    with open_map(path) as map_file:
+        map_file.map_name = os.path.splitext(os.path.basename(path))[0]
+
+        export_size = stream_heightmap(map_file, {fmt: os.path.join(output_dir, f"heightmap.{fmt}") for fmt in heightmap_formats},
+                                       padding_height, crop, window_rows)
+
+        if splatmaps:
+            stream_splatmaps(map_file, output_dir, crop, window_rows)
+
+        terrain = terrain_stream(map_file, crop)
+        map_file.size_x = terrain.size_x
+        map_file.size_y = terrain.size_y
+        map_file.export_size = export_size
+
+    return map_file
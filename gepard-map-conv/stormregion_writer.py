@@ -0,0 +1,512 @@
+import math
+import random
+import struct
+import sys
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+'''
+Writer for synthetic Gepard files
+
+We can't ship the game files, so this makes maps (MAPF) and models (SCEN
+v100/v101) with the same chunk framing and record layouts the parsers read,
+filled with generated content of any size. Good for benchmarks and for
+checking a change didn't break the parsing, not for making playable maps.
+
+Usage: python stormregion_writer.py map <file.map> [size] [layers]
+       python stormregion_writer.py model <file.4d> [vertices] [v100|v101] [strip|skvs]
+'''
+
+MAGIC = b'\x53\x72\x1A\x1B\x0D\x0A\x87\x0A'
+
+DATABLOCK_END   = 0xffffffff
+DATABLOCK_NEXT  = 0x7fffffff
+
+_uint   = struct.Struct('<I')
+_sint   = struct.Struct('<i')
+_ushort = struct.Struct('<H')
+_float  = struct.Struct('<f')
+
+
+class stormregion_writer:
+    '''
+    Builds a file in memory, the opposite of stormregion_reader
+
+    Chunks are opened with begin_chunk() and closed with end_chunk(), which
+    fills in the size, so they can be nested:
+
+        writer.begin_chunk("TERR")
+        writer.write(b"v100")
+        ...
+        writer.end_chunk()
+    '''
+
+    def __init__(self):
+        self.data = bytearray(MAGIC)
+        self.open_chunks = []
+
+
+    def write(self, raw_data):
+        self.data += raw_data
+
+    def write_char(self, value: int):
+        self.data.append(value)
+
+    def write_uint(self, value: int):
+        self.data += _uint.pack(value)
+
+    def write_sint(self, value: int):
+        self.data += _sint.pack(value)
+
+    def write_ushort(self, value: int):
+        self.data += _ushort.pack(value)
+
+    def write_float(self, value: float):
+        self.data += _float.pack(value)
+
+    def write_string(self, value: str):
+        raw_data = value.encode()
+        self.data += _ushort.pack(len(raw_data)) + raw_data
+
+    def write_vec(self, values):
+        self.data += struct.pack(f'<{len(values)}f', *values)
+
+    def write_struct(self, fmt: struct.Struct, *values):
+        self.data += fmt.pack(*values)
+
+    def write_array(self, dtype: str, values):
+        '''
+        Bulk values (heights, blend planes, indexes), any sequence or array
+        '''
+
+        if np is not None and isinstance(values, np.ndarray):
+            self.data += values.astype(f'<{dtype}', copy=False).tobytes()
+            return
+
+        values = array(dtype, values)
+        if sys.byteorder != "little":
+            values.byteswap()
+        self.data += values.tobytes()
+
+
+    def begin_chunk(self, kind: str):
+        self.data += kind.encode()
+        self.open_chunks.append(len(self.data))
+        self.data += bytes(4)
+
+    def end_chunk(self):
+        size_offset = self.open_chunks.pop()
+        _uint.pack_into(self.data, size_offset, len(self.data) - size_offset - 4)
+
+    def chunk(self, kind: str, payload: bytes):
+        self.data += kind.encode() + _uint.pack(len(payload)) + payload
+
+
+    def getvalue(self):
+        if self.open_chunks:
+            raise IOError(f"{len(self.open_chunks)} chunks not closed")
+        return bytes(self.data)
+
+    def save(self, path: str):
+        with open(path, "wb") as fp:
+            fp.write(self.getvalue())
+
+
+def synthetic_heightmap(size_x: int, size_y: int, seed: int = 1):
+    '''
+    Rolling hills plus some noise, (size_y, size_x) heights between about -4 and 12
+
+    All the randomness comes from one random.Random stream and the few sin/cos
+    values from math, numpy only does the per vertex sums, so a seed gives the
+    same heights with and without numpy
+    '''
+
+    rnd = random.Random(seed)
+    phase_x = rnd.uniform(0, math.pi)
+    phase_y = rnd.uniform(0, math.pi)
+    noise_data = rnd.randbytes(size_x * size_y * 2)
+
+    xs = [math.sin(x / 23.0 + phase_x) * 4 for x in range(size_x)]
+    ys = [math.cos(y / 31.0 + phase_y) * 4 + 4 for y in range(size_y)]
+
+    if np is not None:
+        noise = ((np.frombuffer(noise_data, dtype=np.uint16) / 65535.0) * 0.5) - 0.25
+        return ((np.array(ys)[:, None] + np.array(xs)[None, :]) + noise.reshape(size_y, size_x)).astype(np.float32)
+
+    noise = array('H', noise_data)
+    heights = array('f')
+    for y in range(size_y):
+        offset = y * size_x
+        heights.extend((ys[y] + x_height) + (((noise[offset + x] / 65535.0) * 0.5) - 0.25)
+                       for x, x_height in enumerate(xs))
+    return heights
+
+
+def synthetic_blend(num_planes: int, size_x: int, size_y: int, seed: int = 1):
+    '''
+    Blend planes, each layer covers a band of the map, as bytes (the same
+    with and without numpy)
+    '''
+
+    if num_planes <= 0:
+        return b''
+
+    # noise of 0-63 everywhere, 0xC0 added in the band of each layer
+    raw_data = bytearray(random.Random(seed).randbytes(num_planes * size_y * size_x))
+    raw_data = bytearray(raw_data.translate(bytes(value & 0x3F for value in range(256))))
+    covered = bytes((value & 0x3F) | 0xC0 for value in range(256))
+
+    band = max(1, size_y // num_planes)
+    plane_size = size_x * size_y
+    for i in range(num_planes):
+        start = (i * plane_size) + (min(i * band, size_y) * size_x)
+        end = (i * plane_size) + (min((i + 1) * band, size_y) * size_x)
+        raw_data[start:end] = raw_data[start:end].translate(covered)
+
+    return bytes(raw_data)
+
+
+def write_map(size: int = 129, layers: int = 4, doods: int = 100, roads: int = 5, road_nodes: int = 8,
+              junctions: int = 2, sounds: int = 10, paths: int = 3, locs: int = 3, tvars: int = 4,
+              units: int = 5, decals: int = 4, size_y: int = None, version: int = 100, seed: int = 1,
+              stored_units: int = 0):
+    '''
+    A MAPF file of size x size_y vertices (size_y defaults to size), returns the bytes
+
+    With stored_units every 4th unit carries that many units (as _mcl blocks)
+    '''
+
+    size_x = size
+    size_y = size_y or size
+    rnd = random.Random(seed)
+    world_x = (size_x - 1) * 1.0
+    world_y = (size_y - 1) * 1.0
+
+    writer = stormregion_writer()
+    writer.begin_chunk("MAPF")
+    writer.write_uint(version)
+
+    for (kind, value) in (("TPAM", "synthetic"), ("ATMS", "atm_day"), ("KSYB", "sky_clear"),
+                          ("LRIA", "aircraft"), ("ISUM", "music_01")):
+        writer.begin_chunk(kind)
+        writer.write_string(value)
+        writer.end_chunk()
+
+    # terrain
+    writer.begin_chunk("TERR")
+    writer.write(b"v100")
+
+    writer.begin_chunk("HMAP")
+    writer.write_uint(size_x - 1)
+    writer.write_uint(size_y - 1)
+    writer.write_array('f', synthetic_heightmap(size_x, size_y, seed))
+    writer.end_chunk()
+
+    writer.begin_chunk("TLAY")
+    writer.write_uint(layers)
+    for i in range(layers):
+        writer.write_string(f"tile{i}")
+        # one walker only layer so the textured/untextured split gets used
+        writer.write_uint(0x10 if i == 2 else 0)
+    writer.end_chunk()
+
+    writer.begin_chunk("BLND")
+    writer.write(synthetic_blend(layers - 1, size_x, size_y, seed))
+    writer.end_chunk()
+
+    writer.end_chunk()
+
+    # roads, each one a straight-ish line of nodes
+    writer.begin_chunk("ROD5")
+    writer.write_uint(roads)
+    writer.write_uint(0)
+    writer.write_uint(0)
+    for i in range(roads):
+        writer.write_uint(DATABLOCK_NEXT)
+        writer.write_string(f"road{i % 3}")
+        writer.write_vec((5.0, 0.0))
+        writer.write_uint(0x20)
+        writer.write_uint(road_nodes)
+
+        x = rnd.uniform(0, world_x)
+        y = rnd.uniform(0, world_y)
+        for n in range(road_nodes):
+            x = min(world_x, max(0.0, x + rnd.uniform(-4, 8)))
+            y = min(world_y, max(0.0, y + rnd.uniform(-4, 8)))
+            writer.write_vec((x, y, 2.0, 2.0, 0.0, 0.0, 0.0, 2.0))
+            writer.write_uint(0)
+    writer.end_chunk()
+
+    writer.begin_chunk("RODJ")
+    writer.write_uint(0)
+    writer.write_uint(13)
+    writer.write_uint(junctions)
+    writer.write_uint(DATABLOCK_NEXT)
+    for i in range(junctions):
+        writer.write_string(f"jcn{i % 2}")
+        writer.write_vec((1.0, 2.0))
+        writer.write_uint(0x40)
+        writer.write_vec((rnd.uniform(0, world_x), rnd.uniform(0, world_y), 2.0, 2.0, 0.0, 0.0, 0.0, 2.0))
+        writer.write_uint(0)
+        writer.write_uint(2)
+        for joint in range(2):
+            writer.write_uint(joint)
+            writer.write_char(joint + 1)
+        writer.write_uint(DATABLOCK_END if i == junctions - 1 else DATABLOCK_NEXT)
+    writer.end_chunk()
+
+    # entities
+    writer.begin_chunk("ENTS")
+    writer.write(b"v100")
+
+    writer.begin_chunk("DECS")
+    writer.write_uint(decals)
+    for i in range(decals):
+        writer.begin_chunk("DECA")
+        writer.write(b"v100")
+        writer.write_string(f"decal{i % 3}")
+        writer.write_uint(rnd.randrange(size_x))
+        writer.write_uint(rnd.randrange(size_y))
+        writer.write_uint(rnd.randrange(4))
+        writer.end_chunk()
+    writer.end_chunk()
+
+    writer.begin_chunk("DODS")
+    writer.write_uint(doods)
+    writer.write_uint(0)
+    writer.write_uint(0)
+    writer.write_uint(0)
+    for i in range(doods):
+        writer.write(b"DOOD" + _uint.pack(0) + b"v100")
+        writer.write_string(f"objects/obj{i % 8}.4d")
+        writer.write_vec((rnd.uniform(0, world_x), 1.0, rnd.uniform(0, world_y), rnd.uniform(0, 6.28)))
+        writer.write_uint(1)
+        writer.write_uint(2)
+        writer.write_float(3.0)
+        writer.write(bytes((1, 2, 3)))
+        writer.write_ushort(4)
+
+        # some objects have links to others before the end marker
+        if i % 5 == 0:
+            writer.write_uint(7)
+            writer.write_uint(8)
+        writer.write_uint(DATABLOCK_END if i == doods - 1 else DATABLOCK_NEXT)
+    writer.end_chunk()
+
+    writer.begin_chunk("UNDS")
+    for i in range(units):
+        writer.begin_chunk("UNTD")
+        writer.write(b"v100")
+        writer.write_uint(5)
+        writer.write_string("ClassName")
+        writer.write_string(f"tank{i % 3}")
+        writer.write_uint(2)
+        writer.write_string("Player")
+        writer.write_uint(i % 2)
+        if stored_units and i % 4 == 0:
+            writer.write_uint(10)
+            writer.write_string("StoredUnits")
+            writer.write_uint(0)
+            writer.write_uint(stored_units)
+            for j in range(stored_units):
+                writer.begin_chunk("_mcl")
+                writer.write_uint(5)
+                writer.write_string("ClassName")
+                writer.write_string(f"infantry{j % 2}")
+                writer.write_uint(2)
+                writer.write_string("Player")
+                writer.write_uint(i % 2)
+                writer.write_uint(3)
+                writer.write_string("HP")
+                writer.write_float(1.0 - (j * 0.25))
+                writer.write_uint(0)
+                writer.end_chunk()
+        writer.write_uint(3)
+        writer.write_string("XP")
+        writer.write_float(0.5)
+        writer.write_uint(8)
+        writer.write_string("Pos")
+        writer.write_vec((rnd.uniform(0, world_x), rnd.uniform(0, world_y)))
+        writer.write_uint(0)
+        writer.end_chunk()
+    writer.end_chunk()
+
+    writer.begin_chunk("AMBS")
+    writer.write_uint(0)
+    writer.write_uint(DATABLOCK_NEXT)
+    for i in range(sounds):
+        writer.write(b"AMBI" + _uint.pack(0) + b"v100")
+        writer.write_string(f"sound{i % 4}")
+        writer.write_vec((rnd.uniform(0, world_x), rnd.uniform(0, world_y), 0.0, 1.0))
+        writer.write_uint(DATABLOCK_END if i == sounds - 1 else DATABLOCK_NEXT)
+    if sounds == 0:
+        # the parser expects at least one record after the start marker
+        writer.write(b"AMBI" + _uint.pack(0) + b"v100")
+        writer.write_string("silence")
+        writer.write_vec((0.0, 0.0, 0.0, 0.0))
+        writer.write_uint(DATABLOCK_END)
+    writer.end_chunk()
+
+    writer.end_chunk()
+
+    # script data
+    writer.begin_chunk("TVAR")
+    writer.write_uint(tvars)
+    writer.write_uint(0)
+    writer.write_uint(tvars)
+    writer.write_uint(DATABLOCK_NEXT)
+    for i in range(tvars):
+        writer.write_string(f"var{i}")
+        writer.write_uint(i)
+        writer.write_uint(1)
+        if tvars > 1:
+            writer.write_uint(DATABLOCK_NEXT)
+    writer.end_chunk()
+
+    writer.begin_chunk("LOCS")
+    writer.write_uint(0)
+    writer.write_uint(0)
+    writer.write_uint(locs)
+    if locs:
+        writer.write_uint(DATABLOCK_NEXT)
+    for i in range(locs):
+        x = rnd.randrange(size_x - 8)
+        y = rnd.randrange(size_y - 8)
+        writer.write_uint(x)
+        writer.write_uint(y)
+        writer.write_uint(x + 8)
+        writer.write_uint(y + 8)
+        writer.write_string(f"loc{i}")
+        writer.write_uint(0xff00ff)
+        writer.write_uint(DATABLOCK_END if i == locs - 1 else DATABLOCK_NEXT)
+    writer.end_chunk()
+
+    writer.begin_chunk("PATH")
+    writer.write_uint(0)
+    writer.write_uint(0)
+    writer.write_uint(paths)
+    if paths:
+        writer.write_uint(DATABLOCK_NEXT)
+    for i in range(paths):
+        writer.write_string(f"path{i}")
+        writer.write_char(0xff)
+        writer.write_uint(i)
+        writer.write_uint(3)
+        for n in range(3):
+            writer.write_vec((rnd.uniform(0, world_x), rnd.uniform(0, world_y)))
+        writer.write_uint(DATABLOCK_END if i == paths - 1 else DATABLOCK_NEXT)
+    writer.end_chunk()
+
+    writer.end_chunk()
+    return writer.getvalue()
+
+
+def _write_object_header(writer, name: str, parent_id: int, version: str):
+    writer.write_string(name)
+    writer.write_sint(parent_id)
+    if version == "v101":
+        writer.write_sint(0)
+        writer.write_sint(0)
+    writer.write_vec((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0))
+    writer.write_vec((0.0, 0.0, 0.0))
+
+
+def write_model(vertices: int = 1000, indices: int = None, version: str = "v101",
+                strip: bool = False, skvs: bool = False, meshes: int = 1, seed: int = 1):
+    '''
+    A SCEN model with meshes each of vertices/indices, plus a dummy
+    strip uses a STRP (triangle strip) material, skvs makes them skinned
+    meshes (SKVS) with a BONS chunk. Returns the bytes
+    '''
+
+    if vertices > 0xFFFF:
+        raise ValueError("Gepard meshes have at most 65535 vertices")
+
+    indices = indices if indices is not None else vertices * 3
+    rnd = random.Random(seed)
+
+    writer = stormregion_writer()
+    writer.begin_chunk("SCEN")
+    writer.write(version.encode())
+
+    for mesh in range(meshes):
+        writer.begin_chunk("SKVS" if skvs else "MESH")
+        _write_object_header(writer, f"mesh{mesh}", -1, version)
+
+        writer.begin_chunk("VERT")
+        writer.write_uint(vertices)
+        writer.write_uint(0)
+        if skvs:
+            writer.write_uint(0)
+
+        for i in range(vertices):
+            # position, normal, uv
+            writer.write_vec((rnd.uniform(-50, 50), rnd.uniform(-50, 50), rnd.uniform(0, 30),
+                              0.0, 0.0, 1.0, rnd.random(), rnd.random()))
+            if skvs:
+                # bones, weights, MTBL, material floats
+                writer.write(bytes((0, 1, 0, 0)))
+                writer.write_vec((0.75, 0.25, 0.0, 0.0))
+                writer.write(bytes(4))
+                writer.write_vec((0.0, 0.0, 0.0, 0.0))
+        writer.end_chunk()
+
+        writer.begin_chunk("INDI")
+        writer.write_uint(indices)
+        writer.write_array('H', [rnd.randrange(vertices) for _ in range(indices)])
+        writer.end_chunk()
+
+        if skvs:
+            writer.begin_chunk("BONS")
+            writer.write_uint(2)
+            for bone_id in (1, 2):
+                writer.write_uint(bone_id)
+                writer.write_vec((1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, bone_id * 10.0))
+            writer.end_chunk()
+
+        writer.begin_chunk("MTLS")
+        writer.write_uint(1)
+        writer.begin_chunk("STRP" if strip else "MATE")
+        writer.write_uint(indices)
+        writer.write_uint(0)
+        writer.write_uint(vertices)
+        writer.begin_chunk("DIFF")
+        writer.write_string(f"textures/mesh{mesh}.tga")
+        writer.end_chunk()
+        writer.end_chunk()
+        writer.end_chunk()
+
+        writer.end_chunk()
+
+    for bone_id in (1, 2):
+        writer.begin_chunk("DUMY")
+        _write_object_header(writer, f"bone{bone_id}", bone_id - 2, version)
+        writer.end_chunk()
+
+    writer.end_chunk()
+    return writer.getvalue()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("map", "model"):
+        print("Usage: python stormregion_writer.py map <file.map> [size] [layers]")
+        print("       python stormregion_writer.py model <file.4d> [vertices] [v100|v101] [strip|skvs]")
+        sys.exit(1)
+
+    if sys.argv[1] == "map":
+        raw_data = write_map(size=int(sys.argv[3]) if len(sys.argv) > 3 else 129,
+                             layers=int(sys.argv[4]) if len(sys.argv) > 4 else 4)
+    else:
+        raw_data = write_model(vertices=int(sys.argv[3]) if len(sys.argv) > 3 else 1000,
+                               version=sys.argv[4] if len(sys.argv) > 4 else "v101",
+                               strip="strip" in sys.argv[5:],
+                               skvs="skvs" in sys.argv[5:])
+
+    with open(sys.argv[2], "wb") as fp:
+        fp.write(raw_data)
+
+    print(f"Wrote {len(raw_data)} bytes to {sys.argv[2]}")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the tools are flat modules run from gepard-map-conv/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+from stormregion_writer import write_map
+
+'''
+Batch conversion with a broken map among good ones
+'''
+
+BATCH_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "stormregion_batch.py")
+
+
+def test_bad_map_does_not_stop_batch(tmp_path):
+    good = write_map(33, doods=20, decals=4)
+    for name in ("good1.map", "good2.map"):
+        (tmp_path / name).write_bytes(good)
+
+    # first decal renamed, parse_decs doesn't know the sub-chunk
+    assert good.count(b"DECA") >= 1
+    (tmp_path / "bad.map").write_bytes(good.replace(b"DECA", b"DECX", 1))
+
+    output = tmp_path / "output"
+    result = subprocess.run([sys.executable, BATCH_SCRIPT, str(tmp_path), "-o", str(output), "-j", "2", "--no-splatmaps"],
+                            capture_output=True, text=True)
+
+    assert result.returncode == 1, result.stdout + result.stderr
+    assert "Converted 2 of 3 maps" in result.stdout
+    assert "Unknown DECS sub-node DECX" in [line for line in result.stdout.splitlines()
+                                            if line.startswith("FAILED") and "bad.map" in line][0]
+
+    for name in ("good1", "good2"):
+        assert (output / name / "heightmap.raw").is_file()
@@ -0,0 +1,243 @@
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import stormregion_native as native
+from stormregion_def import stormregion_table
+from stormregion_reader import stormregion_reader
+from stormregion_spatial import ENTITY_COORDS
+from stormregion_writer import write_map, write_model
+
+'''
+Checks on synthetic maps from stormregion_writer, run with python -m pytest
+'''
+
+
+def same(a, b):
+    '''
+    Deep comparison of parsed map data (arrays, tables, entity objects...)
+    '''
+
+    if np is not None and (isinstance(a, np.ndarray) or isinstance(b, np.ndarray)):
+        return np.array_equal(np.asarray(a), np.asarray(b))
+
+    if isinstance(a, stormregion_table):
+        return isinstance(b, stormregion_table) and len(a) == len(b) and all(
+            (a.strings(name) == b.strings(name)) if dtype == "s" else (list(a.columns[name]) == list(b.columns[name]))
+            for (name, dtype) in a.schema)
+
+    if isinstance(a, (list, tuple)):
+        return isinstance(b, (list, tuple)) and len(a) == len(b) and all(same(x, y) for (x, y) in zip(a, b))
+
+    if isinstance(a, dict):
+        return isinstance(b, dict) and a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+
+    slots = getattr(type(a), "__slots__", None)
+    if slots:
+        return type(a) is type(b) and all(same(getattr(a, name, None), getattr(b, name, None)) for name in slots)
+
+    if isinstance(a, memoryview):
+        return bytes(a) == bytes(b)
+
+    return a == b
+
+
+@pytest.fixture(scope="module")
+def map_path(tmp_path_factory):
+    path = tmp_path_factory.mktemp("maps") / "synthetic.map"
+    path.write_bytes(write_map(65, layers=5, doods=200, roads=4, units=12, decals=6, size_y=49, stored_units=2))
+    return str(path)
+
+
+def full_parse(path):
+    with stormregion_reader.open(path) as file:
+        return native.parse_4d_model(path, file)
+
+
+LAZY_SECTIONS = [name for cls in native.stormregion_lazy_map.__mro__ for (name, attr) in vars(cls).items()
+                 if isinstance(attr, native.lazy_section)]
+
+
+@pytest.mark.parametrize("name", LAZY_SECTIONS)
+def test_lazy_section_read_first(map_path, name):
+    # each section as the very first thing read from a fresh lazy map,
+    # decoders that need other sections must not disturb the file position
+    full = full_parse(map_path)
+
+    with native.open_map(map_path) as lazy_map:
+        assert same(getattr(lazy_map, name), getattr(full, name)), name
+
+
+def test_lazy_section_corrupt(tmp_path):
+    data = write_map(33, doods=20, decals=4)
+    (tmp_path / "good.map").write_bytes(data)
+    path = tmp_path / "corrupt.map"
+    path.write_bytes(data.replace(b"DECA", b"DECX", 1))
+
+    with native.open_map(str(path)) as lazy_map:
+        for attempt in range(2):
+            with pytest.raises(IOError, match="DECX"):
+                lazy_map.decals
+
+        # the rest of the map still reads
+        assert same(lazy_map.objects, full_parse(str(tmp_path / "good.map")).objects)
+        assert lazy_map.size_x == 33
+
+
+def test_cache_round_trip(map_path, tmp_path, monkeypatch):
+    import stormregion_cache
+
+    full = full_parse(map_path)
+    stormregion_cache.load_map(map_path, str(tmp_path))
+
+    # the second load must come from the cache, not another parse
+    monkeypatch.setattr(native, "parse_4d_model", None)
+    cached = stormregion_cache.load_map(map_path, str(tmp_path))
+
+    for name in LAZY_SECTIONS:
+        assert same(getattr(cached, name), getattr(full, name)), name
+
+
+def test_cache_rebuilt_for_same_size_and_mtime(tmp_path):
+    import stormregion_cache
+
+    path = tmp_path / "edited.map"
+    path.write_bytes(write_map(33, doods=20, seed=1))
+    first = stormregion_cache.load_map(str(path), str(tmp_path))
+    stat = path.stat()
+
+    # rewritten in place with the same size and mtime, only the hash differs
+    path.write_bytes(write_map(33, doods=20, seed=2))
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert path.stat().st_size == stat.st_size
+
+    second = stormregion_cache.load_map(str(path), str(tmp_path))
+    assert same(second.objects, full_parse(str(path)).objects)
+    assert not same(second.objects, first.objects)
+
+
+def test_model_parse_quiet_without_trace(tmp_path, capsys):
+    path = tmp_path / "walker.4d"
+    path.write_bytes(write_model(30, skvs=True))
+
+    assert full_parse(str(path)) is None
+    # just the file type and end of scene, objects/vertices/bones are traced
+    assert len(capsys.readouterr().out.splitlines()) == 3
+
+
+# converts a map with every export plus some spatial queries, argv: map,
+# output folder, texture folder and "nonumpy" to run without numpy
+CONVERT_SCRIPT = """
+import json, sys
+if sys.argv[4] == "nonumpy":
+    sys.modules["numpy"] = None
+
+import stormregion_native as native
+native.stormregion_map.TEXTURE_PATHS = [sys.argv[3]]
+
+for (output, options) in (("plain", {}), ("tiled", {"tile_size": 32, "lod_min_size": 17})):
+    map_file = native.convert_map(sys.argv[1], f"{sys.argv[2]}/{output}", heightmap_formats=("raw", "png", "r32"),
+                                  roads=True, bake=True, instances=True, **options)
+
+queries = {name: [[int(row) for row in map_file.spatial_index(name).radius(30.0, 25.0, 15.0)],
+                  [int(row) for row in map_file.spatial_index(name).nearest(10.0, 40.0, 5)]]
+           for name in native.ENTITY_COORDS}
+with open(f"{sys.argv[2]}/queries.json", "w") as fp:
+    json.dump(queries, fp)
+"""
+
+
+def convert(map_path, output_dir, texture_dir, numpy: bool):
+    env = dict(os.environ, XDG_CACHE_HOME=str(output_dir / "cache"),
+               PYTHONPATH=os.pathsep.join([os.path.dirname(native.__file__), os.environ.get("PYTHONPATH", "")]))
+    result = subprocess.run([sys.executable, "-c", CONVERT_SCRIPT, map_path, str(output_dir), str(texture_dir),
+                             "numpy" if numpy else "nonumpy"], env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    # every file written (relative path -> contents), minus the texture cache
+    outputs = {}
+    for (folder, dirs, files) in os.walk(output_dir):
+        dirs[:] = [name for name in dirs if name != "cache"]
+        for name in files:
+            with open(os.path.join(folder, name), "rb") as fp:
+                outputs[os.path.relpath(os.path.join(folder, name), output_dir).replace(os.sep, "/")] = fp.read()
+
+    return outputs
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy to compare against")
+def test_numpy_and_fallback_output_match(map_path, tmp_path):
+    from PIL import Image
+
+    # a texture for every layer, including the baked road/junction/decal ones
+    map_file = full_parse(map_path)
+    materials = sorted(set([layer["material"] for layer in map_file.tlayers] + map_file.decals.strings("material")
+                           + [road.material for road in map_file.roads + map_file.junctions]))
+
+    texture_dir = tmp_path / "textures"
+    texture_dir.mkdir()
+    for i, material in enumerate(materials):
+        Image.new("RGB", (16, 16), ((i * 40) % 256, 128, 255 - ((i * 40) % 256))).save(texture_dir / f"{material}_1.png")
+
+    with_numpy = convert(map_path, tmp_path / "numpy", texture_dir, True)
+    without_numpy = convert(map_path, tmp_path / "nonumpy", texture_dir, False)
+
+    assert "plain/heightmap.raw" in with_numpy and "tiled/tiles.json" in with_numpy
+    assert sorted(with_numpy) == sorted(without_numpy)
+    for name in with_numpy:
+        assert with_numpy[name] == without_numpy[name], name
+
+
+def brute_force(xs, ys, test):
+    return [row for row in range(len(xs)) if test(float(xs[row]), float(ys[row]))]
+
+
+@pytest.mark.parametrize("entities", sorted(ENTITY_COORDS))
+@pytest.mark.parametrize("cell_size", [None, 7.0, 1000.0])
+def test_spatial_queries_match_brute_force(map_path, entities, cell_size):
+    map_file = full_parse(map_path)
+    index = map_file.spatial_index(entities, cell_size)
+
+    (x_name, y_name) = ENTITY_COORDS[entities]
+    table = getattr(map_file, entities)
+    (xs, ys) = (table.column(x_name), table.column(y_name))
+    assert len(xs)
+
+    for (x1, x2, y1, y2) in ((0, 20, 0, 20), (45, 10, 40, 5), (-5, 100, -5, 100), (90, 95, 90, 95)):
+        (lx, hx), (ly, hy) = sorted((x1, x2)), sorted((y1, y2))
+        assert list(index.rect(x1, x2, y1, y2)) == brute_force(xs, ys, lambda x, y: lx <= x <= hx and ly <= y <= hy)
+
+    for (x, y, radius) in ((20, 20, 10), (30, 20, 0), (0, 0, 200), (-50, -50, 1)):
+        assert list(index.radius(x, y, radius)) == brute_force(
+            xs, ys, lambda px, py: ((px - x) ** 2) + ((py - y) ** 2) <= radius * radius)
+
+    for (x, y, k) in ((20, 20, 1), (50, 4, 7), (-10, 90, len(xs) + 3)):
+        # closest first, ties by row number
+        expected = sorted(range(len(xs)), key=lambda row: ((float(xs[row]) - x) ** 2 + (float(ys[row]) - y) ** 2, row))
+        assert list(index.nearest(x, y, k)) == expected[:k]
+
+
+WRITER_SCRIPT = """
+import hashlib, sys
+if sys.argv[1] == "nonumpy":
+    sys.modules["numpy"] = None
+
+from stormregion_writer import write_map
+print(hashlib.sha1(write_map(97, layers=5, size_y=61, seed=7)).hexdigest())
+"""
+
+
+@pytest.mark.skipif(np is None, reason="needs numpy to compare against")
+def test_writer_same_with_and_without_numpy():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(native.__file__), os.environ.get("PYTHONPATH", "")]))
+    hashes = [subprocess.run([sys.executable, "-c", WRITER_SCRIPT, mode], env=env, capture_output=True, text=True,
+                             check=True).stdout for mode in ("numpy", "nonumpy")]
+
+    assert hashes[0] and hashes[0] == hashes[1]
@@ -0,0 +1,68 @@
+import pytest
+from PIL import Image
+
+import stormregion_stream
+from stormregion_native import open_map
+from stormregion_stream import png_stream_writer, stream_heightmap
+from stormregion_writer import write_map
+
+'''
+Streaming export, mostly what is left behind when it fails
+'''
+
+
+def test_png_writer_complete(tmp_path):
+    path = tmp_path / "image.png"
+    with png_stream_writer(str(path), 3, 2, "L") as writer:
+        writer.write_rows(bytes(range(6)))
+
+    with Image.open(path) as img:
+        assert img.size == (3, 2) and img.tobytes() == bytes(range(6))
+
+
+def test_png_writer_short_close_raises(tmp_path):
+    with pytest.raises(IOError, match="1 rows, expected 2"):
+        with png_stream_writer(str(tmp_path / "image.png"), 3, 2, "L") as writer:
+            writer.write_rows(bytes(3))
+
+
+def test_png_writer_error_not_hidden(tmp_path):
+    path = tmp_path / "image.png"
+
+    # the real error comes out, not the row count, and no truncated file is left
+    with pytest.raises(RuntimeError, match="decoder broke"):
+        with png_stream_writer(str(path), 3, 2, "L") as writer:
+            writer.write_rows(bytes(3))
+            raise RuntimeError("decoder broke")
+
+    assert not path.exists()
+
+
+def test_stream_heightmap_error_removes_png(tmp_path, monkeypatch):
+    map_path = tmp_path / "stream.map"
+    map_path.write_bytes(write_map(65, size_y=49))
+    outputs = {"png": str(tmp_path / "heightmap.png"), "raw": str(tmp_path / "heightmap.raw")}
+
+    quantize = stormregion_stream._quantize
+    calls = []
+
+    def failing_quantize(*args):
+        calls.append(1)
+        if len(calls) > 1:
+            raise ValueError("window 2 broke")
+        return quantize(*args)
+
+    monkeypatch.setattr(stormregion_stream, "_quantize", failing_quantize)
+
+    with open_map(str(map_path)) as map_file:
+        with pytest.raises(ValueError, match="window 2 broke"):
+            stream_heightmap(map_file, outputs, window_rows=16)
+
+    assert not (tmp_path / "heightmap.png").exists()
+
+    monkeypatch.setattr(stormregion_stream, "_quantize", quantize)
+    with open_map(str(map_path)) as map_file:
+        export_size = stream_heightmap(map_file, outputs, window_rows=16)
+
+    with Image.open(outputs["png"]) as img:
+        assert img.size == (export_size, export_size)
@@ -4,6 +4,15 @@
 '''
 Version history
 
+1.3
+- Files are memory mapped and read through stormregion_reader
+- Parse state (dummies, bones, animations) lives in ParsingContext instead of
+  globals, importing another file starts from scratch
+- Per chunk/vertex/bone/animation detail goes through stormregion_trace, off
+  unless STORMREGION_TRACE is set
+- Profiler (stormregion_profile): with STORMREGION_PROFILE=profile.json the
+  import writes its per chunk timings and record counts there from execute
+
 1.2
 - Support for RfB models
 
@@ -21,7 +30,7 @@ Version history
 bl_info = {
     "name": "Import Stormregion 4D Model (.4d)",
     "author": "lorddevereux and others",
-    "version": (1, 2, 0),
+    "version": (1, 3, 0),
     "blender": (3, 6, 0),
     "location": "File > Import-Export",
     "description": "Import Stormregion 4d files from Gepard1/2 v100 and v101",
@@ -43,66 +52,23 @@ import bpy_extras.node_shader_utils
 
 import collections
 
-# v100 - SWINE and some leftover in Panzers Phase 1/2
-# v101 - Panzers phase 1 + 2
-file_version = "v101"
-
-objects = []
-numBones = 0
-bones = []
-dummy_name_id_map = {}
-dummies = []
-scene_animations = {}
-mesh_obj_ptr = None
-bones_by_object = {}
-
-def read_kind(file):
-    return file.read(4).decode()
-
-def read_char(file):
-    raw_data = file.read(1)
-    #print("++C " + raw_data.hex())
-    return int.from_bytes(raw_data, 'little')
-
-def read_uint(file):
-    raw_data = file.read(4)
-    #print("++U " + raw_data.hex())
-    return struct.unpack('<I', raw_data)[0]
-
-def read_sint(file):
-    raw_data = file.read(4)
-    #print("++I " + raw_data.hex())
-    return struct.unpack('<i', raw_data)[0]
-
-def read_ushort(file):
-    raw_data = file.read(2)
-    #print("++S " + raw_data.hex())
-    return struct.unpack('<H', raw_data)[0]
-
-def read_float(file):
-    raw_data = file.read(4)
-    #print("++F " + raw_data.hex())
-    return struct.unpack('<f', raw_data)[0]
-
-def read_string(file):
-    length = read_ushort(file)
-    raw_data = file.read(length)
-    #print("++S " + raw_data.hex())
-    result = raw_data.decode()
-    return result
+from .stormregion_reader import stormregion_reader
+from .stormregion_trace import trace
+from .stormregion_profile import profiler
 
 def read_vec(file, components):
-    res = mathutils.Vector()
-    
-    for i in range(components):
-        res[i] = read_float(file)
-        
-    return res
+    return mathutils.Vector(file.read_vec(components))
 
 def iter_chunks(file, limit):    
+    if profiler.enabled:
+        return profiler.iter_chunks(file, limit)
+
+    return _iter_chunks(file, limit)
+
+def _iter_chunks(file, limit):
     while(file.tell() < limit):
-        kind = read_kind(file)
-        size = read_uint(file)
+        kind = file.read_kind()
+        size = file.read_uint()
         
         last = file.tell() + size
     
@@ -124,46 +90,61 @@ class ParsingContext():
         self.mesh = None
         self.obj  = None
 
+        # v100 - SWINE and some leftover in Panzers Phase 1/2
+        # v101 - Panzers phase 1 + 2
+        self.file_version = "v101"
+
+        # everything collected while parsing one file, kept here rather than
+        # in globals so importing a second file starts from scratch
+        self.dummies = []
+        self.dummy_name_id_map = {}
+        self.bones_by_object = {}
+        self.scene_animations = {}
+        self.mesh_obj_ptr = None
+
 
 def parse_anims(file, limit, ctx):
-    num_anims = read_uint(file)
+    num_anims = file.read_uint()
 
     for (kind, limit) in iter_chunks(file, limit):    
-        print(f"  - {kind}")
+        if trace.chunk:
+            trace.emit("chunk", kind, limit=limit)
 
-        nom = read_string(file)
-        fname = read_string(file)
-        scene_animations[nom] = fname
+        nom = file.read_string()
+        fname = file.read_string()
+        ctx.scene_animations[nom] = fname
 
 
 def parse_material(file, limit, ctx):
     
     # TODO: These properties are actually unsupported, first DIFF applies to whole object
-    if file_version == "v101":
-        numFaces = read_uint(file)      # actually numIndis
-        vertexStart = read_uint(file)
-        vertexEnd = read_uint(file)
+    if ctx.file_version == "v101":
+        numFaces = file.read_uint()      # actually numIndis
+        vertexStart = file.read_uint()
+        vertexEnd = file.read_uint()
     else:
         # 100
-        numFaces    = read_uint(file)
-        vertexStart = read_uint(file)
-        vertexEnd   = read_uint(file) + vertexStart
+        numFaces    = file.read_uint()
+        vertexStart = file.read_uint()
+        vertexEnd   = file.read_uint() + vertexStart
 
     diffuse = None
     specular = None
     
     for (kind, limit) in iter_chunks(file, limit):    
         if kind == 'DIFF':
-            diffuse = read_string(file)
+            diffuse = file.read_string()
 
-            print(f"  > Parsed DIFF: {diffuse} with {vertexStart} and {vertexEnd} and {numFaces}")
+            if trace.material:
+                trace.emit("material", "DIFF", texture=diffuse, start=vertexStart, end=vertexEnd, faces=numFaces)
             
             #  textures stored as .tga, but actually DDS
             diffuse = diffuse.replace('.tga', '.dds')
 
         elif kind == 'SPEC':
-            specular = read_string(file)
-            print(f"  > Parsed SPEC: {specular} with {vertexStart} and {vertexEnd} and {numFaces}")
+            specular = file.read_string()
+            if trace.material:
+                trace.emit("material", "SPEC", texture=specular, start=vertexStart, end=vertexEnd, faces=numFaces)
 
 
         elif kind == "STRP":
@@ -171,19 +152,16 @@ def parse_material(file, limit, ctx):
 
 
         elif kind == "MTBL":
-            numMTBL = read_uint(file)
-
-            print(f"  > Found MTBL section with {numMTBL} indexes")
+            numMTBL = file.read_uint()
 
-            mtbl = []
+            mtbl = file.read_array('I', numMTBL).tolist()
 
-            for idx in range(numMTBL):
-                mtbl.append(read_uint(file))
-
-            print(mtbl)
+            if trace.material:
+                trace.emit("material", "MTBL", count=numMTBL, indexes=mtbl)
 
         else:
-            print(f"  > Unsupported MTL kind {kind}")
+            if trace.material:
+                trace.emit("material", "unsupported", kind=kind)
             
         # Other settings are not supported
         pass
@@ -223,21 +201,19 @@ def parse_material(file, limit, ctx):
 
 
 def parse_object(file, limit, ctx, kind = "MESH"):
-    global mesh_obj_ptr
-
-    name     = read_string(file)
-    parentID = read_sint(file)
+    name     = file.read_string()
+    parentID = file.read_sint()
     print(f"Parsed {kind}: {name} with parent ID {parentID}")
 
     is_stripe = False
     indis = []
     indiNum = 0
     
-    if file_version == "v101":
+    if ctx.file_version == "v101":
         # waste 8 bytes
         print("> Wasting 8 bytes for 101")
-        read_sint(file)
-        read_sint(file)
+        file.read_sint()
+        file.read_sint()
 
     if kind == "MESH" or kind == "SKVS":
         # Allocate associated blender structures
@@ -253,9 +229,9 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
     # Parse transformation, location
     ctx.obj.matrix_local = (
-        (read_float(file), read_float(file), read_float(file), 0),
-        (read_float(file), read_float(file), read_float(file), 0),
-        (read_float(file), read_float(file), read_float(file), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
+        (file.read_float(), file.read_float(), file.read_float(), 0),
         (0,                0,                0,                1)
     )
 
@@ -272,22 +248,23 @@ def parse_object(file, limit, ctx, kind = "MESH"):
     faces = []
 
     if kind == "DUMY":
-        dummy_name_id_map[name] = len(dummies)
-        dummies.append(ctx.obj)
+        ctx.dummy_name_id_map[name] = len(ctx.dummies)
+        ctx.dummies.append(ctx.obj)
         return
     
     root_kind = kind
 
     for (kind, limit) in iter_chunks(file, limit):
-
-        print(f"> Parsing kind {kind}")
+        if trace.chunk:
+            trace.emit("chunk", kind, object=name, limit=limit)
 
         # VRT2 is used by RfB, seems to be mostly the same as VERT
                 
         # normal VERT, for objects and vehicles
         if (kind == 'VERT' or kind == 'VRT2') and root_kind != "SKVS":
-            vertexNum    = read_uint(file)
-            vertexFormat = read_uint(file)
+            vertexNum    = file.read_uint()
+            profiler.add_records(vertexNum)
+            vertexFormat = file.read_uint()
 
             if vertexNum > 0xFFFF:
                 raise IOError('Too many vertices')
@@ -310,8 +287,8 @@ def parse_object(file, limit, ctx, kind = "MESH"):
                     
                     # Whacky coordinate systems..
                     vertex_uv.append((
-                        0 + read_float(file), 
-                        1 - read_float(file)
+                        0 + file.read_float(), 
+                        1 - file.read_float()
                     ))
 
             else:
@@ -331,24 +308,26 @@ def parse_object(file, limit, ctx, kind = "MESH"):
                     
                     # Whacky coordinate systems..
                     vertex_uv.append((
-                        0 + read_float(file), 
-                        1 - read_float(file)
+                        0 + file.read_float(), 
+                        1 - file.read_float()
                     ))
-                    other = read_float(file)
+                    other = file.read_float()
 
 
         # VERT inside SKVS is used by "walker"s (humans)
         elif (kind == "VERT" or kind == "VRT2") and root_kind == "SKVS":
-            vertexNum    = read_uint(file)
-            vertexFormat = read_uint(file)
-            vertexUnknown = read_uint(file)
+            vertexNum    = file.read_uint()
+            profiler.add_records(vertexNum)
+            vertexFormat = file.read_uint()
+            vertexUnknown = file.read_uint()
 
             print(f" > Read vertex format SKVS: {vertexNum}, {vertexFormat}, {vertexUnknown}")
 
             vertex_pos  = []
             vertex_norm = []
             vertex_uv   = []
-            
+            trace_vertex = trace.vertex
+            trace_bone   = trace.bone
 
             for idx in range(vertexNum):
                 vertex_pos.append( read_vec(file, 3) * ctx.scale )
@@ -356,40 +335,38 @@ def parse_object(file, limit, ctx, kind = "MESH"):
                 
                 # Whacky coordinate systems..
                 vertex_uv.append((
-                    0 + read_float(file), 
-                    1 - read_float(file)
+                    0 + file.read_float(), 
+                    1 - file.read_float()
                 ))
 
                 bone_numbers = []
                 group = 0
                 for i in range(4):
-                    group = read_char(file)
+                    group = file.read_char()
                     bone_numbers.append(group)
-                
-                print(f" > > Bone num {bone_numbers}")
 
                 bone_weights = []
                 material_floats = []
 
                 for i in range(4):
-                    bone_weights.append(read_float(file))
-
-                print(f" > > Bone weights {bone_weights}")
+                    bone_weights.append(file.read_float())
 
                 mtbl_numbers = []
                 for i in range(4):
-                    mtbl_numbers.append(read_char(file))
-                
-                print(f" > > MTBL {mtbl_numbers}")
+                    mtbl_numbers.append(file.read_char())
 
                 for i in range(4):
-                    material_floats.append(read_float(file))
+                    material_floats.append(file.read_float())
+
+                if trace_vertex:
+                    trace.emit("vertex", "SKVS", object=name, index=idx, bones=bone_numbers, weights=bone_weights, mtbl=mtbl_numbers)
 
                 # create vertex groups with weights
                 for i in range(4):
                     if bone_numbers[i] not in groups_created:
                         ctx.obj.vertex_groups.new(name = f"{bone_numbers[i]}")
-                        print(f"Create vertex group {bone_numbers[i]}")
+                        if trace_bone:
+                            trace.emit("bone", "vertex group", object=name, group=bone_numbers[i])
                         groups_created[bone_numbers[i]] = []
                     
                     groups_created[bone_numbers[i]].append((int(idx), bone_weights[i]))
@@ -397,47 +374,47 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
 
         elif kind == "BONS":
-            if name not in bones_by_object:
-                bones_by_object[name] = {}
-            numBones = read_uint(file)
+            if name not in ctx.bones_by_object:
+                ctx.bones_by_object[name] = {}
+            numBones = file.read_uint()
+            profiler.add_records(numBones)
 
             for idx in range(numBones):
-                bone_id = read_uint(file) - 1
+                bone_id = file.read_uint() - 1
                 matrix = read_vec(file, 3)
                 matrix2 = read_vec(file, 3)
                 matrix3 = read_vec(file, 3)
                 pos = read_vec(file, 3)
                 this_bone = ( matrix, matrix2, matrix3, pos)
   
-                bones_by_object[name][bone_id] = this_bone
-                print(f" > Bone {bone_id}: {matrix}")
-                print(f" >         {matrix2}")
-                print(f" >         {matrix3}")
-                print(f" >         {pos}")
+                ctx.bones_by_object[name][bone_id] = this_bone
+                if trace.bone:
+                    trace.emit("bone", "BONS", object=name, bone=bone_id, matrix=(matrix, matrix2, matrix3), pos=pos)
                 
 
             print(f" > Loaded {numBones} bones for this object")
 
 
         elif kind == 'INDI':
-            indiNum = read_uint(file)
+            indiNum = file.read_uint()
+            profiler.add_records(indiNum)
 
             print(f" > Found {indiNum} indexes for this mesh")
 
-            for idx in range(indiNum):
-                indis.append(read_ushort(file))
+            indis.extend(file.read_array('H', indiNum).tolist())
                 
 
         elif kind == 'FACE':
-            faceNum = read_uint(file)
+            faceNum = file.read_uint()
+            profiler.add_records(faceNum)
 
             print(f" > Found {faceNum} faces for this mesh")
             
             for idx in range(faceNum):
                 faces.append((
-                    read_ushort(file),
-                    read_ushort(file),
-                    read_ushort(file)          
+                    file.read_ushort(),
+                    file.read_ushort(),
+                    file.read_ushort()          
                 ))
                 
             # Fill mesh data with geometry (vertices, faces)
@@ -452,7 +429,7 @@ def parse_object(file, limit, ctx, kind = "MESH"):
         
 
         elif kind == 'MTLS' or kind == 'SSQS':
-            materialNum = read_uint(file)
+            materialNum = file.read_uint()
             
             for (kind, limit) in iter_chunks(file, limit):
                 if kind == 'MATE' or kind == "STRP":
@@ -512,19 +489,17 @@ def parse_object(file, limit, ctx, kind = "MESH"):
         # Create UV mapping
         uv_layer = ctx.mesh.uv_layers.new()
 
-        mesh_obj_ptr = len(ctx.objects) - 1
+        ctx.mesh_obj_ptr = len(ctx.objects) - 1
 
-        print(f"Set mesh_obj_ptr: {mesh_obj_ptr}")
+        print(f"Set mesh_obj_ptr: {ctx.mesh_obj_ptr}")
 
         for idx, loop in enumerate(ctx.mesh.loops):
             uv_layer.data[idx].uv = vertex_uv[loop.vertex_index]
 
         for group in ctx.obj.vertex_groups:
-            print(group)
             igroup = int(group.name)
-            print(f"Adding to vtx group {group.name}")
-            print(groups_created[igroup][0])
-            print(groups_created[igroup][1])
+            if trace.bone:
+                trace.emit("bone", "vertex group weights", object=name, group=group.name, vertices=len(groups_created[igroup]))
             for vertex in groups_created[igroup]:
                 group.add( [vertex[0]], vertex[1], 'ADD' )
 
@@ -538,8 +513,6 @@ def parse_object(file, limit, ctx, kind = "MESH"):
 
 
 def parse_4d_model(filepath, file):
-    global file_version
-
     if file.read(8) != b'\x53\x72\x1A\x1B\x0D\x0A\x87\x0A':
         raise IOError('Not a Stormregion file')
 
@@ -566,12 +539,12 @@ def parse_4d_model(filepath, file):
         if kind != 'SCEN':
             raise IOError('Not a SCEN file')
     
-        file_version = file.read(4).decode("utf-8")
-        print(f"SCEN version {file_version}")
+        ctx.file_version = file.read(4).decode("utf-8")
+        print(f"SCEN version {ctx.file_version}")
 
         # v100: Rotate root object to compensate some the wacky coordinate system
         # v101: No correction
-        if file_version == "v100":
+        if ctx.file_version == "v100":
             root.rotation_euler = (math.radians(90), 0, 0)
             
         for (kind, limit) in iter_chunks(file, limit):
@@ -631,7 +604,7 @@ def parse_4d_model(filepath, file):
             obj.parent_type = 'OBJECT'
 
 
-    if len(bones_by_object) > 0:
+    if len(ctx.bones_by_object) > 0:
         #armature = bpy.data.armatures.new(f"arm_{scene_name}")
         #armature_object = bpy.data.objects.new(f"obj_{scene_name}", armature)
         #armature.show_names = True
@@ -642,17 +615,17 @@ def parse_4d_model(filepath, file):
         
         # create a list of dummies that are relevant
         bones_to_create = {}
-        print(f"Found {len(bones)} bones to process")
+        print(f"Found {len(ctx.bones_by_object)} objects with bones to process")
 
         # get a list of dummy names -> IDs
         print("DUMMIES:")
-        print(dummies)
+        print(ctx.dummies)
 
         # now find the head and tail of them all
-        for object in bones_by_object:
-            for dummy in bones_by_object[object]:
+        for object in ctx.bones_by_object:
+            for dummy in ctx.bones_by_object[object]:
                 print(f"Parsing DUMY {dummy}...")
-                dumy_object = dummies[dummy]
+                dumy_object = ctx.dummies[dummy]
 
                 if dummy in bones_to_create:
                     print("WARNING: duplicate bone INDEX!!!")
@@ -663,22 +636,22 @@ def parse_4d_model(filepath, file):
                     print(f"Can't deal with DUMY without a parent: {dumy_object.name}")
                     continue
 
-                parent_id = dummy_name_id_map[dumy_object.parent.name]
+                parent_id = ctx.dummy_name_id_map[dumy_object.parent.name]
 
-                if parent_id not in bones_by_object[object]:
+                if parent_id not in ctx.bones_by_object[object]:
                     print(f"Found root armature node {dumy_object.parent.name}")
                     bones_to_create[dummy]["name"] = dumy_object.name
                     bones_to_create[dummy]["parent"] = None
 
                 else:
-                    print(f"{dumy_object.name} bone {dummy_name_id_map[dumy_object.name]} is a child of {dumy_object.parent} which is bone {parent_id}")
+                    print(f"{dumy_object.name} bone {ctx.dummy_name_id_map[dumy_object.name]} is a child of {dumy_object.parent} which is bone {parent_id}")
                     bones_to_create[dummy]["name"] = dumy_object.name
                     bones_to_create[dummy]["parent"] = parent_id
 
         print("BONES TO CREATE:")
         pprint.pprint(bones_to_create)
 
-        for object in bones_by_object:
+        for object in ctx.bones_by_object:
             print(f"Object {object}")
 
             joints = {}
@@ -712,8 +685,8 @@ def parse_4d_model(filepath, file):
                 else:
                     parent = root
 
-                dummy_name = dummies[bone_index]
-                bone_properties = bones_by_object[object][bone_index]
+                dummy_name = ctx.dummies[bone_index]
+                bone_properties = ctx.bones_by_object[object][bone_index]
 
                 ctx.obj = bpy.data.objects.new(bprops["name"] + "_bone", None)
                 ctx.obj.parent = parent
@@ -781,8 +754,15 @@ class Import4DModel(Operator, ImportHelper):
     filter_glob: StringProperty(default="*.4d", options={'HIDDEN'}, maxlen=255)
 
     def execute(self, context):
-        with open(self.filepath, 'rb') as file:
-            return parse_4d_model(self.filepath, file)
+        # the addon stays loaded between imports, profile each one on its own
+        profiler.reset()
+
+        with stormregion_reader.open(self.filepath) as file:
+            result = parse_4d_model(self.filepath, file)
+
+        # only if STORMREGION_PROFILE is set
+        profiler.save(file=self.filepath)
+        return result
 
 
 def menu_func_import(self, context):
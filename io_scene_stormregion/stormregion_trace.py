@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+import threading
+
+'''
+Tracing for the parsers
+
+Detail that is only useful while working out the file formats (every chunk,
+object, vertex, bone, map entity, animation frame...) goes through here
+instead of print(). Each category is a plain bool attribute of the trace
+object, call sites check it before building anything, so a disabled category
+costs one attribute lookup:
+
+    if trace.vertex:
+        trace.emit("vertex", "VERT", index=idx, pos=pos)
+
+In hot loops take the flag into a local first. Records are printed, or
+written as JSON lines to a file for later digging.
+
+Set from the environment (also picked up by batch workers):
+
+    STORMREGION_TRACE=2                 level, categories up to that level
+    STORMREGION_TRACE=vertex,bone       just these categories
+    STORMREGION_TRACE_FILE=trace.jsonl  JSON lines instead of printing
+
+The same file is shipped with the Blender addon (io_scene_stormregion), keep
+the two copies in sync.
+'''
+
+# category -> lowest level it is enabled at
+CATEGORIES = {
+    "chunk"     : 1,    # chunk tree, one record per chunk
+    "material"  : 2,    # DIFF/SPEC/MTBL...
+    "bone"      : 2,    # BONS and vertex groups
+    "object"    : 2,    # model objects, their transformation and vertex counts
+    "entity"    : 2,    # every road, junction, TVAR, LOC and PATH of a map
+    "anim"      : 3,    # every CPSP/CEUP frame
+    "vertex"    : 3,    # every vertex
+}
+
+
+class stormregion_trace:
+    '''
+    Switches for each category plus where the records go
+    '''
+
+    def __init__(self):
+        self.level  = 0
+        self.output = None
+        self.lock   = threading.Lock()
+
+        for category in CATEGORIES:
+            setattr(self, category, False)
+
+
+    def configure(self, level: int = 0, categories: list = None, output_filename: str = None):
+        '''
+        Enable every category up to level, plus any listed in categories.
+        With output_filename records are appended to it as JSON lines
+        '''
+
+        for category in (categories or []):
+            if category not in CATEGORIES:
+                raise ValueError(f"Unknown trace category {category}, use one of {list(CATEGORIES)}")
+
+        self.close()
+
+        self.level = level
+        for category, category_level in CATEGORIES.items():
+            setattr(self, category, category_level <= level or category in (categories or []))
+
+        if output_filename and self.enabled():
+            self.output = open(output_filename, "a")
+
+
+    def configure_from_env(self):
+        setting = os.environ.get("STORMREGION_TRACE", "")
+        if not setting:
+            return
+
+        if setting.isdigit():
+            self.configure(int(setting), output_filename=os.environ.get("STORMREGION_TRACE_FILE"))
+        else:
+            self.configure(0, setting.split(","), os.environ.get("STORMREGION_TRACE_FILE"))
+
+
+    def enabled(self):
+        return any(getattr(self, category) for category in CATEGORIES)
+
+
+    def emit(self, category: str, event: str, **fields):
+        '''
+        Write one record, only call this after checking the category
+        '''
+
+        if self.output is None:
+            details = " ".join(f"{name}={value}" for name, value in fields.items())
+            print(f"[{category}] {event} {details}")
+            return
+
+        line = json.dumps({"cat": category, "event": event, **fields}, default=str)
+        with self.lock:
+            self.output.write(line + "\n")
+
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+trace = stormregion_trace()
+trace.configure_from_env()